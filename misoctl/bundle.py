@@ -0,0 +1,238 @@
+from hashlib import md5
+from hashlib import sha512
+from io import BytesIO
+import json
+import os
+import tarfile
+import time
+from misoctl import debfile
+from misoctl import filemanager
+from misoctl.log import log as log
+
+"""
+Pack a build directory into one file, and read it back without unpacking it.
+
+A bundle is an uncompressed tar file. The first member is MANIFEST.json, which
+lists every other member's name, size, md5 and sha512, the control fields of
+each .deb, and the build's times. That is everything "upload" needs for the CG
+metadata, so it can stream each member straight to Koji.
+"""
+
+MANIFEST = 'MANIFEST.json'
+
+FORMAT = 1
+
+DESCRIPTION = """
+Pack a build directory into one bundle file for "misoctl upload".
+
+The bundle holds the .dsc, the source files it lists, the .debs, and the
+.build log (as a .log file), with a leading manifest of their sizes and
+checksums.
+"""
+
+
+class BundleFormatError(Exception):
+    """ This file is not a bundle that we can read. """
+    pass
+
+
+def add_parser(subparsers):
+    """
+    Add build parser to this top-level subparsers object.
+    """
+    parser = subparsers.add_parser('bundle', description=DESCRIPTION,
+                                   help='pack a build directory into one '
+                                        'file')
+    parser.add_argument('--skip-log', action='store_true',
+                        help="Do not bundle a .build log file")
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help='bundle file to write (defaults to '
+                             'SOURCE_VERSION.bundle in the current '
+                             'directory)')
+    parser.add_argument('directory', help="parent directory of a .dsc file")
+    parser.set_defaults(func=main)
+
+
+def hash_file(path):
+    """
+    Read a file once, for its manifest entry.
+
+    :returns: dict of size, md5 and sha512, and control fields for a .deb.
+    """
+    md5sum = md5()
+    sha512sum = sha512()
+    reader = None
+    if path.endswith('.deb'):
+        reader = debfile.ControlReader()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(debfile.CHUNK_SIZE), b''):
+            md5sum.update(chunk)
+            sha512sum.update(chunk)
+            size += len(chunk)
+            if reader and not reader.done:
+                try:
+                    reader.feed(chunk)
+                except debfile.DebFormatError as e:
+                    log.warning('%s: %s' % (path, e))
+                    reader = None
+    entry = {
+        'size': size,
+        'md5': md5sum.hexdigest(),
+        'sha512': sha512sum.hexdigest(),
+    }
+    if path.endswith('.deb'):
+        entry['control'] = reader.control() if reader else {}
+    return entry
+
+
+def get_manifest(build_dir, skip_log):
+    """
+    Find and hash the build artifacts for a bundle.
+
+    :param build_dir: filemanager.BuildDirectory with one dsc file.
+    :param skip_log: Don't try to bundle a log file for this build.
+    :returns: two-element tuple of the manifest dict, and a list of
+              (path, member name) tuples in the same order as the
+              manifest's "files".
+    """
+    dsc = build_dir.dsc()
+    # We compare the md5s with the .dsc as we hash each file below.
+    source_files = build_dir.source_files(verify=False)
+    paths = [build_dir.dsc_file()] + sorted(source_files) + \
+        sorted(build_dir.deb_files())
+    members = [(path, os.path.basename(path)) for path in paths]
+    log_file = build_dir.log_file(fatal=not skip_log)
+    if log_file:
+        (start_time, end_time) = filemanager.get_build_times(log_file)
+        # Koji checks the extension, see upload.rename_log_file().
+        name = os.path.basename(log_file)[:-len('.build')] + '.log'
+        members.append((log_file, name))
+    else:
+        start_time = end_time = filemanager.get_date_time(build_dir.changes())
+
+    dsc_md5sums = dict((f['name'], f['md5sum']) for f in dsc['Files'])
+    files = []
+    for path, name in members:
+        entry = {'name': name}
+        entry.update(hash_file(path))
+        if name in dsc_md5sums and dsc_md5sums[name] != entry['md5']:
+            raise RuntimeError('dsc file md5sum mismatch on %s' % path)
+        files.append(entry)
+    manifest = {
+        'format': FORMAT,
+        'source': dsc['Source'],
+        'version': dsc['Version'],
+        'start_time': start_time,
+        'end_time': end_time,
+        'files': files,
+    }
+    return (manifest, members)
+
+
+def write_bundle(path, manifest, members):
+    """
+    Write the manifest, then each member, as one tar file.
+
+    We write to a temporary file and rename it, so a bundle that exists is
+    always complete.
+    """
+    tmp_path = path + '.tmp'
+    with tarfile.open(tmp_path, 'w', dereference=True) as tar:
+        data = json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(data)
+        info.mtime = time.time()
+        tar.addfile(info, BytesIO(data))
+        for (filename, name), entry in zip(members, manifest['files']):
+            info = tar.gettarinfo(filename, arcname=name)
+            if info.size != entry['size']:
+                raise RuntimeError('%s changed size while bundling'
+                                   % filename)
+            with open(filename, 'rb') as f:
+                tar.addfile(info, f)
+    os.rename(tmp_path, path)
+
+
+def read_manifest(path):
+    """
+    Read the manifest at the start of a bundle file.
+
+    :raises: BundleFormatError if this is not a bundle.
+    """
+    try:
+        with tarfile.open(path) as tar:
+            member = tar.next()
+            if member is None or member.name != MANIFEST:
+                raise BundleFormatError('%s does not start with %s'
+                                        % (path, MANIFEST))
+            manifest = json.loads(tar.extractfile(member).read()
+                                  .decode('utf-8'))
+    except (tarfile.TarError, ValueError) as e:
+        raise BundleFormatError('%s: %s' % (path, e))
+    if manifest.get('format') != FORMAT:
+        raise BundleFormatError('%s has unknown format %s'
+                                % (path, manifest.get('format')))
+    return manifest
+
+
+class Bundle(object):
+    """
+    One bundle file, read in place.
+
+    :param path: bundle file from "misoctl bundle"
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest = read_manifest(path)
+
+    def dsc(self):
+        """ Return the .dsc fields that we keep in the manifest. """
+        return {'Source': self.manifest['source'],
+                'Version': self.manifest['version']}
+
+    @property
+    def size(self):
+        """ Total size in bytes of the files in this bundle. """
+        return sum(entry['size'] for entry in self.manifest['files'])
+
+    def members(self):
+        """
+        Yield each file in this bundle, in manifest order.
+
+        We don't extract anything. Each file object reads from the bundle,
+        and can seek. Finish with each one before you ask for the next.
+
+        :returns: generator of (manifest entry, file object) tuples
+        """
+        entries = list(self.manifest['files'])
+        with tarfile.open(self.path) as tar:
+            for member in tar:
+                if member.name == MANIFEST:
+                    continue
+                if not entries:
+                    raise BundleFormatError('%s has unlisted member %s'
+                                            % (self.path, member.name))
+                entry = entries.pop(0)
+                if member.name != entry['name'] or \
+                   member.size != entry['size']:
+                    raise BundleFormatError('%s member %s does not match '
+                                            'its manifest entry'
+                                            % (self.path, member.name))
+                yield (entry, tar.extractfile(member))
+        if entries:
+            raise BundleFormatError('%s is missing %s'
+                                    % (self.path, entries[0]['name']))
+
+
+def main(args):
+    build_dir = filemanager.BuildDirectory(args.directory)
+    (manifest, members) = get_manifest(build_dir, args.skip_log)
+    output = args.output
+    if not output:
+        output = '%(source)s_%(version)s.bundle' % manifest
+    write_bundle(output, manifest, members)
+    size = sum(entry['size'] for entry in manifest['files'])
+    log.info('wrote %s (%d files, %.1f MB)'
+             % (output, len(members), size / 1048576.0))
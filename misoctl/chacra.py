@@ -1,13 +1,34 @@
 import os
 from hashlib import sha512
+from multiprocessing.pool import ThreadPool
 import posixpath
+import threading
+import time
+import requests
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    # Python 2
+    from urlparse import urlparse
 from misoctl.log import log as log
+from misoctl.metrics import metrics
 from misoctl.util import ensure_directory
+from misoctl.util import record_hash
 
 """
 Methods for interacting with builds in Chacra.
 """
 
+# Download files this large in byte-range segments over several
+# connections, since one TCP stream over the WAN is too slow for them.
+SEGMENT_THRESHOLD = 256 * 1024 * 1024
+SEGMENTS = 4
+
+
+class ChecksumMismatchError(RuntimeError):
+    """ A downloaded file does not match Chacra's checksum. """
+    pass
+
 
 def name_version(nvr):
     """
@@ -39,48 +60,654 @@ def name_version_release(nvr):
     return (name, version, release)
 
 
-def download_build(nvr, base_url, session):
+class Mirror(object):
+    """ One Chacra server, and what we have seen of it this run. """
+
+    def __init__(self, url):
+        self.url = url
+        # Seconds per request, and bytes per second for downloads.
+        self.latency = None
+        self.rate = None
+        self.in_flight = 0
+        self.failures = 0
+        self.down_until = 0
+
+    def join(self, path):
+        return posixpath.join(self.url, path)
+
+
+class MirrorPool(object):
+    """
+    Several Chacra servers with the same content.
+
+    For each request we choose the mirror that we expect to answer soonest,
+    from the latency and throughput we have measured and the requests
+    already in flight there. Mirrors that fail sit out for a while, doubling
+    each time, and requests fail over to the other mirrors.
+    """
+
+    WEIGHT = 0.3
+    BACKOFF = 30
+    MAX_BACKOFF = 600
+
+    def __init__(self, urls):
+        """
+        :param urls: one base URL, or a list of mirror base URLs
+        """
+        if not isinstance(urls, (list, tuple)):
+            urls = [urls]
+        self.mirrors = [Mirror(url) for url in urls]
+        self.lock = threading.Lock()
+
+    def cost(self, mirror, nbytes):
+        """ Estimate how long a request for nbytes would take here. """
+        if mirror.latency is None:
+            # Try every mirror once.
+            return -1
+        seconds = mirror.latency
+        if nbytes and mirror.rate:
+            seconds += nbytes / mirror.rate
+        return seconds * (mirror.in_flight + 1)
+
+    def choose(self, nbytes=0, exclude=()):
+        """
+        Claim the best mirror for a request of about nbytes.
+
+        Call release() when the request is done.
+
+        :returns: a Mirror, or None if we have tried them all.
+        """
+        with self.lock:
+            candidates = [m for m in self.mirrors if m not in exclude]
+            if not candidates:
+                return None
+            now = time.time()
+            healthy = [m for m in candidates if m.down_until <= now]
+            if healthy:
+                mirror = min(healthy, key=lambda m: self.cost(m, nbytes))
+            else:
+                # Everything is down. Try the one that should recover first.
+                mirror = min(candidates, key=lambda m: m.down_until)
+            mirror.in_flight += 1
+            return mirror
+
+    def healthy(self):
+        """ Return the mirrors that are not sitting out a failure. """
+        with self.lock:
+            now = time.time()
+            return [m for m in self.mirrors if m.down_until <= now]
+
+    def claim_healthy(self, exclude=()):
+        """
+        Claim every healthy mirror, eg. to spread one download over them.
+
+        Call release() for each mirror when the request is done.
+
+        :returns: list of Mirrors
+        """
+        with self.lock:
+            now = time.time()
+            mirrors = [m for m in self.mirrors
+                       if m not in exclude and m.down_until <= now]
+            for mirror in mirrors:
+                mirror.in_flight += 1
+            return mirrors
+
+    def release(self, mirror, ok, seconds=None, nbytes=0):
+        """ Record how one request to this mirror went. """
+        with self.lock:
+            mirror.in_flight -= 1
+            if not ok:
+                mirror.failures += 1
+                backoff = min(self.BACKOFF * 2 ** (mirror.failures - 1),
+                              self.MAX_BACKOFF)
+                mirror.down_until = time.time() + backoff
+                if len(self.mirrors) > 1:
+                    log.warning('chacra mirror %s failed, skipping it for %d '
+                                'seconds' % (mirror.url, backoff))
+                return
+            mirror.failures = 0
+            if seconds is None:
+                return
+            seconds = max(seconds, 0.001)
+            if nbytes:
+                sample = nbytes / seconds
+                if mirror.rate is not None:
+                    sample = self.WEIGHT * sample + \
+                        (1 - self.WEIGHT) * mirror.rate
+                mirror.rate = sample
+            else:
+                sample = seconds
+                if mirror.latency is not None:
+                    sample = self.WEIGHT * sample + \
+                        (1 - self.WEIGHT) * mirror.latency
+                mirror.latency = sample
+
+    def relative_path(self, url):
+        """ Return this mirror URL's path relative to its mirror. """
+        for mirror in self.mirrors:
+            prefix = mirror.url.rstrip('/') + '/'
+            if url.startswith(prefix):
+                return url[len(prefix):]
+        raise ValueError('%s is not on any chacra mirror' % url)
+
+    def get(self, session, path, **kwargs):
+        """
+        GET a path from the best mirror, failing over on errors.
+
+        Connection errors, timeouts and 5xx responses move on to the next
+        mirror. Any other response (including a 404) is the answer.
+
+        :returns: requests.Response
+        """
+        tried = []
+        error = None
+        while True:
+            mirror = self.choose(exclude=tried)
+            if mirror is None:
+                break
+            tried.append(mirror)
+            start = time.time()
+            try:
+                response = session.get(mirror.join(path), **kwargs)
+            except requests.RequestException as e:
+                self.release(mirror, False)
+                error = e
+                continue
+            if response.status_code >= 500:
+                self.release(mirror, False)
+                error = None
+                continue
+            self.release(mirror, True, time.time() - start)
+            return response
+        if error:
+            raise error
+        # Every mirror answered with a server error.
+        return response
+
+
+class ChacraCatalog(object):
+    """
+    In-memory index of the binaries that Chacra holds for each package.
+
+    We fetch each package's whole version/arch/file tree (including every
+    file's checksum and size) with one search query, the first time we need
+    it, and answer everything else for this run from that index.
+
+    Older Chacra servers do not have the search endpoint. For those we fall
+    back to fetching each version's listing and arch metadata on demand.
+    """
+
+    def __init__(self, base_url, session):
+        """
+        :param base_url: chacra base URL, or a list of mirror base URLs
+        :param session: persistent requests.Session() to use for HTTPS
+                        requests
+        """
+        self.mirrors = MirrorPool(base_url)
+        self.base_url = self.mirrors.mirrors[0].url
+        self.session = session
+        self.use_search = True
+        # package name -> version -> arch -> filename -> metadata dict
+        self.packages = {}
+        # Callers may look up builds from many threads. Only fetch each
+        # package once.
+        self.lock = threading.Lock()
+        self.package_locks = {}
+
+    def build_path(self, nvr, arch=None, filename=None):
+        """ Return the path for this build, arch, or file on any mirror. """
+        (pkg, version) = name_version(nvr)
+        parts = ['binaries', pkg, version, 'ubuntu', 'all']
+        if arch:
+            parts.append(arch)
+        if filename:
+            parts.append(filename)
+        return posixpath.join(*parts)
+
+    def build_url(self, nvr, arch=None, filename=None):
+        """ Return the Chacra URL for this build, arch, or file. """
+        return posixpath.join(self.base_url,
+                              self.build_path(nvr, arch, filename))
+
+    def binaries(self, nvr):
+        """
+        Find all of this build's files in Chacra.
+
+        :param nvr: build NVR, eg ceph-ansible_3.2.0~rc3-2redhat1
+        :returns: dict of arch -> filename -> metadata dict (with "checksum"
+                  and "size" keys). Empty if Chacra has no such build.
+        """
+        (pkg, version) = name_version(nvr)
+        if self.use_search:
+            self.load_package(pkg)
+        tree = self.packages.setdefault(pkg, {})
+        if version not in tree:
+            # Either this server can't search, or the search did not
+            # return this version. Confirm with the build's listing before
+            # we call it missing.
+            tree[version] = self.fetch_version(nvr)
+        return tree[version]
+
+    def add(self, nvr, binaries):
+        """
+        Record this build's files without asking Chacra, eg. from a plan.
+
+        :param binaries: dict of arch -> filename -> metadata dict
+        """
+        (pkg, version) = name_version(nvr)
+        self.packages.setdefault(pkg, {})[version] = binaries
+
+    def exists(self, nvr):
+        """ Return True if Chacra has any files for this build. """
+        return bool(self.binaries(nvr))
+
+    def metadata(self, nvr, filename):
+        """
+        Return Chacra's metadata dict for one file in this build.
+
+        :returns: dict with "checksum" and "size" keys, or None if Chacra
+                  has no such file for this build.
+        """
+        for files in self.binaries(nvr).values():
+            if filename in files:
+                return files[filename]
+        return None
+
+    def checksum(self, nvr, filename):
+        """ Return Chacra's sha512 for one file, or None if it is absent. """
+        metadata = self.metadata(nvr, filename)
+        if metadata is None:
+            return None
+        return metadata['checksum']
+
+    def size(self, nvr):
+        """ Return the total size in bytes of all this build's files. """
+        total = 0
+        for files in self.binaries(nvr).values():
+            for metadata in files.values():
+                total += metadata.get('size') or 0
+        return total
+
+    def load_package(self, pkg):
+        """
+        Return the version/arch/file tree for this package, fetching it with
+        one search query if we have not already.
+        """
+        if pkg in self.packages:
+            return self.packages[pkg]
+        with self.lock:
+            package_lock = self.package_locks.setdefault(pkg,
+                                                         threading.Lock())
+        with package_lock:
+            if pkg in self.packages:
+                return self.packages[pkg]
+            return self.search_package(pkg)
+
+    def search_package(self, pkg):
+        """ Fetch the version/arch/file tree for this package. """
+        search_url = posixpath.join(self.base_url, 'search/')
+        params = {'project': pkg, 'distro': 'ubuntu', 'distro_version': 'all'}
+        log.info('searching %s for %s builds' % (search_url, pkg))
+        response = self.mirrors.get(self.session, 'search/', params=params)
+        if response.status_code in (400, 404):
+            log.warning('%s is not available, listing builds instead'
+                        % search_url)
+            self.use_search = False
+            return {}
+        response.raise_for_status()
+        tree = {}
+        for binary in response.json():
+            # A server that ignores our "project" filter returns every
+            # package's binaries.
+            if binary.get('project') != pkg:
+                continue
+            version = tree.setdefault(binary['ref'], {})
+            arch = version.setdefault(binary['arch'], {})
+            arch[binary['name']] = binary
+        self.packages[pkg] = tree
+        return tree
+
+    def fetch_version(self, nvr):
+        """
+        Fetch one build's file listings and arch metadata from Chacra.
+
+        :returns: dict of arch -> filename -> metadata dict
+        """
+        build_path = self.build_path(nvr)
+        log.info('searching %s for builds' % self.build_url(nvr))
+        build_response = self.mirrors.get(self.session, build_path)
+        if build_response.status_code == 404:
+            return {}
+        build_response.raise_for_status()
+        payload = build_response.json()
+        result = {}
+        for arch, binaries in payload.items():
+            metadata_path = posixpath.join(build_path, arch)
+            metadata_response = self.mirrors.get(self.session, metadata_path)
+            metadata_response.raise_for_status()
+            metadata = metadata_response.json()
+            result[arch] = dict((binary, metadata[binary])
+                                for binary in binaries)
+        return result
+
+
+def request_kind(method, url, stream=False):
+    """
+    Classify a Chacra request, so the limiter compares its latency with
+    similar requests.
+
+    Searches, downloads, and each depth of the binaries/ listing tree
+    (project, version, distro, ... down to one binary's metadata) cost the
+    server very different amounts of work.
+    """
+    path = urlparse(url).path.rstrip('/')
+    if stream:
+        return 'download'
+    if path.endswith('/search'):
+        return 'search'
+    return '%s %d' % (method, path.count('/'))
+
+
+def throttle_session(session, limiter):
+    """
+    Send every request from this requests.Session through an
+    util.AdaptiveLimiter.
+
+    Connection errors, timeouts and 5xx responses count as failures. For
+    streaming GETs, we release the slot once the headers arrive.
+    """
+    request = session.request
+
+    def throttled_request(method, url, *args, **kwargs):
+        kind = request_kind(method, url, kwargs.get('stream', False))
+        limiter.acquire()
+        start = time.time()
+        ok = False
+        try:
+            r = request(method, url, *args, **kwargs)
+            ok = r.status_code < 500
+            return r
+        finally:
+            limiter.release(ok, time.time() - start, kind)
+    session.request = throttled_request
+
+
+def download_build(nvr, base_url, session, catalog=None, limiter=None):
     """
     Download an NVR from chacra to a nvr-named directory.
 
     :param nvr: build NVR to download, eg ceph-ansible_3.2.0~rc3-2redhat1
-    :param base_url: chacra base URL
+    :param base_url: chacra base URL, or a list of mirror base URLs
     :param session: persistent requests.Session() to use for HTTPS requests
+    :param catalog: ChacraCatalog to look up this build's files. If None,
+                    we make a new one for this build.
+    :param limiter: util.RateLimiter to cap our download bandwidth
     :returns: destination directory for this build
     """
-    (pkg, version) = name_version(nvr)
+    if catalog is None:
+        catalog = ChacraCatalog(base_url, session)
+    binaries = catalog.binaries(nvr)
+    if not binaries:
+        raise RuntimeError('%s not found in chacra' % nvr)
     dest_dir = os.path.join('downloads', nvr)
     ensure_directory(dest_dir)
-    build_url = posixpath.join(base_url, 'binaries/', pkg, version,
-                               'ubuntu', 'all')
-    log.info('searching %s for builds' % build_url)
-    build_response = session.get(build_url)
-    build_response.raise_for_status()
-    payload = build_response.json()
-    for arch, binaries in payload.items():
-        metadata_url = posixpath.join(build_url, arch)
-        metadata_response = session.get(metadata_url)
-        metadata_response.raise_for_status()
-        metadata = metadata_response.json()
-        for binary in binaries:
+    for arch, files in binaries.items():
+        for binary, metadata in files.items():
             output_path = os.path.join(dest_dir, binary)
             if os.path.isfile(output_path):
-                checksum = metadata[binary]['checksum']
+                checksum = metadata['checksum']
                 if verify_checksum(output_path, checksum):
                     log.info('skipping %s' % binary)
                     continue
                 else:
                     log.warning('checksum mismatch on %s' % binary)
             log.info('downloading %s' % binary)
-            binary_url = posixpath.join(build_url, arch, binary) + '/'
-            r = session.get(binary_url, stream=True)
-            r.raise_for_status()
-            with open(output_path, 'wb') as f:
-                for chunk in r.iter_content(4096):
-                    f.write(chunk)
+            binary_path = catalog.build_path(nvr, arch, binary) + '/'
+            download_from_mirrors(binary_path, output_path, metadata,
+                                  session, catalog.mirrors, limiter)
     return dest_dir
 
 
+def download_from_mirrors(path, output_path, metadata, session, mirrors,
+                          limiter=None):
+    """
+    Download one file from the best mirror, failing over to the others.
+
+    Whichever mirror serves the file, we verify it against the same sha512
+    from the catalog's metadata.
+
+    :param path: file path on each mirror
+    :param metadata: this file's metadata dict from ChacraCatalog
+    :param mirrors: MirrorPool
+    :raises: the last mirror's error, if every mirror failed.
+    """
+    size = metadata.get('size') or 0
+    tried = []
+    error = None
+    while True:
+        mirror = mirrors.choose(size, exclude=tried)
+        if mirror is None:
+            raise error
+        tried.append(mirror)
+        start = time.time()
+        try:
+            download_spread(path, output_path, metadata, session, mirrors,
+                            mirror, limiter)
+        except (requests.RequestException, RuntimeError) as e:
+            mirrors.release(mirror, False)
+            log.warning('downloading %s from %s failed: %s'
+                        % (path, mirror.url, e))
+            error = e
+            continue
+        mirrors.release(mirror, True, time.time() - start, size)
+        return
+
+
+def download_spread(path, output_path, metadata, session, mirrors, mirror,
+                    limiter=None):
+    """
+    Download one file from a mirror we have claimed, spreading a large
+    file's segments over the other healthy mirrors.
+
+    We claim each of those helper mirrors too, and release them with how
+    their segments went. If the whole file fails its checksum, any of these
+    mirrors could have sent the bad bytes, so we download it again from our
+    mirror alone before we blame anyone. If that copy is good, a helper
+    was bad.
+
+    See download_from_mirrors() for the parameters.
+
+    :param mirror: Mirror from mirrors.choose(). The caller releases it.
+    :raises: if the download from mirror fails.
+    """
+    size = metadata.get('size') or 0
+    checksum = metadata['checksum']
+    url = mirror.join(path)
+    helpers = []
+    if size >= SEGMENT_THRESHOLD:
+        helpers = mirrors.claim_healthy(exclude=[mirror])
+    if not helpers:
+        download_file(url, output_path, checksum, session, limiter, size)
+        return
+    # The helper URLs whose segments failed.
+    failed = set()
+    results = dict((helper, True) for helper in helpers)
+    try:
+        try:
+            download_file(url, output_path, checksum, session, limiter, size,
+                          [helper.join(path) for helper in helpers], failed)
+        except ChecksumMismatchError as e:
+            log.warning('%s, retrying from %s alone' % (e, mirror.url))
+            download_file(url, output_path, checksum, session, limiter, size)
+            results = dict((helper, False) for helper in helpers)
+    finally:
+        for helper, ok in results.items():
+            ok = ok and helper.join(path) not in failed
+            mirrors.release(helper, ok)
+
+
+def download_file(url, output_path, checksum, session, limiter=None,
+                  size=None, mirror_urls=None, failed=None):
+    """
+    Download one file from chacra, and verify its sha512 as we write it.
+
+    :param url: chacra URL for this file
+    :param output_path: local destination path
+    :param checksum: expected sha512 from chacra's metadata
+    :param session: persistent requests.Session() to use for HTTPS requests
+    :param limiter: util.RateLimiter to cap our download bandwidth
+    :param size: file size from chacra's metadata. If this is at least
+                 SEGMENT_THRESHOLD, we download the file in segments.
+    :param mirror_urls: URLs for the same file on other mirrors, to spread
+                        the segments over.
+    :param failed: set of the mirror_urls whose segments failed. See
+                   download_segments().
+    :raises: ChecksumMismatchError if the downloaded file does not match
+             checksum.
+    """
+    if size and size >= SEGMENT_THRESHOLD:
+        if download_segments(url, output_path, size, session, limiter,
+                             mirror_urls=mirror_urls, failed=failed):
+            if not verify_checksum(output_path, checksum):
+                os.unlink(output_path)
+                raise ChecksumMismatchError('checksum mismatch on '
+                                            'downloaded %s' % url)
+            return
+    chsum = sha512()
+    r = session.get(url, stream=True)
+    r.raise_for_status()
+    with open(output_path, 'wb') as f:
+        for chunk in r.iter_content(64 * 1024):
+            f.write(chunk)
+            chsum.update(chunk)
+            metrics.inc('misoctl_downloaded_bytes_total', len(chunk))
+            if limiter:
+                limiter.consume(len(chunk))
+    if chsum.hexdigest() != checksum:
+        os.unlink(output_path)
+        raise ChecksumMismatchError('checksum mismatch on downloaded %s'
+                                    % url)
+
+
+def segment_bounds(size, count):
+    """
+    Split a file into byte ranges.
+
+    :returns: list of (start, end) tuples, with inclusive ends like HTTP's
+              Range header.
+    """
+    segment_size = -(-size // count)
+    return [(start, min(start + segment_size, size) - 1)
+            for start in range(0, size, segment_size)]
+
+
+def get_range(url, start, end, session):
+    """ Start a streaming GET for these bytes of url. """
+    r = session.get(url, headers={'Range': 'bytes=%d-%d' % (start, end)},
+                    stream=True)
+    r.raise_for_status()
+    return r
+
+
+def write_segment(r, output_path, start, end, limiter=None):
+    """
+    Write one range response into its place in output_path.
+
+    :raises: RuntimeError if the server sent the wrong bytes.
+    """
+    if r.status_code != 206:
+        raise RuntimeError('%s ignored our Range request' % r.url)
+    written = 0
+    with open(output_path, 'r+b') as f:
+        f.seek(start)
+        for chunk in r.iter_content(64 * 1024):
+            f.write(chunk)
+            written += len(chunk)
+            metrics.inc('misoctl_downloaded_bytes_total', len(chunk))
+            if limiter:
+                limiter.consume(len(chunk))
+    if written != end - start + 1:
+        raise RuntimeError('expected %d bytes from %s, got %d'
+                           % (end - start + 1, r.url, written))
+
+
+def preallocate(output_path, size):
+    """ Create output_path with room for size bytes. """
+    with open(output_path, 'wb') as f:
+        f.truncate(size)
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except OSError:
+                # Some filesystems (eg. NFS) can't, and that's fine.
+                pass
+
+
+def download_segments(url, output_path, size, session, limiter=None,
+                      segments=SEGMENTS, mirror_urls=None, failed=None):
+    """
+    Download one large file in parallel byte-range segments.
+
+    Each segment writes straight into its place in a preallocated file. The
+    caller must verify the checksum afterwards.
+
+    :param mirror_urls: URLs for the same file on other mirrors. We fetch
+                        some segments from these, and retry a segment from
+                        url if its mirror fails.
+    :param failed: set. We add each of the mirror_urls whose segment
+                   failed.
+    :returns: True if we downloaded the file, or False if the server does
+              not honour Range requests.
+    """
+    bounds = segment_bounds(size, segments)
+    (start, end) = bounds[0]
+    first = get_range(url, start, end, session)
+    if first.status_code != 206:
+        first.close()
+        log.info('%s does not support Range requests' % url)
+        return False
+    urls = [url] + list(mirror_urls or [])
+
+    def fetch(i):
+        (start, end) = bounds[i]
+        segment_url = urls[i % len(urls)]
+        try:
+            if i == 0:
+                r = first
+            else:
+                r = get_range(segment_url, start, end, session)
+            try:
+                write_segment(r, output_path, start, end, limiter)
+            finally:
+                r.close()
+        except (requests.RequestException, RuntimeError) as e:
+            if segment_url == url:
+                raise
+            if failed is not None:
+                failed.add(segment_url)
+            log.warning('segment from %s failed (%s), retrying from %s'
+                        % (segment_url, e, url))
+            r = get_range(url, start, end, session)
+            try:
+                write_segment(r, output_path, start, end, limiter)
+            finally:
+                r.close()
+
+    log.info('downloading %d segments of %s' % (len(bounds), url))
+    preallocate(output_path, size)
+    pool = ThreadPool(len(bounds))
+    try:
+        pool.map(fetch, range(len(bounds)))
+    except Exception:
+        os.unlink(output_path)
+        raise
+    finally:
+        pool.close()
+        pool.join()
+    return True
+
+
 def verify_checksum(path, checksum):
     """
     Verify this local file's sha512 against checksum.
@@ -91,8 +718,12 @@ def verify_checksum(path, checksum):
               does not match this file.
     """
     chsum = sha512()
+    start = time.time()
+    size = 0
     with open(path, 'rb') as f:
         for chunk in iter(lambda: f.read(4096), b''):
             chsum.update(chunk)
+            size += len(chunk)
         digest = chsum.hexdigest()
+    record_hash(size, time.time() - start)
     return digest == checksum
@@ -0,0 +1,234 @@
+from hashlib import md5
+from io import BytesIO
+import subprocess
+import tarfile
+import time
+import zlib
+from debian import deb822
+from misoctl.log import log as log
+from misoctl.util import record_hash
+
+"""
+Read the control metadata from .deb files without unpacking them.
+
+A .deb is an "ar" archive with three members: debian-binary, control.tar.*
+and data.tar.*. We only need the small control.tar member, so we read the ar
+headers as a stream and pass over everything else.
+"""
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+
+# The control fields we record in the CG metadata.
+CONTROL_FIELDS = ('Package', 'Architecture', 'Version', 'Depends')
+
+# Read this many bytes at a time when hashing a file.
+CHUNK_SIZE = 1024 * 1024
+
+
+class DebFormatError(Exception):
+    """ This file does not look like a .deb. """
+    pass
+
+
+def parse_ar_header(header):
+    """
+    Parse one 60-byte ar member header.
+
+    :returns: two-element tuple of member name and size in bytes.
+    """
+    if header[58:60] != b'`\n':
+        raise DebFormatError('bad ar member header %r' % header)
+    name = header[0:16].decode('ascii').strip().rstrip('/')
+    size = int(header[48:58].decode('ascii').strip())
+    return (name, size)
+
+
+class ControlReader(object):
+    """
+    Find the control.tar member of a .deb, fed one chunk at a time.
+
+    This lets us collect the control metadata while something else (like an
+    md5 hash) reads through the whole file. We only keep the bytes of the
+    control.tar member, and pass over the rest.
+    """
+
+    def __init__(self):
+        self.header = b''
+        self.header_size = len(AR_MAGIC)
+        self.magic = True
+        self.skip = 0
+        self.capture = 0
+        self.member_name = None
+        self.parts = []
+        self.done = False
+
+    def feed(self, chunk):
+        """ Process the next chunk of bytes from this .deb file. """
+        i = 0
+        length = len(chunk)
+        while i < length and not self.done:
+            if self.skip:
+                n = min(self.skip, length - i)
+                self.skip -= n
+                i += n
+            elif self.capture:
+                n = min(self.capture, length - i)
+                self.parts.append(chunk[i:i + n])
+                self.capture -= n
+                i += n
+                if not self.capture:
+                    # We have the whole control.tar member.
+                    self.done = True
+            else:
+                n = min(self.header_size - len(self.header), length - i)
+                self.header += chunk[i:i + n]
+                i += n
+                if len(self.header) == self.header_size:
+                    self.read_header(self.header)
+                    self.header = b''
+                    self.header_size = AR_HEADER_SIZE
+
+    def read_header(self, header):
+        if self.magic:
+            if header != AR_MAGIC:
+                raise DebFormatError('not an ar archive')
+            self.magic = False
+            return
+        (name, size) = parse_ar_header(header)
+        # ar members start on even offsets.
+        padding = size % 2
+        if name.startswith('control.tar'):
+            self.member_name = name
+            self.capture = size
+            if not size:
+                self.done = True
+        else:
+            self.skip = size + padding
+
+    def control(self):
+        """
+        Return the parsed control fields, or an empty dict if we did not
+        find (or cannot decompress) the control.tar member.
+        """
+        if not self.done:
+            return {}
+        try:
+            return parse_control_tar(self.member_name, b''.join(self.parts))
+        except (tarfile.TarError, DebFormatError, EOFError, IOError,
+                zlib.error) as e:
+            log.warning('cannot read control fields from %s: %s'
+                        % (self.member_name, e))
+            return {}
+
+
+def decompress_xz(member_name, data):
+    """
+    Decompress an .xz member.
+
+    Python 2's tarfile cannot read xz, so we do it ourselves, with lzma (or
+    the backports.lzma module), or else the xz command.
+    """
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            lzma = None
+    if lzma:
+        try:
+            return lzma.decompress(data)
+        except lzma.LZMAError as e:
+            raise DebFormatError('%s: %s' % (member_name, e))
+    try:
+        xz = subprocess.Popen(['xz', '--decompress', '--stdout'],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+    except OSError as e:
+        raise DebFormatError('cannot read %s without lzma or xz: %s'
+                             % (member_name, e))
+    (output, error) = xz.communicate(data)
+    if xz.returncode != 0:
+        raise DebFormatError('%s: %s' % (member_name,
+                                         error.decode('utf-8', 'replace')))
+    return output
+
+
+def parse_control_tar(member_name, data):
+    """
+    Read the control file out of a control.tar.* member.
+
+    :returns: dict of CONTROL_FIELDS that are present in the control file.
+    """
+    if member_name.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            log.warning('cannot read %s without python-zstandard'
+                        % member_name)
+            return {}
+        decompressor = zstandard.ZstdDecompressor()
+        try:
+            data = decompressor.decompressobj().decompress(data)
+        except zstandard.ZstdError as e:
+            raise DebFormatError('%s: %s' % (member_name, e))
+    if member_name.endswith('.xz'):
+        data = decompress_xz(member_name, data)
+    with tarfile.open(fileobj=BytesIO(data), mode='r:*') as tar:
+        for member in tar:
+            if member.name in ('./control', 'control'):
+                f = tar.extractfile(member)
+                control = deb822.Deb822(f.read().decode('utf-8'))
+                break
+        else:
+            raise DebFormatError('no control file in %s' % member_name)
+    result = {}
+    for field in CONTROL_FIELDS:
+        if field in control:
+            result[field.lower()] = control[field]
+    return result
+
+
+def read_control(filename):
+    """
+    Read the control fields from a .deb file.
+
+    This seeks past every ar member except control.tar, so it reads very
+    little of the file.
+    """
+    reader = ControlReader()
+    with open(filename, 'rb') as f:
+        reader.feed(f.read(len(AR_MAGIC)))
+        while not reader.done:
+            header = f.read(AR_HEADER_SIZE)
+            if len(header) < AR_HEADER_SIZE:
+                break
+            reader.feed(header)
+            if reader.skip:
+                f.seek(reader.skip, 1)
+                reader.skip = 0
+            elif reader.capture:
+                reader.feed(f.read(reader.capture))
+    return reader.control()
+
+
+def get_md5sum_and_control(filename):
+    """
+    Read a .deb file once, for its md5 digest and its control fields.
+
+    :returns: two-element tuple of the hex md5 digest and a dict of control
+              fields.
+    """
+    chsum = md5()
+    reader = ControlReader()
+    start = time.time()
+    size = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            chsum.update(chunk)
+            size += len(chunk)
+            if not reader.done:
+                reader.feed(chunk)
+    record_hash(size, time.time() - start)
+    return (chsum.hexdigest(), reader.control())
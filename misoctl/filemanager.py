@@ -1,11 +1,17 @@
+from hashlib import md5
 import os
-from glob import glob
 import datetime
 import dateutil.parser
 import dateutil.tz
 from debian import deb822
+from misoctl import debfile
 from misoctl import util
 from misoctl.log import log as log
+try:
+    from os import scandir
+except ImportError:
+    # Python 2
+    from scandir import scandir
 
 """
 Find and parse various debian build files for information.
@@ -20,6 +26,221 @@ class MultipleFilesFoundError(Exception):
     pass
 
 
+class DscMismatchError(RuntimeError):
+    """ A source file does not match the md5 in the .dsc. """
+    pass
+
+
+class BuildDirectory(object):
+    """
+    The build artifacts in one directory.
+
+    We list the directory once, the first time we need it, and sort the
+    files by extension. We parse the .dsc and .changes files when we first
+    need them, and we remember each file's size and digests, so an import
+    reads each directory entry and each byte at most once.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: directory of build artifacts, or None if we only
+                          want to remember the sizes and digests of files.
+        """
+        self.directory = directory
+        self._entries = None
+        self._dsc = None
+        self._changes = None
+        self.sizes = {}
+        self.md5sums = {}
+        self.controls = {}
+        # path -> md5 that the .dsc lists for this source file
+        self.dsc_md5sums = {}
+
+    @property
+    def entries(self):
+        """ dict of extension -> list of file paths in this directory """
+        if self._entries is None:
+            self._entries = {}
+            for entry in scandir(self.directory):
+                # glob() never matched hidden files, so skip them too.
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                extension = entry.name.rsplit('.', 1)[-1]
+                paths = self._entries.setdefault(extension, [])
+                paths.append(entry.path)
+                self.sizes[entry.path] = entry.stat().st_size
+        return self._entries
+
+    def find_files(self, extension):
+        """ Find the paths to all the files with this extension. """
+        return set(self.entries.get(extension, []))
+
+    def find_one_file(self, extension):
+        """
+        Find the one file with an extension in this directory.
+
+        Raise if we could not find exactly one.
+        """
+        results = self.entries.get(extension, [])
+        if len(results) < 1:
+            raise NoFilesFoundError('could not find a .%s file in %s' %
+                                    (extension, self.directory))
+        if len(results) > 1:
+            log.error(results)
+            raise MultipleFilesFoundError('multiple .%s files in %s' %
+                                          (extension, self.directory))
+        return results[0]
+
+    def changes_file(self):
+        """ Find the path to the .changes file. """
+        return self.find_one_file('changes')
+
+    def deb_files(self):
+        """ Find the paths to all the .debs. """
+        return self.find_files('deb')
+
+    def dsc_file(self):
+        """ Find the path to the .dsc file. """
+        return self.find_one_file('dsc')
+
+    def log_file(self, fatal=True):
+        """ Find the path to the .build file. """
+        try:
+            return self.find_one_file('build')
+        except NoFilesFoundError:
+            if fatal:
+                raise
+
+    def dsc(self):
+        """ Return the parsed .dsc file. """
+        if self._dsc is None:
+            self._dsc = parse_dsc(self.dsc_file())
+        return self._dsc
+
+    def changes(self):
+        """ Return the parsed .changes file. """
+        if self._changes is None:
+            self._changes = parse_changes(self.changes_file())
+        return self._changes
+
+    def source_files(self, dsc=None, verify=True):
+        """
+        Find the paths to all the source files that the .dsc lists.
+
+        :param dsc: parsed .dsc file, if not this directory's .dsc file.
+        :param verify: check each file's md5 against the .dsc. Callers that
+                       will learn the md5s later (for example while they
+                       upload the files) can skip this. We still check each
+                       file when its md5 is record()ed.
+        :raises: RuntimeError if a file is missing, or DscMismatchError if
+                 its md5 does not match
+        """
+        if dsc is None:
+            dsc = self.dsc()
+        result = set()
+        for f in dsc['Files']:
+            filename = f['name']
+            path = os.path.join(self.directory, filename)
+            # Sanity-check the file while we're here:
+            if not os.path.isfile(path):
+                raise RuntimeError('dsc file references non-existent %s'
+                                   % path)
+            self.dsc_md5sums[path] = f['md5sum']
+            if verify:
+                self.verify(path)
+            result.add(path)
+        return result
+
+    def verify(self, path):
+        """
+        Check this file's md5 against the .dsc, if the .dsc lists it.
+
+        :raises: DscMismatchError if the md5 does not match
+        """
+        expected = self.dsc_md5sums.get(path)
+        if expected is not None and self.md5sum(path) != expected:
+            raise DscMismatchError('dsc file md5sum mismatch on %s' % path)
+
+    def size(self, path):
+        """ Return the size of this file in bytes. """
+        if path not in self.sizes:
+            self.sizes[path] = os.path.getsize(path)
+        return self.sizes[path]
+
+    def md5sum(self, path):
+        """
+        Return the hex md5 digest of this file.
+
+        For .debs, we read the control fields in the same pass.
+        """
+        if path not in self.md5sums:
+            if path.endswith('.deb'):
+                (md5sum, control) = debfile.get_md5sum_and_control(path)
+                self.controls[path] = control
+            else:
+                md5sum = util.get_md5sum(path)
+            self.md5sums[path] = md5sum
+        return self.md5sums[path]
+
+    def control(self, path):
+        """ Return the control fields of this .deb file. """
+        if path not in self.controls:
+            self.md5sum(path)
+        return self.controls[path]
+
+    def record(self, path, digest):
+        """
+        Remember the md5 (and control fields) that something else computed
+        while it read this file, so we don't read it again.
+
+        :param digest: StreamDigest that read the whole file.
+        """
+        if digest.error:
+            # Let md5sum() read it again, and raise.
+            return
+        self.md5sums[path] = digest.hexdigest()
+        if path.endswith('.deb'):
+            self.controls[path] = digest.control()
+        self.verify(path)
+
+
+class StreamDigest(object):
+    """
+    Hash a file as some other code reads it, one chunk at a time.
+
+    For .debs, we collect the control fields from the same chunks. If a
+    .deb is malformed, we keep hashing, and raise the error when someone
+    asks for its control fields.
+    """
+
+    def __init__(self, path):
+        self.md5 = md5()
+        self.size = 0
+        self.reader = None
+        self.error = None
+        if path.endswith('.deb'):
+            self.reader = debfile.ControlReader()
+
+    def update(self, chunk):
+        self.md5.update(chunk)
+        self.size += len(chunk)
+        if self.reader and not self.reader.done and not self.error:
+            try:
+                self.reader.feed(chunk)
+            except debfile.DebFormatError as e:
+                self.error = e
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+    def control(self):
+        if self.error:
+            raise self.error
+        if self.reader is None:
+            return {}
+        return self.reader.control()
+
+
 def find_changes_file(directory):
     """ Find the path to a .changes file in this directory. """
     return find_one_file('changes', directory)
@@ -27,9 +248,7 @@ def find_changes_file(directory):
 
 def find_deb_files(directory):
     """ Find the paths to all the .debs in this directory """
-    search_path = os.path.join(directory, '*.deb')
-    filenames = glob(search_path)
-    return set(filenames)
+    return BuildDirectory(directory).deb_files()
 
 
 def find_dsc_file(directory):
@@ -39,11 +258,7 @@ def find_dsc_file(directory):
 
 def find_log_file(directory, fatal=True):
     """ Find the path to a .build file in this directory. """
-    try:
-        return find_one_file('build', directory)
-    except NoFilesFoundError:
-        if fatal:
-            raise
+    return BuildDirectory(directory).log_file(fatal)
 
 
 def find_one_file(extension, directory):
@@ -52,45 +267,131 @@ def find_one_file(extension, directory):
 
     Raise if we could not find exactly one.
     """
-    search_path = os.path.join(directory, '*.%s' % extension)
-    results = glob(search_path)
-    if len(results) < 1:
-        raise NoFilesFoundError('could not find a .%s file in %s' %
-                                (extension, directory))
-    if len(results) > 1:
-        log.error(results)
-        raise MultipleFilesFoundError('multiple .%s files in %s' %
-                                      (extension, directory))
-    return results[0]
+    return BuildDirectory(directory).find_one_file(extension)
 
 
 def find_source_files(dsc, directory):
     """ Find the paths to all the source files in this directory. """
-    result = set()
-    for f in dsc['Files']:
-        filename = f['name']
-        path = os.path.join(directory, filename)
-        # Sanity-check the file while we're here:
-        if not os.path.isfile(path):
-            raise RuntimeError('dsc file references non-existent %s' % path)
-        md5sum = util.get_md5sum(path)
-        if md5sum != f['md5sum']:
-            raise RuntimeError('dsc file md5sum mismatch on %s' % path)
-        result.add(path)
-    return result
-
-
-def get_build_times(log_file):
-    """ Return the start and end times from a pbuilder log file. """
+    return BuildDirectory(directory).source_files(dsc)
+
+
+PBUILDER_TIME_STAMP = b'I: pbuilder-time-stamp: '
+
+# How far into a pbuilder log we look for the start time stamp, and how far
+# back from the end we look for the end time stamp, before giving up and
+# reading the whole file.
+BUILD_TIMES_HEAD_WINDOW = 64 * 1024
+BUILD_TIMES_TAIL_WINDOW = 1024 * 1024
+
+
+def get_build_times(log_file, strict=False):
+    """
+    Return the start and end times from a pbuilder log file.
+
+    pbuilder writes one time stamp near the start of the log and one near the
+    end. By default we only read a window at the head of the file and scan
+    backwards from the tail, so huge logs cost a few small reads. If either
+    window misses, we fall back to reading the whole file.
+
+    :param log_file: path to a pbuilder .build (or .log) file.
+    :param strict: read the whole file and raise if it contains more than
+                   two time stamp lines.
+    :returns: two-element tuple of start and end epoch seconds.
+    """
+    if strict:
+        return scan_build_times(log_file, strict=True)
+    with open(log_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size <= BUILD_TIMES_HEAD_WINDOW + BUILD_TIMES_TAIL_WINDOW:
+            return scan_build_times(log_file)
+        f.seek(0)
+        head = f.read(BUILD_TIMES_HEAD_WINDOW)
+        stamps = find_time_stamps(head, 0, at_line_start=True)
+        if stamps:
+            (start_offset, start_time) = stamps[0]
+            end = find_last_time_stamp(f, size, start_offset)
+            if end is not None:
+                return (start_time, end)
+    log.debug('time stamps not found in %s windows, reading it all'
+              % log_file)
+    return scan_build_times(log_file)
+
+
+def find_time_stamps(data, offset, at_line_start, at_eof=False):
+    """
+    Find the complete pbuilder time stamp lines in a chunk of a log file.
+
+    :param data: bytes read from the log file.
+    :param offset: position of data within the log file.
+    :param at_line_start: True if data begins at the start of a line.
+    :param at_eof: True if data ends at the end of the file.
+    :returns: list of (file offset, epoch seconds) tuples, in file order.
+    """
+    stamps = []
+    needle = b'\n' + PBUILDER_TIME_STAMP
+    if at_line_start and data.startswith(PBUILDER_TIME_STAMP):
+        pos = 0
+    else:
+        pos = data.find(needle)
+        if pos >= 0:
+            pos += 1
+    while pos >= 0:
+        value_start = pos + len(PBUILDER_TIME_STAMP)
+        value_end = data.find(b'\n', value_start)
+        if value_end < 0:
+            if not at_eof:
+                # The window cut this line in half.
+                break
+            value_end = len(data)
+        timestamp = int(data[value_start:value_end].strip())
+        stamps.append((offset + pos, timestamp))
+        pos = data.find(needle, value_end)
+        if pos >= 0:
+            pos += 1
+    return stamps
+
+
+def find_last_time_stamp(f, size, after):
+    """
+    Scan backwards from the end of this log file for the last time stamp.
+
+    :param f: log file object, opened in binary mode.
+    :param size: size of the log file, in bytes.
+    :param after: only consider time stamps beyond this file offset.
+    :returns: epoch seconds, or None if the tail window has no time stamp.
+    """
+    window = 64 * 1024
+    while True:
+        start = max(size - window, after + 1)
+        f.seek(start)
+        data = f.read(size - start)
+        # Look from the first full line in this window.
+        stamps = find_time_stamps(data, start, at_line_start=False,
+                                  at_eof=True)
+        if stamps:
+            return stamps[-1][1]
+        if start == after + 1 or window >= BUILD_TIMES_TAIL_WINDOW:
+            return None
+        window *= 4
+
+
+def scan_build_times(log_file, strict=False):
+    """
+    Return the start and end times from reading an entire pbuilder log.
+
+    :param strict: raise if we find more than two time stamp lines.
+                   Otherwise the last time stamp is the end time.
+    """
     start_time = None
     end_time = None
-    with open(log_file) as f:
+    with open(log_file, 'rb') as f:
         for line in f:
-            if line.startswith('I: pbuilder-time-stamp: '):
+            if line.startswith(PBUILDER_TIME_STAMP):
                 timestamp = int(line[24:].strip())
                 if start_time is None:
                     start_time = timestamp
-                elif end_time is None:
+                elif end_time is None or not strict:
                     end_time = timestamp
                 else:
                     log.error('reading %s' % log_file)
@@ -110,6 +411,16 @@ def get_changes_time(changes_file):
     :returns: number of seconds since the unix epoch
     """
     changes = parse_changes(changes_file)
+    return get_date_time(changes)
+
+
+def get_date_time(changes):
+    """
+    Get the epoch seconds value from this parsed .changes file.
+
+    :param changes: a Changes class for this build.
+    :returns: number of seconds since the unix epoch
+    """
     changes_date = changes['Date']
     my_datetime = dateutil.parser.parse(changes_date)
     utc = dateutil.tz.tzutc()
@@ -0,0 +1,126 @@
+import re
+import misoctl.session
+from misoctl import chacra
+from misoctl.log import log as log
+
+"""
+Use Koji's tag inheritance to tag each build into as few tags as possible.
+
+A build in a parent tag is visible in every tag that inherits from it, so we
+don't need to tag it into those child tags as well.
+"""
+
+
+class TagInheritance(object):
+    """
+    The full inheritance of each tag we have asked about, for one run.
+
+    :param session: Koji session
+    """
+
+    def __init__(self, session):
+        self.session = session
+        # tag name -> list of getFullInheritance entries
+        self.parents = {}
+        # (tag name, package name) -> True if the package is blocked there
+        self.blocked = {}
+
+    def reset(self):
+        """ Forget what we know, so we fetch it again from Koji. """
+        self.parents = {}
+        self.blocked = {}
+
+    def load(self, tags, pairs=()):
+        """
+        Fetch the inheritance for any of these tags that we lack.
+
+        :param tags: tag names
+        :param pairs: (tag name, package name) tuples. We fetch whether each
+                      package is blocked in that tag, if we lack it.
+        """
+        missing = sorted(set(tags) - set(self.parents))
+        if missing:
+            calls = [((tag,), {}) for tag in missing]
+            results = misoctl.session.multicall(self.session,
+                                                'getFullInheritance', calls)
+            self.parents.update(zip(missing, results))
+        pairs = sorted(set(pairs) - set(self.blocked))
+        if pairs:
+            calls = [(pair, {}) for pair in pairs]
+            results = misoctl.session.multicall(self.session,
+                                                'getPackageConfig', calls)
+            for pair, config in zip(pairs, results):
+                self.blocked[pair] = bool(config and config.get('blocked'))
+
+    def inherits(self, tag, parent, package):
+        """
+        Return True if this tag shows this package's builds from parent.
+
+        getFullInheritance already accounts for maxdepth and intransitive
+        links. We honour package filters too. A tag that blocks this package
+        does not show it from any parent.
+        """
+        if self.blocked[(tag, package)]:
+            return False
+        for entry in self.parents[tag]:
+            if entry['name'] != parent:
+                continue
+            filters = list(entry.get('filter') or [])
+            if entry.get('pkg_filter'):
+                filters.append(entry['pkg_filter'])
+            if all(re.match(f, package) for f in filters):
+                return True
+        return False
+
+    def prune(self, tags, package):
+        """
+        Drop the tags that inherit this package's builds from another one
+        of these tags.
+
+        :param tags: set of tag names
+        :param package: Koji package name, eg. "ceph-deb"
+        :returns: the smallest set of tags that still makes a build visible
+                  in all of these tags.
+        """
+        self.load(tags, [(tag, package) for tag in tags])
+        return set(tag for tag in tags
+                   if not any(self.covers(parent, tag, package)
+                              for parent in tags))
+
+    def covers(self, parent, tag, package):
+        """
+        Return True if tagging into parent makes tagging into tag needless.
+
+        Koji allows inheritance loops. Tags that inherit from each other
+        cover each other, so we keep the first of them by name.
+        """
+        if parent == tag or not self.inherits(tag, parent, package):
+            return False
+        return parent < tag or not self.inherits(parent, tag, package)
+
+
+def prune_nvrs(nvrs, inheritance):
+    """
+    Prune the tags for each build in place, using Koji's inheritance.
+
+    :param nvrs: dict of chacra nvr -> set of tag names, from find_all_nvrs
+    :param inheritance: TagInheritance
+    """
+    all_tags = set()
+    pairs = set()
+    packages = {}
+    for nvr, tags in nvrs.items():
+        all_tags.update(tags)
+        (name, _) = chacra.name_version(nvr)
+        packages[nvr] = '%s-deb' % name
+        pairs.update((tag, packages[nvr]) for tag in tags)
+    inheritance.load(all_tags, pairs)
+    pruned = 0
+    for nvr, tags in nvrs.items():
+        package = packages[nvr]
+        minimal = inheritance.prune(tags, package)
+        pruned += len(tags) - len(minimal)
+        nvrs[nvr] = minimal
+    if pruned:
+        log.info('skipping %d tag operations that inheritance covers'
+                 % pruned)
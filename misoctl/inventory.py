@@ -0,0 +1,184 @@
+import json
+import os
+import time
+import koji
+from misoctl.util import ensure_directory
+from misoctl.log import log as log
+
+"""
+Keep a local inventory of Koji's Debian builds and their tags.
+
+Asking Koji about each build with getBuild and listTagged costs one round
+trip per build. Instead, we load every Debian build once with listBuilds,
+and then refresh incrementally: new builds from listBuilds(createdAfter=...),
+and tag changes from the tag_listing history since the last event we saw.
+"""
+
+# Koji reports build and tag changes at least this late, so look back a
+# little when we ask for newly-created builds.
+CREATED_MARGIN = 300
+
+# Builds can be deleted, and the incremental refresh does not see that.
+# Reload everything at least this often.
+FULL_REFRESH_AGE = 7 * 24 * 3600
+
+
+class Inventory(object):
+    """
+    Koji's Debian builds and tag memberships, cached in a JSON file.
+
+    :param session: Koji session
+    :param path: JSON cache file. Defaults to one file for each Koji profile,
+                 since each hub has its own builds and event ids.
+    :param max_age: trust the cache for this many seconds before we ask Koji
+                    for changes again.
+    """
+
+    VERSION = 1
+
+    def __init__(self, session, path=None, max_age=600, profile='koji'):
+        if path is None:
+            path = os.path.expanduser('~/.cache/misoctl/koji-inventory-%s.json'
+                                      % profile)
+        self.session = session
+        self.path = path
+        self.max_age = max_age
+        self.event_id = None
+        self.event_ts = None
+        self.refreshed = 0
+        self.loaded = 0
+        self.builds = {}
+        self.tags = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') != self.VERSION:
+            return
+        self.event_id = data['event_id']
+        self.event_ts = data['event_ts']
+        self.refreshed = data['refreshed']
+        self.loaded = data['loaded']
+        self.builds = data['builds']
+        self.tags = dict((tag, set(nvrs))
+                         for tag, nvrs in data['tags'].items())
+
+    def save(self):
+        if not self.changed:
+            return
+        data = {
+            'version': self.VERSION,
+            'event_id': self.event_id,
+            'event_ts': self.event_ts,
+            'refreshed': self.refreshed,
+            'loaded': self.loaded,
+            'builds': self.builds,
+            'tags': dict((tag, sorted(nvrs))
+                         for tag, nvrs in self.tags.items()),
+        }
+        ensure_directory(os.path.dirname(self.path))
+        # Concurrent runs may share this file, so replace it atomically.
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+        self.changed = False
+
+    def refresh(self):
+        """ Bring this inventory up to date, if it is too old. """
+        now = time.time()
+        if now - self.refreshed < self.max_age:
+            return
+        if self.event_id is None or now - self.loaded > FULL_REFRESH_AGE:
+            self.full_refresh()
+        else:
+            self.incremental_refresh()
+
+    def full_refresh(self):
+        """ Load every Debian build from Koji. """
+        event = self.session.getLastEvent()
+        builds = self.session.listBuilds(type='debian',
+                                         state=koji.BUILD_STATES['COMPLETE'])
+        self.builds = {}
+        for build in builds:
+            self.add_build(build)
+        # Load the tags again when we need them, at this event.
+        self.tags = {}
+        self.event_id = event['id']
+        self.event_ts = event['ts']
+        self.refreshed = self.loaded = time.time()
+        self.changed = True
+        log.info('loaded %d debian builds from koji' % len(self.builds))
+
+    def incremental_refresh(self):
+        """ Find new builds and tag changes since our last event. """
+        event = self.session.getLastEvent()
+        builds = self.session.listBuilds(
+            type='debian', state=koji.BUILD_STATES['COMPLETE'],
+            createdAfter=self.event_ts - CREATED_MARGIN)
+        for build in builds:
+            self.add_build(build)
+        history = self.session.queryHistory(tables=['tag_listing'],
+                                            afterEvent=self.event_id)
+        rows = [row for row in history['tag_listing']
+                if row['tag.name'] in self.tags]
+        # A build has at most one active listing in a tag, so apply all the
+        # untags before all the tags.
+        for row in rows:
+            if not row['active']:
+                self.tags[row['tag.name']].discard(get_nvr(row))
+        for row in rows:
+            if row['active']:
+                self.tags[row['tag.name']].add(get_nvr(row))
+        self.event_id = event['id']
+        self.event_ts = event['ts']
+        self.refreshed = time.time()
+        self.changed = True
+        log.info('found %d new debian builds and %d tag changes in koji'
+                 % (len(builds), len(rows)))
+
+    def get_build(self, koji_nvr):
+        """
+        Look up this build, like getBuild.
+
+        :returns: buildinfo dict, or None if it is not in Koji
+        """
+        self.refresh()
+        return self.builds.get(koji_nvr)
+
+    def tagged_nvrs(self, tag):
+        """ Return the set of Debian build nvrs in this tag. """
+        self.refresh()
+        if tag not in self.tags:
+            builds = self.session.listTagged(tag, type='debian',
+                                             event=self.event_id)
+            self.tags[tag] = set(build['nvr'] for build in builds)
+            self.changed = True
+        return self.tags[tag]
+
+    def add_build(self, buildinfo):
+        """ Record a build that we found or imported. """
+        nvr = get_nvr(buildinfo)
+        self.builds[nvr] = {
+            'id': buildinfo.get('build_id', buildinfo.get('id')),
+            'name': buildinfo['name'],
+            'version': buildinfo['version'],
+            'release': buildinfo['release'],
+            'nvr': nvr,
+        }
+        self.changed = True
+
+    def add_tagged(self, tag, koji_nvr):
+        """ Record that we tagged this build. """
+        if tag in self.tags:
+            self.tags[tag].add(koji_nvr)
+            self.changed = True
+
+
+def get_nvr(info):
+    return '%(name)s-%(version)s-%(release)s' % info
@@ -0,0 +1,184 @@
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+from misoctl.util import ensure_directory
+from misoctl.log import log as log
+
+"""
+Claim builds with lease files, so concurrent runs never duplicate work.
+
+Each lease is a small JSON file in a directory that all the runners share
+(for example on NFS). A lease names the host and process that holds it, and
+expires after a fixed time so that a crashed runner's claims do not block
+everyone else forever. While we hold leases, a heartbeat thread renews them,
+so a long import does not outlive its lease.
+"""
+
+
+class LeaseHeldError(Exception):
+    """ Another live runner holds this lease. """
+    pass
+
+
+def pid_alive(pid):
+    """ Return True if this process id exists on this host. """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class LeaseDirectory(object):
+    """
+    A directory of lease files.
+
+    :param directory: shared directory for the lease files.
+    :param duration: number of seconds until a lease expires, unless we
+                     renew it.
+    """
+
+    # Renew our leases this many times per duration.
+    HEARTBEATS = 4
+
+    def __init__(self, directory, duration):
+        ensure_directory(directory)
+        self.directory = directory
+        self.duration = duration
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        # Names of the leases we hold.
+        self.held = set()
+        self.held_lock = threading.Lock()
+        # lockf() locks belong to the whole process, so they do not keep our
+        # own threads apart. This does.
+        self.thread_lock = threading.Lock()
+        self.heartbeat = None
+        self.stopped = threading.Event()
+
+    def path(self, name):
+        return os.path.join(self.directory, '%s.lease' % name)
+
+    def read(self, name):
+        """ Return the holder of this lease (a dict), or None. """
+        try:
+            with open(self.path(name)) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return None
+        except ValueError:
+            # A runner crashed while writing this lease.
+            return {}
+
+    def is_stale(self, holder):
+        """ Return True if nobody holds this lease any more. """
+        if not holder or holder.get('expires', 0) < time.time():
+            return True
+        if holder.get('host') == self.host:
+            return not pid_alive(holder.get('pid'))
+        return False
+
+    @contextmanager
+    def lock(self):
+        """
+        Serialize lease changes across our threads, and across runners with
+        a lock file.
+        """
+        with self.thread_lock:
+            with open(os.path.join(self.directory, '.lock'), 'a') as f:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+                yield
+
+    def holder(self):
+        """ Return a new lease for this process. """
+        return {
+            'host': self.host,
+            'pid': self.pid,
+            'expires': time.time() + self.duration,
+        }
+
+    def write(self, name, holder):
+        """ Replace this lease file atomically. """
+        path = self.path(name)
+        tmp_path = '%s.%s.%d' % (path, self.host, self.pid)
+        with open(tmp_path, 'w') as f:
+            json.dump(holder, f)
+        os.rename(tmp_path, path)
+
+    def is_ours(self, holder):
+        return holder.get('host') == self.host and \
+            holder.get('pid') == self.pid
+
+    def acquire(self, name):
+        """
+        Claim this lease, and renew it until we release it.
+
+        :raises: LeaseHeldError if another live runner holds this lease.
+        """
+        with self.lock():
+            current = self.read(name)
+            if current is not None:
+                if not self.is_stale(current):
+                    raise LeaseHeldError('%s is held by %s pid %s' %
+                                         (name, current.get('host'),
+                                          current.get('pid')))
+                log.warning('breaking stale lease on %s' % name)
+            self.write(name, self.holder())
+            with self.held_lock:
+                self.held.add(name)
+        with self.held_lock:
+            if self.heartbeat is None:
+                self.heartbeat = threading.Thread(target=self.run)
+                self.heartbeat.daemon = True
+                self.heartbeat.start()
+
+    def renew(self, name):
+        """ Push back the expiry of this lease, if we still hold it. """
+        with self.lock():
+            # release() changes self.held under this lock too, so the lease
+            # stays ours until we have written it.
+            with self.held_lock:
+                if name not in self.held:
+                    # We released it since the heartbeat woke up.
+                    return
+            current = self.read(name)
+            if not current or not self.is_ours(current):
+                log.warning('lease on %s is no longer ours' % name)
+                return
+            self.write(name, self.holder())
+
+    def run(self):
+        """ Renew the leases we hold, until close(). """
+        while not self.stopped.wait(self.duration / self.HEARTBEATS):
+            with self.held_lock:
+                names = sorted(self.held)
+            for name in names:
+                try:
+                    self.renew(name)
+                except (IOError, OSError) as e:
+                    log.warning('could not renew lease on %s: %s'
+                                % (name, e))
+
+    def close(self):
+        """ Stop renewing our leases. """
+        self.stopped.set()
+        if self.heartbeat:
+            self.heartbeat.join()
+
+    def release(self, name):
+        """ Give up this lease, if we hold it. """
+        with self.lock():
+            with self.held_lock:
+                self.held.discard(name)
+            current = self.read(name)
+            if not current:
+                return
+            if not self.is_ours(current):
+                log.warning('lease on %s is no longer ours' % name)
+                return
+            os.unlink(self.path(name))
@@ -1,13 +1,24 @@
 import argparse
+from misoctl.metrics import metrics
+import misoctl.bundle
 import misoctl.upload
 import misoctl.sync_chacra
 import misoctl.missing_chacra
+import misoctl.prefetch_chacra
+import misoctl.sync_status
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--profile', default='koji',
                         help='koji client profile (defaults to "koji")')
+    parser.add_argument('--metrics-file',
+                        help='write Prometheus textfile collector metrics '
+                             'to this file, eg. '
+                             '/var/lib/node_exporter/misoctl.prom')
+    parser.add_argument('--metrics-interval', type=int, default=60,
+                        help='also write metrics every this many seconds '
+                             'during the run (defaults to 60)')
 
     # top-level subcommands:
     subparsers = parser.add_subparsers(dest='subcommand')
@@ -15,9 +26,18 @@ def main():
 
     # add arguments for each subcommand:
     misoctl.upload.add_parser(subparsers)
+    misoctl.bundle.add_parser(subparsers)
     misoctl.sync_chacra.add_parser(subparsers)
     misoctl.missing_chacra.add_parser(subparsers)
+    misoctl.prefetch_chacra.add_parser(subparsers)
+    misoctl.sync_status.add_parser(subparsers)
 
     args = parser.parse_args()
 
-    args.func(args)
+    if args.metrics_file:
+        metrics.configure(args.metrics_file, args.metrics_interval,
+                          subcommand=args.subcommand, profile=args.profile)
+    try:
+        args.func(args)
+    finally:
+        metrics.write()
@@ -0,0 +1,230 @@
+import os
+import threading
+import time
+from misoctl.log import log as log
+
+"""
+Collect run metrics, and write them for Prometheus' textfile collector.
+
+Like misoctl.log, this module has one shared "metrics" object. Collecting
+samples is always cheap. We only write them out if someone calls
+metrics.configure() with a file path.
+"""
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+                   600, 1800)
+
+# name: (type, help)
+METRICS = {
+    'misoctl_nvrs_processed_total':
+        ('counter', 'Builds that this run finished syncing.'),
+    'misoctl_nvrs_skipped_total':
+        ('counter', 'Builds that this run skipped.'),
+    'misoctl_builds_imported_total':
+        ('counter', 'Builds that this run imported into Koji.'),
+    'misoctl_downloaded_bytes_total':
+        ('counter', 'Bytes downloaded from Chacra.'),
+    'misoctl_uploaded_bytes_total':
+        ('counter', 'Bytes uploaded to Koji.'),
+    'misoctl_hashed_bytes_total':
+        ('counter', 'Bytes read to compute checksums.'),
+    'misoctl_hash_seconds_total':
+        ('counter', 'Seconds spent computing checksums.'),
+    'misoctl_chacra_request_seconds':
+        ('histogram', 'Latency of Chacra HTTP requests.'),
+    'misoctl_koji_call_seconds':
+        ('histogram', 'Latency of Koji RPCs.'),
+    'misoctl_tag_wait_seconds':
+        ('histogram', 'Time spent waiting for Koji tag tasks.'),
+    'misoctl_concurrency_limit':
+        ('gauge', 'Requests we allow in flight to each server.'),
+    'misoctl_run_start_timestamp_seconds':
+        ('gauge', 'When this run started.'),
+    'misoctl_last_update_timestamp_seconds':
+        ('gauge', 'When this file was last written.'),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in sorted(labels.items()):
+        value = str(value).replace('\\', r'\\').replace('"', r'\"')
+        value = value.replace('\n', r'\n')
+        pairs.append('%s="%s"' % (key, value))
+    return '{%s}' % ','.join(pairs)
+
+
+class Metrics(object):
+    """ Counters, gauges and histograms for one misoctl run. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.labels = {}
+        self.path = None
+        self.thread = None
+
+    def configure(self, path, interval=60, **labels):
+        """
+        Start writing metrics to this file.
+
+        :param path: textfile collector file, eg.
+                     /var/lib/node_exporter/misoctl.prom
+        :param interval: also write the file every this many seconds during
+                         the run.
+        :param labels: labels for every sample, eg. subcommand="sync-chacra"
+        """
+        self.path = path
+        self.labels = labels
+        self.set('misoctl_run_start_timestamp_seconds', time.time())
+        if interval:
+            self.thread = threading.Thread(target=self.write_periodically,
+                                           args=(interval,))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def key(self, name, labels):
+        if name not in METRICS:
+            raise ValueError('unknown metric %s' % name)
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        """ Increase a counter. """
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ Set a gauge. """
+        key = self.key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def total(self, name):
+        """ Return the sum of a counter over all its labels. """
+        with self.lock:
+            return sum(value for (key, _), value in self.values.items()
+                       if key == name)
+
+    def observe(self, name, value, **labels):
+        """ Record one sample in a histogram. """
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {
+                    'buckets': [0] * len(DEFAULT_BUCKETS),
+                    'sum': 0,
+                    'count': 0,
+                }
+            histogram = self.histograms[key]
+            for i, bound in enumerate(DEFAULT_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self):
+        """ Return all our metrics in the Prometheus text format. """
+        lines = []
+        with self.lock:
+            samples = {}
+            for (name, labels), value in self.values.items():
+                samples.setdefault(name, []).append((labels, value))
+            histograms = {}
+            for (name, labels), histogram in self.histograms.items():
+                histograms.setdefault(name, []).append((labels, histogram))
+            for name in sorted(set(samples) | set(histograms)):
+                (metric_type, help_text) = METRICS[name]
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for labels, value in sorted(samples.get(name, [])):
+                    labels = dict(self.labels, **dict(labels))
+                    lines.append('%s%s %s' % (name, format_labels(labels),
+                                              repr(float(value))))
+                for labels, histogram in sorted(histograms.get(name, []),
+                                                key=lambda item: item[0]):
+                    labels = dict(self.labels, **dict(labels))
+                    for bound, count in zip(DEFAULT_BUCKETS,
+                                            histogram['buckets']):
+                        bucket_labels = dict(labels, le=repr(float(bound)))
+                        lines.append('%s_bucket%s %d' % (
+                            name, format_labels(bucket_labels), count))
+                    bucket_labels = dict(labels, le='+Inf')
+                    lines.append('%s_bucket%s %d' % (
+                        name, format_labels(bucket_labels),
+                        histogram['count']))
+                    lines.append('%s_sum%s %s' % (
+                        name, format_labels(labels),
+                        repr(float(histogram['sum']))))
+                    lines.append('%s_count%s %d' % (
+                        name, format_labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Write our metrics to the textfile, if we have one.
+
+        The textfile collector may read at any time, so we write a temporary
+        file and rename it into place.
+        """
+        if not self.path:
+            return
+        self.set('misoctl_last_update_timestamp_seconds', time.time())
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            log.warning('could not write metrics to %s: %s' % (self.path, e))
+
+    def write_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            self.write()
+
+
+metrics = Metrics()
+
+
+def chacra_endpoint(url):
+    """ Classify a Chacra URL for the "endpoint" label. """
+    path = url.split('?', 1)[0].rstrip('/')
+    if path.endswith('/search'):
+        return 'search'
+    parts = path.split('/binaries/', 1)
+    if len(parts) != 2:
+        return 'other'
+    # pkg/version/distro/distro_version[/arch[/filename]]
+    depth = len(parts[1].split('/'))
+    return {4: 'listing', 5: 'metadata', 6: 'binary'}.get(depth, 'other')
+
+
+def instrument_requests(rsession):
+    """ Record the latency of every request from this requests.Session. """
+    def record(response, *args, **kwargs):
+        metrics.observe('misoctl_chacra_request_seconds',
+                        response.elapsed.total_seconds(),
+                        endpoint=chacra_endpoint(response.url),
+                        code=response.status_code)
+    rsession.hooks['response'].append(record)
+
+
+def instrument_koji(session):
+    """ Record the latency of every RPC from this Koji session. """
+    call_method = session._callMethod
+
+    def timed_call_method(name, args, kwargs=None, *rest, **kw):
+        if session.multicall:
+            # Queued for a later multiCall.
+            return call_method(name, args, kwargs, *rest, **kw)
+        start = time.time()
+        try:
+            return call_method(name, args, kwargs, *rest, **kw)
+        finally:
+            metrics.observe('misoctl_koji_call_seconds', time.time() - start,
+                            method=name)
+    session._callMethod = timed_call_method
@@ -1,11 +1,12 @@
+from io import StringIO
 import os
-import posixpath
 import requests
-import StringIO
 from debian import deb822
 from misoctl.sync_chacra import find_all_nvrs, sort_nvrs
-from misoctl.chacra import name_version
+from misoctl.chacra import ChacraCatalog
 from misoctl.log import log as log
+from misoctl.metrics import metrics
+from misoctl.metrics import instrument_requests
 
 
 DESCRIPTION = """
@@ -13,6 +14,9 @@ Find all the Chacra builds that are missing files.
 
 This walks a tree of rhcephcompose builds-*.txt files and ensures that we have
 a dsc file, all the files mentioned in the dsc file, and a changes file.
+
+With --deep, we also compare the sizes and checksums in the dsc and changes
+files against Chacra's metadata for each file, without downloading them.
 """
 
 
@@ -31,6 +35,11 @@ class MultipleFilesFoundException(SourceError):
     pass
 
 
+class ChecksumMismatchException(SourceError):
+    """ Chacra's copy of a file does not match the dsc or changes file. """
+    pass
+
+
 def add_parser(subparsers):
     """
     Add build parser to this top-level subparsers object.
@@ -38,8 +47,12 @@ def add_parser(subparsers):
     parser = subparsers.add_parser('missing-chacra', description=DESCRIPTION,
                                    help='find missing files in chacra')
 
-    parser.add_argument('--chacra-url', required=True,
-                        help='Chacra base URL to use, eg. https://...')
+    parser.add_argument('--chacra-url', required=True, action='append',
+                        help='Chacra base URL to use, eg. https://... '
+                             'Repeat this for each Chacra mirror.')
+    parser.add_argument('--deep', action='store_true',
+                        help='also compare file sizes and checksums in the '
+                             'dsc and changes files against chacra')
     parser.add_argument('directory', default='.',
                         help="directory tree of build txt files")
     parser.set_defaults(func=main)
@@ -60,35 +73,44 @@ def find_one_url(extension, urls):
     return needle
 
 
-def parse_debian(url, klass, rsession):
+def parse_debian(url, klass, rsession, mirrors=None):
     """
     Download this URL and parse it into this Debian class.
+
+    :param mirrors: chacra.MirrorPool to fetch this URL from any mirror
     """
-    response = rsession.get(url)
+    if mirrors:
+        response = mirrors.get(rsession, mirrors.relative_path(url))
+    else:
+        response = rsession.get(url)
     response.raise_for_status()
-    io = StringIO.StringIO(response.text)
+    io = StringIO(response.text)
     result = klass(io)
     io.close()
     return result
 
 
-def ensure_files(nvr, chacra_url, rsession):
+def ensure_files(nvr, chacra_url, rsession, catalog=None, deep=False):
     """
     Ensure this build has all the relevant files in chacra.
 
     :param nvr: build's name_versionrelease in chacra
-    :param chacra_url: base url to chacra instance
+    :param chacra_url: base url to chacra instance, or a list of mirrors
     :param rsession: requests.Session object
+    :param catalog: ChacraCatalog to look up this build's files
+    :param deep: also verify the files' sizes and checksums
     :raises: SourceError if there was any problem with this build's sources.
     """
-    source_urls = get_source_urls(nvr, chacra_url, rsession)
+    if catalog is None:
+        catalog = ChacraCatalog(chacra_url, rsession)
+    source_urls = get_source_urls(nvr, chacra_url, rsession, catalog)
     source_filenames = [os.path.basename(url) for url in source_urls]
     # Check the .dsc file
     try:
         dsc_url = find_one_url('dsc', source_urls)
     except SourceError as e:
         raise e.__class__('%s: %s' % (nvr, str(e)))
-    dsc = parse_debian(dsc_url, deb822.Dsc, rsession)
+    dsc = parse_debian(dsc_url, deb822.Dsc, rsession, catalog.mirrors)
     if not dsc['Files']:
         raise NoFilesFoundException('no files in %s' % dsc_url)
     missing = set()
@@ -103,30 +125,79 @@ def ensure_files(nvr, chacra_url, rsession):
         changes_url = find_one_url('changes', source_urls)
     except SourceError as e:
         raise e.__class__('%s: %s' % (nvr, str(e)))
-    changes = parse_debian(changes_url, deb822.Changes, rsession)
+    changes = parse_debian(changes_url, deb822.Changes, rsession,
+                           catalog.mirrors)
     if not changes['Files']:
         raise NoFilesFoundException('no files in %s' % changes_url)
+    if deep:
+        verify_files(nvr, dsc, catalog)
+        verify_files(nvr, changes, catalog)
 
 
-def get_source_urls(nvr, base_url, session):
-    (pkg, version) = name_version(nvr)
-    src_url = posixpath.join(base_url, 'binaries/', pkg, version,
-                             'ubuntu', 'all', 'source')
-    log.debug('searching %s for files' % src_url)
-    src_response = session.get(src_url)
-    if src_response.status_code == 404:
+def verify_files(nvr, control, catalog):
+    """
+    Compare the files in a dsc or changes file against Chacra's metadata.
+
+    Chacra only publishes sha512 checksums, and dsc and changes files rarely
+    have a Checksums-Sha512 field. We always compare the file sizes, and we
+    compare checksums when we have a sha512 for a file.
+
+    :param nvr: build's name_versionrelease in chacra
+    :param control: parsed Dsc or Changes object
+    :param catalog: ChacraCatalog with this build's files
+    :raises: NoFilesFoundException if Chacra lacks a listed file,
+             ChecksumMismatchException if a size or checksum differs.
+    """
+    sha512s = {}
+    for f in control.get('Checksums-Sha512', []):
+        sha512s[f['name']] = f['sha512']
+    missing = []
+    mismatches = []
+    for f in control['Files']:
+        filename = f['name']
+        metadata = catalog.metadata(nvr, filename)
+        if metadata is None:
+            missing.append(filename)
+            continue
+        size = metadata.get('size')
+        if size is not None and int(size) != int(f['size']):
+            mismatches.append('%s size %s != %s' % (filename, size,
+                                                    f['size']))
+        if filename in sha512s and sha512s[filename] != metadata['checksum']:
+            mismatches.append('%s sha512 mismatch' % filename)
+    if missing:
+        raise NoFilesFoundException('%s: chacra lacks %s'
+                                    % (nvr, ' '.join(missing)))
+    if mismatches:
+        raise ChecksumMismatchException('%s: %s'
+                                        % (nvr, ', '.join(mismatches)))
+
+
+def get_source_urls(nvr, base_url, session, catalog=None):
+    """
+    Find the URLs to all of this build's source files in chacra.
+
+    :param catalog: ChacraCatalog to look up this build's files. If None,
+                    we make a new one for this build.
+    :returns: set of URLs
+    :raises: NoFilesFoundException if this build has no source files.
+    """
+    if catalog is None:
+        catalog = ChacraCatalog(base_url, session)
+    sources = catalog.binaries(nvr).get('source')
+    if not sources:
         raise NoFilesFoundException('%s has no source files' % nvr)
-    src_response.raise_for_status()
-    payload = src_response.json()
     urls = set()
-    for filename in payload:
-        url = posixpath.join(src_url, filename)
+    for filename in sources:
+        url = catalog.build_url(nvr, 'source', filename)
         urls.add(url)
     return urls
 
 
 def main(args):
     rsession = requests.Session()
+    instrument_requests(rsession)
+    catalog = ChacraCatalog(args.chacra_url, rsession)
 
     nvrs = find_all_nvrs(args.directory)
 
@@ -135,6 +206,9 @@ def main(args):
     for nvr in sorted_nvrs:
         log.debug('nvr: "%s"' % nvr)
         try:
-            ensure_files(nvr, args.chacra_url, rsession)
+            ensure_files(nvr, args.chacra_url, rsession, catalog, args.deep)
+            metrics.inc('misoctl_nvrs_processed_total')
         except SourceError as e:
             log.error('%s: %s' % (e.__class__.__name__, e))
+            metrics.inc('misoctl_nvrs_skipped_total',
+                        reason=e.__class__.__name__)
@@ -0,0 +1,237 @@
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from misoctl.session import find_builds
+from misoctl.session import find_tagged_nvrs
+from misoctl.util import ensure_directory
+from misoctl.log import log as log
+
+"""
+Plan a sync-chacra run up front, and estimate how long it will take.
+"""
+
+# Extensions of the Chacra files that upload.import_from_directory() sends
+# to Koji. (We download the .changes file, but we don't import it.)
+UPLOAD_EXTENSIONS = ('.deb', '.dsc', '.tar.gz', '.tar.xz', '.tar.bz2')
+
+# Rough cost of one round of tagBuild tasks, in seconds. watch_tasks() polls
+# every 15 seconds.
+TAG_SECONDS = 15
+
+
+class Throughput(object):
+    """
+    Remember how fast our downloads and uploads were, across runs.
+
+    We keep an exponentially-weighted moving average for each direction, in
+    bytes per second, in a small JSON file. Each Koji profile gets its own
+    file, since each hub has its own upload speed.
+    """
+
+    # Until we have measured anything, assume a modest WAN link.
+    DEFAULTS = {'download': 10 * 1024 * 1024, 'upload': 5 * 1024 * 1024}
+    WEIGHT = 0.3
+
+    def __init__(self, path=None, profile='koji'):
+        if path is None:
+            path = os.path.expanduser('~/.cache/misoctl/throughput-%s.json'
+                                      % profile)
+        self.path = path
+        self.rates = {}
+        self.changed = False
+        try:
+            with open(path) as f:
+                self.rates = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def rate(self, direction):
+        """ Return the average bytes per second for this direction. """
+        return self.rates.get(direction, self.DEFAULTS[direction])
+
+    def measured(self, direction):
+        """ Return True if we have measured this direction before. """
+        return direction in self.rates
+
+    def record(self, direction, nbytes, seconds):
+        """
+        Record one transfer of nbytes that took this many seconds.
+
+        :param direction: "download" or "upload"
+        """
+        if nbytes <= 0 or seconds <= 0:
+            return
+        rate = nbytes / float(seconds)
+        if direction in self.rates:
+            old = self.rates[direction]
+            rate = self.WEIGHT * rate + (1 - self.WEIGHT) * old
+        self.rates[direction] = rate
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        ensure_directory(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            json.dump(self.rates, f)
+
+
+def get_upload_files(binaries):
+    """
+    Find the files in this Chacra build that we will import into Koji.
+
+    :param binaries: dict of arch -> filename -> metadata dict
+    :returns: dict of filename -> size in bytes
+    """
+    result = {}
+    for files in binaries.values():
+        for filename, metadata in files.items():
+            if filename.endswith(UPLOAD_EXTENSIONS):
+                result[filename] = metadata.get('size') or 0
+    return result
+
+
+def make_plan(nvrs, sorted_nvrs, koji_nvrs, catalog, session, jobs=8,
+              throughput=None):
+    """
+    Resolve everything a sync-chacra run would do, without doing it.
+
+    :param nvrs: dict of chacra nvr -> set of tag names, from find_all_nvrs
+    :param sorted_nvrs: list of chacra nvrs, in the order to process them
+    :param koji_nvrs: list of the Koji build nvrs for sorted_nvrs
+    :param catalog: ChacraCatalog
+    :param session: Koji session
+    :param jobs: number of concurrent Chacra queries
+    :param throughput: Throughput, for the time estimate
+    :returns: plan dict, suitable for JSON
+    """
+    buildinfos = find_builds(koji_nvrs, session)
+    missing = [nvr for nvr, koji_nvr in zip(sorted_nvrs, koji_nvrs)
+               if not buildinfos[koji_nvr]]
+
+    # Query Chacra for all the builds we must download, concurrently.
+    log.info('looking up %d missing builds in chacra' % len(missing))
+    pool = ThreadPool(jobs)
+    try:
+        binaries = pool.map(catalog.binaries, missing)
+    finally:
+        pool.close()
+        pool.join()
+    missing_binaries = dict(zip(missing, binaries))
+    download_bytes = dict((nvr, catalog.size(nvr)) for nvr in missing)
+
+    all_tags = set()
+    for nvr in sorted_nvrs:
+        all_tags.update(nvrs[nvr])
+    tagged_nvrs = find_tagged_nvrs(all_tags, session)
+
+    builds = []
+    # Builds that are missing from Koji, and that Chacra doesn't have
+    # either. We can neither import nor tag these.
+    not_in_chacra = []
+    tag_operations = {}
+    totals = {
+        'nvrs': len(sorted_nvrs),
+        'missing_builds': len(missing),
+        'download_bytes': 0,
+        'upload_files': 0,
+        'upload_bytes': 0,
+        'tag_operations': 0,
+        'not_in_chacra': 0,
+    }
+    for nvr, koji_nvr in zip(sorted_nvrs, koji_nvrs):
+        tags = sorted(tag for tag in nvrs[nvr]
+                      if koji_nvr not in tagged_nvrs[tag])
+        if nvr not in missing_binaries and not tags:
+            continue
+        if nvr in missing_binaries and not missing_binaries[nvr]:
+            log.warning('%s not found in chacra, skipping it' % nvr)
+            not_in_chacra.append(nvr)
+            continue
+        build = {'nvr': nvr, 'koji_nvr': koji_nvr, 'tags': tags}
+        if nvr in missing_binaries:
+            build_binaries = missing_binaries[nvr]
+            upload_files = get_upload_files(build_binaries)
+            build['binaries'] = build_binaries
+            build['download_bytes'] = download_bytes[nvr]
+            build['upload_files'] = sorted(upload_files)
+            build['upload_bytes'] = sum(upload_files.values())
+            totals['download_bytes'] += build['download_bytes']
+            totals['upload_files'] += len(upload_files)
+            totals['upload_bytes'] += build['upload_bytes']
+        for tag in tags:
+            tag_operations.setdefault(tag, []).append(koji_nvr)
+        totals['tag_operations'] += len(tags)
+        builds.append(build)
+    totals['not_in_chacra'] = len(not_in_chacra)
+
+    plan = {
+        'created': time.time(),
+        'builds': builds,
+        'not_in_chacra': not_in_chacra,
+        'tag_operations': tag_operations,
+        'totals': totals,
+        'estimate': estimate(plan_totals=totals, builds=builds,
+                             throughput=throughput or Throughput()),
+    }
+    return plan
+
+
+def estimate(plan_totals, builds, throughput):
+    """
+    Estimate how long it will take to carry out this plan.
+
+    :returns: dict of rates (bytes/sec) and seconds for each stage
+    """
+    download_rate = throughput.rate('download')
+    upload_rate = throughput.rate('upload')
+    download_seconds = plan_totals['download_bytes'] / float(download_rate)
+    upload_seconds = plan_totals['upload_bytes'] / float(upload_rate)
+    # ensure_tagged() waits for each build's tag tasks together.
+    tag_seconds = TAG_SECONDS * len([b for b in builds if b['tags']])
+    return {
+        'download_rate': download_rate,
+        'download_rate_measured': throughput.measured('download'),
+        'upload_rate': upload_rate,
+        'upload_rate_measured': throughput.measured('upload'),
+        'download_seconds': int(download_seconds),
+        'upload_seconds': int(upload_seconds),
+        'tag_seconds': tag_seconds,
+        'total_seconds': int(download_seconds + upload_seconds +
+                             tag_seconds),
+    }
+
+
+def write_plan(plan, path):
+    """ Write this plan as JSON to a file, or to stdout for "-". """
+    if path == '-':
+        print(json.dumps(plan, indent=2, sort_keys=True))
+        return
+    with open(path, 'w') as f:
+        json.dump(plan, f, indent=2, sort_keys=True)
+
+
+def read_plan(path):
+    """ Read a JSON plan from write_plan(). """
+    with open(path) as f:
+        return json.load(f)
+
+
+def log_summary(plan):
+    """ Log a human-readable summary of this plan. """
+    totals = plan['totals']
+    estimate = plan['estimate']
+    log.info('%(missing_builds)d of %(nvrs)d builds are missing from Koji'
+             % totals)
+    log.info('download %.1f MB, upload %d files (%.1f MB)'
+             % (totals['download_bytes'] / 1048576.0,
+                totals['upload_files'],
+                totals['upload_bytes'] / 1048576.0))
+    if plan.get('not_in_chacra'):
+        log.warning('%d builds are missing from chacra, and we will skip '
+                    'them: %s' % (len(plan['not_in_chacra']),
+                                  ' '.join(plan['not_in_chacra'])))
+    for tag, koji_nvrs in sorted(plan['tag_operations'].items()):
+        log.info('tag %d builds into %s' % (len(koji_nvrs), tag))
+    log.info('estimated time: %d minutes' % (estimate['total_seconds'] / 60))
@@ -0,0 +1,117 @@
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+import misoctl.session
+from misoctl import chacra
+from misoctl.sync_chacra import find_all_nvrs, get_koji_nvr, sort_nvrs
+from misoctl.util import AdaptiveLimiter
+from misoctl.util import RateLimiter
+from misoctl.log import log as log
+from misoctl.metrics import metrics
+from misoctl.metrics import instrument_requests
+
+
+DESCRIPTION = """
+Download all the "shipped builds" from Chacra into the local cache.
+
+This walks a tree of rhcephcompose builds-*.txt files and downloads every
+build that is not already in Koji into the "downloads" directory, verifying
+each file against Chacra's sha512 checksums. A later sync-chacra run from the
+same directory can then import these builds without waiting on Chacra.
+"""
+
+
+def add_parser(subparsers):
+    """
+    Add build parser to this top-level subparsers object.
+    """
+    parser = subparsers.add_parser('prefetch-chacra', description=DESCRIPTION,
+                                   help='download builds from chacra ahead '
+                                        'of sync-chacra')
+
+    parser.add_argument('--chacra-url', required=True, action='append',
+                        help='Chacra base URL to use, eg. https://... '
+                             'Repeat this for each Chacra mirror.')
+    parser.add_argument('--jobs', type=int, default=16,
+                        help='number of builds to download at once '
+                             '(defaults to 16)')
+    parser.add_argument('--max-rate', type=float, metavar='MBPS',
+                        help='cap the total download bandwidth to this '
+                             'many MB/s, so we do not saturate Chacra')
+    parser.add_argument('--skip-koji-check', action='store_true',
+                        help="download every build, even if it's already "
+                             "in Koji")
+    parser.add_argument('directory', nargs='?', default='.',
+                        help="directory tree of build txt files")
+    parser.set_defaults(func=main)
+
+
+def find_missing_nvrs(sorted_nvrs, session):
+    """ Return the builds that are not in Koji, in the same order. """
+    koji_nvrs = [get_koji_nvr(nvr) for nvr in sorted_nvrs]
+    buildinfos = misoctl.session.find_builds(koji_nvrs, session)
+    return [nvr for nvr, koji_nvr in zip(sorted_nvrs, koji_nvrs)
+            if not buildinfos[koji_nvr]]
+
+
+def prefetch(nvrs, chacra_url, rsession, catalog, jobs, limiter=None):
+    """
+    Download these builds with a pool of threads.
+
+    :returns: dict of nvr -> exception, for the builds that failed
+    """
+    def download(nvr):
+        try:
+            chacra.download_build(nvr, chacra_url, rsession, catalog,
+                                  limiter)
+        except Exception as e:
+            log.error('%s: %s' % (nvr, e))
+            return (nvr, e)
+        metrics.inc('misoctl_nvrs_processed_total')
+        return (nvr, None)
+
+    failures = {}
+    pool = ThreadPool(jobs)
+    try:
+        for nvr, error in pool.imap_unordered(download, nvrs):
+            if error:
+                failures[nvr] = error
+    finally:
+        pool.close()
+        pool.join()
+    return failures
+
+
+def main(args):
+    rsession = requests.Session()
+    # Keep a connection open for each of our threads.
+    adapter = HTTPAdapter(pool_connections=args.jobs, pool_maxsize=args.jobs)
+    rsession.mount('https://', adapter)
+    rsession.mount('http://', adapter)
+    instrument_requests(rsession)
+    # Start gently, and grow towards --jobs requests while Chacra copes.
+    chacra.throttle_session(rsession, AdaptiveLimiter('chacra', args.jobs))
+    catalog = chacra.ChacraCatalog(args.chacra_url, rsession)
+
+    nvrs = find_all_nvrs(args.directory)
+
+    sorted_nvrs = sort_nvrs(nvrs.keys())
+
+    if not args.skip_koji_check:
+        session = misoctl.session.get_session(args.profile)
+        missing = find_missing_nvrs(sorted_nvrs, session)
+        skipped = len(sorted_nvrs) - len(missing)
+        log.info('skipping %d builds that are already in Koji' % skipped)
+        metrics.inc('misoctl_nvrs_skipped_total', skipped, reason='exists')
+        sorted_nvrs = missing
+
+    limiter = None
+    if args.max_rate:
+        limiter = RateLimiter(args.max_rate * 1024 * 1024)
+
+    log.info('prefetching %d builds' % len(sorted_nvrs))
+    failures = prefetch(sorted_nvrs, args.chacra_url, rsession, catalog,
+                        args.jobs, limiter)
+    if failures:
+        raise SystemExit('failed to download %d builds: %s'
+                         % (len(failures), ' '.join(sorted(failures))))
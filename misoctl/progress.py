@@ -0,0 +1,188 @@
+from collections import deque
+import sys
+import threading
+import time
+from misoctl.log import log as log
+from misoctl.metrics import metrics
+
+"""
+Show the progress of a long sync-chacra run.
+
+We sample the run's metrics counters, so the code that downloads and uploads
+does not need to know about us. On a terminal we redraw one status line.
+Otherwise we log a line of key=value pairs every so often.
+"""
+
+
+def format_seconds(seconds):
+    """ Format a duration like "2h13m" or "4m05s". """
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    return '%dm%02ds' % (seconds // 60, seconds % 60)
+
+
+class Progress(object):
+    """
+    Builds done, bytes moved, rolling throughput and ETA for one run.
+
+    :param total_nvrs: number of builds this run will process
+    :param download_bytes: bytes we expect to download, if we know
+    :param upload_bytes: bytes we expect to upload, if we know
+    :param stream: terminal to draw on (defaults to stderr)
+    :param interval: seconds between updates. Defaults to 1 on a terminal,
+                     or 60 for log lines.
+    """
+
+    # Measure throughput over this many recent seconds.
+    WINDOW = 60
+
+    COUNTERS = ('misoctl_nvrs_processed_total',
+                'misoctl_downloaded_bytes_total',
+                'misoctl_uploaded_bytes_total')
+
+    def __init__(self, total_nvrs, download_bytes=None, upload_bytes=None,
+                 stream=None, interval=None):
+        self.total_nvrs = total_nvrs
+        self.download_bytes = download_bytes
+        self.upload_bytes = upload_bytes
+        self.stream = stream or sys.stderr
+        self.tty = self.stream.isatty()
+        if interval is None:
+            interval = 1 if self.tty else 60
+        self.interval = interval
+        self.start_time = time.time()
+        # The counters may already count earlier work in this process.
+        self.offsets = [metrics.total(name) for name in self.COUNTERS]
+        self.samples = deque()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def counts(self):
+        """
+        :returns: three-element tuple of builds done, bytes downloaded and
+                  bytes uploaded during this run.
+        """
+        return tuple(metrics.total(name) - offset
+                     for name, offset in zip(self.COUNTERS, self.offsets))
+
+    def sample(self, now=None):
+        """
+        Record the counters now, and return this run's status.
+
+        :returns: dict of done, downloaded, uploaded, download_rate,
+                  upload_rate (bytes per second), and eta (seconds, or None
+                  if we cannot tell yet).
+        """
+        if now is None:
+            now = time.time()
+        (done, downloaded, uploaded) = self.counts()
+        self.samples.append((now, downloaded, uploaded))
+        while len(self.samples) > 2 and \
+                now - self.samples[1][0] >= self.WINDOW:
+            self.samples.popleft()
+        (then, old_downloaded, old_uploaded) = self.samples[0]
+        elapsed = now - then
+        download_rate = upload_rate = 0
+        if elapsed > 0:
+            download_rate = (downloaded - old_downloaded) / elapsed
+            upload_rate = (uploaded - old_uploaded) / elapsed
+        status = {
+            'done': done,
+            'downloaded': downloaded,
+            'uploaded': uploaded,
+            'download_rate': download_rate,
+            'upload_rate': upload_rate,
+            'eta': self.eta(now, done, downloaded, uploaded, download_rate,
+                            upload_rate),
+        }
+        return status
+
+    def eta(self, now, done, downloaded, uploaded, download_rate,
+            upload_rate):
+        """
+        Estimate the seconds left in this run.
+
+        When we know the total bytes, we divide what is left in each
+        direction by its rolling rate. Otherwise we extrapolate from the
+        builds we have finished so far.
+        """
+        if self.download_bytes is not None and self.upload_bytes is not None:
+            if not download_rate and downloaded < self.download_bytes:
+                return None
+            if not upload_rate and uploaded < self.upload_bytes:
+                return None
+            seconds = 0
+            if downloaded < self.download_bytes:
+                seconds += (self.download_bytes - downloaded) / download_rate
+            if uploaded < self.upload_bytes:
+                seconds += (self.upload_bytes - uploaded) / upload_rate
+            return seconds
+        if not done:
+            return None
+        elapsed = now - self.start_time
+        return elapsed / done * (self.total_nvrs - done)
+
+    def format_line(self, status):
+        """ Format a status as one short line for a terminal. """
+        def size(nbytes, total):
+            if total is None:
+                return '%.1f MB' % (nbytes / 1048576.0)
+            return '%.1f/%.1f MB' % (nbytes / 1048576.0, total / 1048576.0)
+        eta = '?'
+        if status['eta'] is not None:
+            eta = format_seconds(status['eta'])
+        return ('%d/%d builds, down %s at %.1f MB/s, up %s at %.1f MB/s, '
+                'ETA %s' % (status['done'], self.total_nvrs,
+                            size(status['downloaded'], self.download_bytes),
+                            status['download_rate'] / 1048576.0,
+                            size(status['uploaded'], self.upload_bytes),
+                            status['upload_rate'] / 1048576.0, eta))
+
+    def format_fields(self, status):
+        """ Format a status as key=value pairs for a log line. """
+        fields = [
+            ('nvrs_done', status['done']),
+            ('nvrs_total', self.total_nvrs),
+            ('downloaded_mb', '%.1f' % (status['downloaded'] / 1048576.0)),
+            ('uploaded_mb', '%.1f' % (status['uploaded'] / 1048576.0)),
+            ('download_mbps', '%.1f' % (status['download_rate'] / 1048576.0)),
+            ('upload_mbps', '%.1f' % (status['upload_rate'] / 1048576.0)),
+        ]
+        if self.download_bytes is not None:
+            fields.append(('download_total_mb',
+                           '%.1f' % (self.download_bytes / 1048576.0)))
+        if self.upload_bytes is not None:
+            fields.append(('upload_total_mb',
+                           '%.1f' % (self.upload_bytes / 1048576.0)))
+        if status['eta'] is not None:
+            fields.append(('eta_seconds', int(status['eta'])))
+        return ' '.join('%s=%s' % field for field in fields)
+
+    def update(self):
+        status = self.sample()
+        if self.tty:
+            self.stream.write('\r%-79s' % self.format_line(status))
+            self.stream.flush()
+        else:
+            log.info('progress %s' % self.format_fields(status))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.update()
+
+    def start(self):
+        """ Start updating in a background thread. """
+        self.sample()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Show the final status, and stop updating. """
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.update()
+        if self.tty:
+            self.stream.write('\n')
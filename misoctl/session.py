@@ -1,6 +1,10 @@
 import koji
 from koji_cli.lib import activate_session
 from misoctl.log import log as log
+from misoctl.metrics import instrument_koji
+
+# Koji's multicall handles large batches, but keep each HTTP request sane.
+MULTICALL_BATCH = 500
 
 
 def get_session(profile):
@@ -11,6 +15,7 @@ def get_session(profile):
     mykoji = koji.get_profile_module(profile)
     opts = mykoji.grab_session_options(mykoji.config)
     session = mykoji.ClientSession(mykoji.config.server, opts)
+    instrument_koji(session)
     # Log in ("activate") this sesssion:
     # Note: this can raise SystemExit if there is a problem, eg with Kerberos:
     activate_session(session, mykoji.config)
@@ -19,3 +24,48 @@ def get_session(profile):
     username = userinfo['name']
     log.info('authenticated to %s as %s' % (mykoji.config.server, username))
     return session
+
+
+def multicall(session, method, calls):
+    """
+    Call one Koji method many times, in batches of multicalls.
+
+    :param session: Koji session
+    :param method: name of the Koji RPC, eg. "getBuild"
+    :param calls: list of (args, kwargs) tuples.
+    :returns: list of results, in the same order as calls.
+    """
+    results = []
+    for i in range(0, len(calls), MULTICALL_BATCH):
+        session.multicall = True
+        for args, kwargs in calls[i:i + MULTICALL_BATCH]:
+            getattr(session, method)(*args, **kwargs)
+        for result in session.multiCall(strict=True):
+            results.append(result[0])
+    return results
+
+
+def find_builds(koji_nvrs, session):
+    """
+    Look up these builds in Koji with multicalls.
+
+    :returns: dict of koji nvr -> buildinfo (None if missing)
+    """
+    calls = [((koji_nvr,), {}) for koji_nvr in koji_nvrs]
+    buildinfos = multicall(session, 'getBuild', calls)
+    return dict(zip(koji_nvrs, buildinfos))
+
+
+def find_tagged_nvrs(tags, session):
+    """
+    Find all the Debian builds in these Koji tags.
+
+    :returns: dict of tag name -> set of koji nvrs
+    """
+    tags = sorted(tags)
+    calls = [((tag,), {'type': 'debian'}) for tag in tags]
+    tagged = multicall(session, 'listTagged', calls)
+    result = {}
+    for tag, builds in zip(tags, tagged):
+        result[tag] = set(build['nvr'] for build in builds)
+    return result
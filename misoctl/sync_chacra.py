@@ -1,14 +1,28 @@
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+import argparse
+import json
 import os
 import re
+import subprocess
 import sys
+import time
+import zlib
 import requests
 from koji_cli.lib import watch_tasks
 from debian import debian_support
 import misoctl.session
 from misoctl import chacra
+from misoctl import inheritance
+from misoctl import inventory
+from misoctl import lease
+from misoctl import plan
+from misoctl import progress
 from misoctl import upload
 from misoctl.log import log as log
+from misoctl.metrics import metrics
+from misoctl.metrics import instrument_requests
+from misoctl.util import AdaptiveLimiter
 
 
 DESCRIPTION = """
@@ -30,8 +44,9 @@ def add_parser(subparsers):
     parser = subparsers.add_parser('sync-chacra', description=DESCRIPTION,
                                    help='sync builds from chacra to Koji')
 
-    parser.add_argument('--chacra-url', required=True,
-                        help='Chacra base URL to use, eg. https://...')
+    parser.add_argument('--chacra-url', required=True, action='append',
+                        help='Chacra base URL to use, eg. https://... '
+                             'Repeat this for each Chacra mirror.')
     parser.add_argument('--scm-template', required=True,
                         help='SCM URL pattern template for all builds. eg. '
                              'git://example.com/packages/{name}')
@@ -39,11 +54,132 @@ def add_parser(subparsers):
                         help='koji user name that will own all new builds')
     parser.add_argument('--dryrun', action='store_true',
                         help="Show what would happen, but don't do it")
-    parser.add_argument('directory', default='.',
+    parser.add_argument('--plan', metavar='FILE',
+                        help='Find everything this run would do, estimate '
+                             'how long it will take, and write that plan '
+                             'as JSON to FILE ("-" for stdout). '
+                             "Don't change anything.")
+    parser.add_argument('--execute-plan', metavar='FILE',
+                        help='Carry out a plan from --plan, without '
+                             'querying Chacra or Koji for it again')
+    parser.add_argument('--jobs', type=int, default=8,
+                        help='maximum number of concurrent Chacra queries '
+                             '(defaults to 8). We start lower, and adapt to '
+                             'how well Chacra copes.')
+    parser.add_argument('--upload-jobs', type=int, default=4,
+                        help='maximum number of files to upload to Koji at '
+                             'once for each build (defaults to 4). We start '
+                             'with one, and add more while the hub copes.')
+    parser.add_argument('--lease-dir', metavar='DIR',
+                        help='claim each build with a lease file in this '
+                             'shared directory before downloading it, so '
+                             'concurrent runs never duplicate work')
+    parser.add_argument('--lease-time', type=int, default=6 * 3600,
+                        help='seconds until a lease expires, for runners '
+                             'that crash (defaults to 6 hours). Live '
+                             'runners renew their leases, and at the end of '
+                             'a run we wait up to this long for the builds '
+                             'that other runners hold.')
+    parser.add_argument('--inventory-max-age', type=int, default=600,
+                        metavar='SECONDS',
+                        help='answer "is this build in Koji, and tagged?" '
+                             'from a local inventory of debian builds, '
+                             'refreshed from Koji when it is older than '
+                             'this (defaults to 600). 0 asks Koji about '
+                             'each build instead.')
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+                        help='only sync shard I of N (eg. 1/4). Every '
+                             'version of a package lands in the same shard, '
+                             'so N hosts can split a migration.')
+    parser.add_argument('--keep-going', action='store_true',
+                        help="don't stop at a build that fails. Skip that "
+                             "package's later builds, retry the failures "
+                             "at the end, and write a --failure-report")
+    parser.add_argument('--retries', type=int, default=2,
+                        help='with --keep-going, retry failed builds this '
+                             'many times, waiting longer each time '
+                             '(defaults to 2)')
+    parser.add_argument('--failure-report', metavar='FILE',
+                        default='sync-chacra-failures.json',
+                        help='with --keep-going, write the builds that '
+                             'still failed as JSON to FILE (defaults to '
+                             'sync-chacra-failures.json)')
+    parser.add_argument('--only-failed', metavar='FILE',
+                        help='only sync the builds in this --failure-report')
+    parser.add_argument('--watch', type=int, metavar='SECONDS',
+                        help='keep running, and check the directory for '
+                             'changed builds txt files every SECONDS. Only '
+                             'sync the builds that changed.')
+    parser.add_argument('--git-pull', action='store_true',
+                        help='with --watch, "git pull" the directory before '
+                             'each check')
+    parser.add_argument('--shard-report', type=int, metavar='N',
+                        help='show how builds and bytes would balance '
+                             'across N shards, and exit')
+    parser.add_argument('directory', nargs='?', default='.',
                         help="directory tree of build txt files")
     parser.set_defaults(func=main)
 
 
+def parse_shard(value):
+    """
+    Parse a "I/N" --shard argument.
+
+    :returns: two-element tuple of shard number (1 to N) and shard count
+    """
+    try:
+        (index, count) = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not I/N' % value)
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError('%s is not a shard from 1/N to N/N'
+                                         % value)
+    return (index, count)
+
+
+def get_shard(nvr, count):
+    """
+    Find this build's shard from a stable hash of its package name.
+
+    :returns: shard number, from 1 to count
+    """
+    (name, _) = chacra.name_version(nvr)
+    checksum = zlib.crc32(name.encode('utf-8')) & 0xffffffff
+    return checksum % count + 1
+
+
+def shard_nvrs(sorted_nvrs, index, count):
+    """ Return the builds in this shard, in the same order. """
+    return [nvr for nvr in sorted_nvrs if get_shard(nvr, count) == index]
+
+
+def shard_report(sorted_nvrs, count, catalog, jobs=8):
+    """
+    Print the number of packages, builds and Chacra bytes in each shard.
+    """
+    pool = ThreadPool(jobs)
+    try:
+        sizes = pool.map(catalog.size, sorted_nvrs)
+    finally:
+        pool.close()
+        pool.join()
+    shards = dict((index, {'names': set(), 'nvrs': 0, 'bytes': 0})
+                  for index in range(1, count + 1))
+    for nvr, size in zip(sorted_nvrs, sizes):
+        shard = shards[get_shard(nvr, count)]
+        shard['names'].add(chacra.name_version(nvr)[0])
+        shard['nvrs'] += 1
+        shard['bytes'] += size
+    total_bytes = max(sum(sizes), 1)
+    print('%-8s %8s %8s %12s %7s' % ('shard', 'packages', 'builds', 'MB',
+                                     'bytes%'))
+    for index in sorted(shards):
+        shard = shards[index]
+        print('%-8s %8d %8d %12.1f %6.1f%%' % (
+            '%d/%d' % (index, count), len(shard['names']), shard['nvrs'],
+            shard['bytes'] / 1048576.0, 100.0 * shard['bytes'] / total_bytes))
+
+
 def find_buildstxts(directory):
     if not os.path.isdir(directory):
         raise ValueError('%s is not a directory' % directory)
@@ -118,10 +254,20 @@ def find_all_nvrs(directory):
     """
     Find all NVRs (and tag names) in this directory of builds .txt files.
     """
-    all_nvrs = defaultdict(set)
     buildstxts = find_buildstxts(directory)
-    for buildstxt in buildstxts:
-        nvrs = read_nvrs(buildstxt)
+    return merge_nvrs(dict((buildstxt, read_nvrs(buildstxt))
+                           for buildstxt in buildstxts))
+
+
+def merge_nvrs(buildstxt_nvrs):
+    """
+    Find the tag names for all these NVRs.
+
+    :param buildstxt_nvrs: dict of builds .txt file path -> set of NVRs
+    :returns: dict of NVR -> set of tag names
+    """
+    all_nvrs = defaultdict(set)
+    for buildstxt, nvrs in buildstxt_nvrs.items():
         # Determine the Koji tag names for these NVRs as well.
         tag_names = get_tag_names(buildstxt)
         for nvr in nvrs:
@@ -141,6 +287,62 @@ def find_all_nvrs(directory):
     return all_nvrs
 
 
+class BuildsTree(object):
+    """
+    A directory of builds .txt files that we check for changes.
+
+    We only read the files whose mtime or size changed since the last scan.
+    We skip (and log) files whose names we can't map to Koji tags, so one
+    bad file does not stop a --watch daemon.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.stats = {}
+        self.buildstxt_nvrs = {}
+
+    def scan(self):
+        """
+        Read any new or changed builds .txt files.
+
+        :returns: True if anything changed since the last scan.
+        """
+        changed = False
+        buildstxts = find_buildstxts(self.directory)
+        for buildstxt in set(self.stats) - buildstxts:
+            del self.stats[buildstxt]
+            self.buildstxt_nvrs.pop(buildstxt, None)
+            changed = True
+        for buildstxt in buildstxts:
+            st = os.stat(buildstxt)
+            stat = (st.st_mtime, st.st_size)
+            if self.stats.get(buildstxt) == stat:
+                continue
+            try:
+                get_tag_names(buildstxt)
+            except (RuntimeError, ValueError) as e:
+                log.warning('skipping %s: %s' % (buildstxt, e))
+                self.buildstxt_nvrs.pop(buildstxt, None)
+            else:
+                self.buildstxt_nvrs[buildstxt] = read_nvrs(buildstxt)
+            self.stats[buildstxt] = stat
+            changed = True
+        return changed
+
+    def all_nvrs(self):
+        """ Return a dict of NVR -> set of tag names, like find_all_nvrs. """
+        return merge_nvrs(self.buildstxt_nvrs)
+
+
+def git_pull(directory):
+    """ Update this git checkout, and log (but survive) any failure. """
+    try:
+        subprocess.check_call(['git', 'pull', '--ff-only', '--quiet'],
+                              cwd=directory)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning('git pull in %s failed: %s' % (directory, e))
+
+
 def get_koji_nvr(nvr):
     """
     Translate this Debian packaging NVR to a Koji build NVR.
@@ -164,7 +366,8 @@ def get_koji_nvr(nvr):
 
 
 def ensure_uploaded(nvr, chacra_url, rsession, session, owner, scm_template,
-                    dryrun):
+                    dryrun, catalog=None, throughput=None, leases=None,
+                    builds=None, limiter=None):
     """
     Ensure this build is uploaded into Koji.
 
@@ -175,29 +378,80 @@ def ensure_uploaded(nvr, chacra_url, rsession, session, owner, scm_template,
     :param owner: Koji user name that will own this build
     :param scm_template: format string for this build's scm_url
     :param dryrun: if True, show what would have happened, but don't do it
+    :param catalog: ChacraCatalog to look up this build's files
+    :param throughput: plan.Throughput to record transfer rates
+    :param leases: lease.LeaseDirectory to claim this build before we
+                   download it
+    :param builds: inventory.Inventory to look up this build, instead of
+                   asking Koji
+    :param limiter: util.AdaptiveLimiter for parallel Koji uploads
+    :raises: lease.LeaseHeldError if another runner is importing this build
     """
     koji_nvr = get_koji_nvr(nvr)
     # Check if this build exists in Koji
-    buildinfo = session.getBuild(koji_nvr)
+    if builds:
+        buildinfo = builds.get_build(koji_nvr)
+    else:
+        buildinfo = session.getBuild(koji_nvr)
     if buildinfo:
+        metrics.inc('misoctl_nvrs_skipped_total', reason='exists')
         return buildinfo
     if dryrun:
         log.info('would download chacra build %s' % nvr)
         return
-    directory = chacra.download_build(nvr, chacra_url, rsession)
+    if not leases:
+        buildinfo = import_build(nvr, chacra_url, rsession, session, owner,
+                                 scm_template, catalog, throughput, limiter)
+    else:
+        leases.acquire(koji_nvr)
+        try:
+            # Another runner may have finished this build before we claimed
+            # it (or before our inventory saw it).
+            buildinfo = session.getBuild(koji_nvr)
+            if not buildinfo:
+                buildinfo = import_build(nvr, chacra_url, rsession, session,
+                                         owner, scm_template, catalog,
+                                         throughput, limiter)
+        finally:
+            leases.release(koji_nvr)
+    if builds:
+        builds.add_build(buildinfo)
+    return buildinfo
+
+
+def import_build(nvr, chacra_url, rsession, session, owner, scm_template,
+                 catalog=None, throughput=None, limiter=None):
+    """
+    Download this build from chacra and import it into Koji.
+
+    See ensure_uploaded() for the parameters.
+    """
+    if catalog is None:
+        catalog = chacra.ChacraCatalog(chacra_url, rsession)
+    start = time.time()
+    directory = chacra.download_build(nvr, chacra_url, rsession,
+                                      catalog)
+    if throughput:
+        throughput.record('download', catalog.size(nvr), time.time() - start)
     skip_log = True
     (name, version) = chacra.name_version(nvr)
     scm_url = scm_template.format(name=name)
+    start = time.time()
     buildinfo = upload.import_from_directory(directory,
                                              session,
                                              owner,
                                              skip_log,
                                              scm_url,
-                                             dryrun)
+                                             False,
+                                             limiter)
+    if throughput:
+        upload_files = plan.get_upload_files(catalog.binaries(nvr))
+        throughput.record('upload', sum(upload_files.values()),
+                          time.time() - start)
     return buildinfo
 
 
-def ensure_tagged(buildinfo, tags, session, dryrun):
+def ensure_tagged(buildinfo, tags, session, dryrun, builds=None):
     """
     Ensure this build is tagged into Koji.
 
@@ -205,29 +459,103 @@ def ensure_tagged(buildinfo, tags, session, dryrun):
     :param list tags: list of tags for this build.
     :param session: Koji session
     :param bool dryrun: show what would happen, but don't do it.
+    :param builds: inventory.Inventory to look up the tagged builds, instead
+                   of asking Koji
     """
-    task_ids = []
     nvr = '%(name)s-%(version)s-%(release)s' % buildinfo
+    needed = []
     for tag in sorted(tags):
-        tagged_builds = session.listTagged(tag, package=buildinfo['name'],
-                                           type='debian')
-        tagged_nvrs = [tagged_build['nvr'] for tagged_build in tagged_builds]
+        if builds:
+            tagged_nvrs = builds.tagged_nvrs(tag)
+        else:
+            tagged_builds = session.listTagged(tag,
+                                               package=buildinfo['name'],
+                                               type='debian')
+            tagged_nvrs = [tagged_build['nvr']
+                           for tagged_build in tagged_builds]
         if nvr in tagged_nvrs:
             log.info('%s is already tagged into %s' % (nvr, tag))
             continue
         log.info('tagging %s into %s' % (nvr, tag))
-        if dryrun:
-            continue
+        needed.append(tag)
+    if dryrun:
+        return
+    apply_tags(nvr, needed, session)
+    if builds:
+        for tag in needed:
+            builds.add_tagged(tag, nvr)
+
+
+def apply_tags(nvr, tags, session):
+    """
+    Tag this build into all these tags, and wait for the tag tasks.
+
+    :param str nvr: Koji build NVR
+    :param list tags: list of tags for this build.
+    :param session: Koji session
+    """
+    task_ids = []
+    for tag in sorted(tags):
         task_id = session.tagBuild(tag, nvr)
         task_ids.append(task_id)
     if not task_ids:
         # This build is already tagged into all the necessary tags.
         return
+    start = time.time()
     task_result = watch_tasks(session, task_ids, poll_interval=15)
-    if task_result != 0 and not dryrun:
+    metrics.observe('misoctl_tag_wait_seconds', time.time() - start)
+    if task_result != 0:
         raise RuntimeError('failed to tag build %s' % nvr)
 
 
+def execute_plan(build_plan, chacra_url, rsession, catalog, session, owner,
+                 scm_template, throughput=None, leases=None, keep_going=False,
+                 retries=0, lease_wait=0, limiter=None):
+    """
+    Carry out a plan from plan.make_plan().
+
+    We trust the plan's view of Chacra and Koji, so we don't query either
+    to discover what to do. See sync_nvrs() for keep_going, retries and
+    lease_wait.
+
+    :param limiter: util.AdaptiveLimiter for parallel Koji uploads
+    :returns: dict of nvr -> error message for the builds that failed
+    """
+    plan_builds = dict((build['nvr'], build) for build in build_plan['builds'])
+
+    def sync(nvr):
+        execute_build(plan_builds[nvr], chacra_url, rsession, catalog,
+                      session, owner, scm_template, throughput, leases,
+                      limiter)
+
+    sorted_nvrs = [build['nvr'] for build in build_plan['builds']]
+    return sync_nvrs(sorted_nvrs, sync, keep_going, retries, lease_wait)
+
+
+def execute_build(build, chacra_url, rsession, catalog, session, owner,
+                  scm_template, throughput=None, leases=None, limiter=None):
+    """ Carry out one build's part of a plan. """
+    nvr = build['nvr']
+    log.info('nvr: "%s"' % nvr)
+    if 'binaries' in build and not build['binaries']:
+        # Older plans kept the builds that Chacra did not have.
+        log.warning('%s not found in chacra, skipping it' % nvr)
+        return
+    if 'binaries' in build:
+        catalog.add(nvr, build['binaries'])
+        if leases:
+            # Check again, since another runner may hold this build.
+            ensure_uploaded(nvr, chacra_url, rsession, session, owner,
+                            scm_template, False, catalog, throughput, leases,
+                            limiter=limiter)
+        else:
+            import_build(nvr, chacra_url, rsession, session, owner,
+                         scm_template, catalog, throughput, limiter)
+    for tag in build['tags']:
+        log.info('tagging %s into %s' % (build['koji_nvr'], tag))
+    apply_tags(build['koji_nvr'], build['tags'], session)
+
+
 def compare_nvrs(a_nvr, b_nvr):
     (a_name, a_version) = chacra.name_version(a_nvr)
     (b_name, b_version) = chacra.name_version(b_nvr)
@@ -247,29 +575,365 @@ def sort_nvrs(nvrs):
     return sorted(nvrs, key=cmp_to_key(compare_nvrs))
 
 
+def sync_nvr(nvr, tags, args, rsession, catalog, session, throughput,
+             leases, builds=None, limiter=None):
+    """
+    Ensure this build is uploaded and tagged into Koji.
+
+    :raises: lease.LeaseHeldError if another runner is importing this build
+    """
+    log.info('nvr: "%s"' % nvr)
+    buildinfo = ensure_uploaded(nvr,
+                                args.chacra_url,
+                                rsession,
+                                session,
+                                args.owner,
+                                args.scm_template,
+                                args.dryrun,
+                                catalog,
+                                throughput,
+                                leases,
+                                builds,
+                                limiter)
+
+    if args.dryrun and not buildinfo:
+        # Minimally fake the buildinfo we would have generated above.
+        (name, version, release) = chacra.name_version_release(nvr)
+        buildinfo = {'name': name, 'version': version, 'release': release}
+    ensure_tagged(buildinfo, tags, session, args.dryrun, builds)
+    metrics.inc('misoctl_nvrs_processed_total')
+
+
+def watch(args, rsession, catalog, session, throughput, leases, builds,
+          limiter=None):
+    """
+    Sync new and changed builds .txt entries as they appear, forever.
+
+    We keep our Koji session, Chacra catalog and build inventory warm
+    between checks, so each check only costs a directory walk.
+    """
+    tree = BuildsTree(args.directory)
+    tag_inheritance = inheritance.TagInheritance(session)
+    synced = {}
+    # NVR -> tags that we have not synced yet, or that failed.
+    pending = {}
+    # True if we failed to process the last scan's changes.
+    stale = False
+    while True:
+        if args.git_pull:
+            git_pull(args.directory)
+        try:
+            if tree.scan() or stale:
+                stale = True
+                nvrs = tree.all_nvrs()
+                # Someone may have changed the tags since the last scan.
+                tag_inheritance.reset()
+                inheritance.prune_nvrs(nvrs, tag_inheritance)
+                for nvr, tags in nvrs.items():
+                    if synced.get(nvr) != tags:
+                        pending[nvr] = tags
+                if args.shard:
+                    (index, count) = args.shard
+                    for nvr in list(pending):
+                        if get_shard(nvr, count) != index:
+                            del pending[nvr]
+                synced = dict((nvr, tags) for nvr, tags in nvrs.items()
+                              if nvr not in pending)
+                stale = False
+        except Exception:
+            log.exception('failed to read the changes in %s, retrying in '
+                          '%d seconds' % (args.directory, args.watch))
+        if pending:
+            log.info('syncing %d changed builds' % len(pending))
+        for nvr in sort_nvrs(pending.keys()):
+            tags = pending[nvr]
+            try:
+                sync_nvr(nvr, tags, args, rsession, catalog, session,
+                         throughput, leases, builds, limiter)
+            except lease.LeaseHeldError as e:
+                log.info('%s, retrying later' % e)
+                continue
+            except Exception:
+                log.exception('failed to sync %s, retrying later' % nvr)
+                continue
+            del pending[nvr]
+            synced[nvr] = tags
+        throughput.save()
+        if builds:
+            builds.save()
+        time.sleep(args.watch)
+
+
+# Seconds to wait before the first round of retries. This doubles for each
+# round after it.
+RETRY_DELAY = 60
+
+# Seconds between checks on the builds that other runners hold leases on.
+LEASE_POLL = 60
+
+
+def sync_round(sorted_nvrs, sync, keep_going=False, lease_wait=0):
+    """
+    Sync these builds once, retrying lease-held ones at the end.
+
+    :param sorted_nvrs: list of chacra nvrs, in the order to process them
+    :param sync: function to sync one nvr
+    :param keep_going: if True, record each failure and carry on with the
+                       other packages. We skip the later builds of a package
+                       that failed, since they may depend on it.
+    :param lease_wait: keep retrying the builds that other runners hold for
+                       up to this many seconds. Runners renew the leases
+                       they work on, so a held lease means the build is in
+                       progress. With 0, we retry them once.
+    :returns: dict of nvr -> error message for the builds that failed
+    """
+    failures = {}
+    failed_names = set()
+    deferred = []
+
+    def attempt(nvr, final):
+        (name, _) = chacra.name_version(nvr)
+        if name in failed_names:
+            failures[nvr] = 'an earlier %s build failed' % name
+            return
+        try:
+            sync(nvr)
+        except lease.LeaseHeldError as e:
+            if final:
+                log.warning('skipping %s: %s' % (nvr, e))
+                metrics.inc('misoctl_nvrs_skipped_total', reason='lease')
+            else:
+                log.info('%s, retrying later' % e)
+                deferred.append(nvr)
+        except Exception as e:
+            if not keep_going:
+                raise
+            log.exception('failed to sync %s' % nvr)
+            failures[nvr] = '%s: %s' % (e.__class__.__name__, e)
+            failed_names.add(name)
+
+    for nvr in sorted_nvrs:
+        attempt(nvr, final=False)
+    # By now, the other runners have probably finished these.
+    deadline = time.time() + lease_wait
+    while deferred:
+        retry = list(deferred)
+        del deferred[:]
+        final = time.time() >= deadline
+        for nvr in retry:
+            attempt(nvr, final)
+        if deferred:
+            log.info('waiting for other runners to finish %d builds'
+                     % len(deferred))
+            time.sleep(LEASE_POLL)
+    return failures
+
+
+def sync_nvrs(sorted_nvrs, sync, keep_going=False, retries=0,
+              lease_wait=0):
+    """
+    Sync these builds, and retry the failures with backoff.
+
+    See sync_round() for the parameters.
+
+    :param retries: number of extra rounds for the builds that failed
+    :returns: dict of nvr -> error message for the builds that still failed
+    """
+    failures = sync_round(sorted_nvrs, sync, keep_going, lease_wait)
+    for attempt in range(retries):
+        if not failures:
+            break
+        delay = RETRY_DELAY * 2 ** attempt
+        log.info('retrying %d failed builds in %d seconds'
+                 % (len(failures), delay))
+        time.sleep(delay)
+        failures = sync_round(sort_nvrs(failures), sync, keep_going,
+                              lease_wait)
+    return failures
+
+
+def write_failure_report(path, failures, nvrs):
+    """
+    Write the builds that failed as JSON, for a later --only-failed run.
+
+    :param failures: dict of nvr -> error message
+    :param nvrs: dict of chacra nvr -> set of tag names
+    """
+    report = {
+        'created': time.time(),
+        'failures': [{'nvr': nvr, 'tags': sorted(nvrs[nvr]), 'error': error}
+                     for nvr, error in sorted(failures.items())],
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def read_failure_report(path):
+    """ Return the set of nvrs in a failure report. """
+    with open(path) as f:
+        report = json.load(f)
+    return set(failure['nvr'] for failure in report['failures'])
+
+
+def report_failures(args, failures, nvrs):
+    """
+    Write the --failure-report, and exit non-zero if any builds failed.
+
+    :param failures: dict of nvr -> error message, from sync_nvrs()
+    :param nvrs: dict of chacra nvr -> set of tag names
+    """
+    if args.keep_going:
+        write_failure_report(args.failure_report, failures, nvrs)
+    if failures:
+        metrics.inc('misoctl_nvrs_skipped_total', len(failures),
+                    reason='failed')
+        raise SystemExit('%d builds failed, see %s'
+                         % (len(failures), args.failure_report))
+
+
+def start_progress(sorted_nvrs, catalog, builds=None, jobs=8):
+    """
+    Start showing the progress of this run.
+
+    With an inventory, we can cheaply find the builds that are missing from
+    Koji, so we look up their sizes in Chacra for a byte-based ETA. The
+    catalog keeps these lookups for the downloads.
+
+    :returns: progress.Progress
+    """
+    download_bytes = upload_bytes = None
+    if builds:
+        missing = [nvr for nvr in sorted_nvrs
+                   if not builds.get_build(get_koji_nvr(nvr))]
+        pool = ThreadPool(jobs)
+        try:
+            binaries = pool.map(catalog.binaries, missing)
+        finally:
+            pool.close()
+            pool.join()
+        download_bytes = sum(catalog.size(nvr) for nvr in missing)
+        upload_bytes = sum(sum(plan.get_upload_files(b).values())
+                           for b in binaries)
+    run_progress = progress.Progress(len(sorted_nvrs), download_bytes,
+                                     upload_bytes)
+    run_progress.start()
+    return run_progress
+
+
 def main(args):
+    if args.watch:
+        for option in ('plan', 'execute_plan', 'only_failed', 'keep_going'):
+            if getattr(args, option):
+                raise SystemExit('--watch does not work with --%s'
+                                 % option.replace('_', '-'))
+    if args.execute_plan and args.dryrun:
+        # A plan already is the dry run.
+        raise SystemExit('--execute-plan does not work with --dryrun')
     rsession = requests.Session()
+    instrument_requests(rsession)
+    chacra.throttle_session(rsession, AdaptiveLimiter('chacra', args.jobs))
+    catalog = chacra.ChacraCatalog(args.chacra_url, rsession)
+
+    if args.shard_report:
+        nvrs = find_all_nvrs(args.directory)
+        sorted_nvrs = sort_nvrs(nvrs.keys())
+        shard_report(sorted_nvrs, args.shard_report, catalog, args.jobs)
+        return
+
     session = misoctl.session.get_session(args.profile)
+    throughput = plan.Throughput(profile=args.profile)
+    leases = None
+    if args.lease_dir:
+        leases = lease.LeaseDirectory(args.lease_dir, args.lease_time)
+
+    try:
+        run(args, rsession, catalog, session, throughput, leases)
+    finally:
+        if leases:
+            leases.close()
 
+
+def run(args, rsession, catalog, session, throughput, leases):
+    """ Sync the builds, with the sessions and leases that main() set up. """
     upload.verify_user(args.owner, session)
 
+    retries = args.retries if args.keep_going else 0
+    lease_wait = args.lease_time if leases else 0
+    limiter = AdaptiveLimiter('koji-upload', args.upload_jobs)
+
+    if args.execute_plan:
+        build_plan = plan.read_plan(args.execute_plan)
+        if args.only_failed:
+            failed = read_failure_report(args.only_failed)
+            build_plan['builds'] = [build for build in build_plan['builds']
+                                    if build['nvr'] in failed]
+            log.info('retrying %d failed builds' % len(build_plan['builds']))
+        plan.log_summary(build_plan)
+        try:
+            failures = execute_plan(build_plan, args.chacra_url, rsession,
+                                    catalog, session, args.owner,
+                                    args.scm_template, throughput, leases,
+                                    args.keep_going, retries, lease_wait,
+                                    limiter)
+        finally:
+            throughput.save()
+        nvrs = dict((build['nvr'], set(build['tags']))
+                    for build in build_plan['builds'])
+        report_failures(args, failures, nvrs)
+        return
+
+    builds = None
+    if args.inventory_max_age:
+        builds = inventory.Inventory(session, max_age=args.inventory_max_age,
+                                     profile=args.profile)
+
+    if args.watch:
+        watch(args, rsession, catalog, session, throughput, leases, builds,
+              limiter)
+        return
+
     nvrs = find_all_nvrs(args.directory)
+    inheritance.prune_nvrs(nvrs, inheritance.TagInheritance(session))
 
     sorted_nvrs = sort_nvrs(nvrs.keys())
 
-    for nvr in sorted_nvrs:
-        log.info('nvr: "%s"' % nvr)
-        buildinfo = ensure_uploaded(nvr,
-                                    args.chacra_url,
-                                    rsession,
-                                    session,
-                                    args.owner,
-                                    args.scm_template,
-                                    args.dryrun)
-
-        if args.dryrun and not buildinfo:
-            # Minimally fake the buildinfo we would have generated above.
-            (name, version, release) = chacra.name_version_release(nvr)
-            buildinfo = {'name': name, 'version': version, 'release': release}
-        tags = nvrs[nvr]
-        ensure_tagged(buildinfo, tags, session, args.dryrun)
+    if args.shard:
+        (index, count) = args.shard
+        sorted_nvrs = shard_nvrs(sorted_nvrs, index, count)
+        log.info('shard %d/%d has %d builds'
+                 % (index, count, len(sorted_nvrs)))
+
+    if args.only_failed:
+        failed = read_failure_report(args.only_failed)
+        for nvr in sorted(failed - set(sorted_nvrs)):
+            log.warning('%s is no longer in %s' % (nvr, args.directory))
+        sorted_nvrs = [nvr for nvr in sorted_nvrs if nvr in failed]
+        log.info('retrying %d failed builds' % len(sorted_nvrs))
+
+    if args.plan:
+        koji_nvrs = [get_koji_nvr(nvr) for nvr in sorted_nvrs]
+        build_plan = plan.make_plan(nvrs, sorted_nvrs, koji_nvrs, catalog,
+                                    session, args.jobs, throughput)
+        plan.log_summary(build_plan)
+        plan.write_plan(build_plan, args.plan)
+        return
+
+    run_progress = None
+    if not args.dryrun:
+        run_progress = start_progress(sorted_nvrs, catalog, builds, args.jobs)
+
+    def sync(nvr):
+        sync_nvr(nvr, nvrs[nvr], args, rsession, catalog, session,
+                 throughput, leases, builds, limiter)
+
+    try:
+        failures = sync_nvrs(sorted_nvrs, sync, args.keep_going, retries,
+                             lease_wait)
+    finally:
+        if run_progress:
+            run_progress.stop()
+        throughput.save()
+        if builds:
+            builds.save()
+
+    report_failures(args, failures, nvrs)
@@ -0,0 +1,137 @@
+import json
+import misoctl.session
+from misoctl import inheritance
+from misoctl import inventory
+from misoctl.sync_chacra import find_all_nvrs, get_koji_nvr
+from misoctl.log import log as log
+
+
+DESCRIPTION = """
+Show what sync-chacra would change, without changing anything.
+
+This walks a tree of rhcephcompose builds-*.txt files and compares it with
+Koji, using a few bulk queries instead of one query per build. It reports:
+1) builds that are missing from Koji,
+2) builds that are missing from their tags,
+3) builds in those tags that no builds-*.txt file mentions.
+"""
+
+
+def add_parser(subparsers):
+    """
+    Add build parser to this top-level subparsers object.
+    """
+    parser = subparsers.add_parser('sync-status', description=DESCRIPTION,
+                                   help='compare the builds txt files with '
+                                        'Koji')
+    parser.add_argument('--json', metavar='FILE',
+                        help='write the status as JSON to FILE ("-" for '
+                             'stdout)')
+    parser.add_argument('--inventory-max-age', type=int, default=600,
+                        metavar='SECONDS',
+                        help='use the local inventory of debian builds if '
+                             'it is newer than this (defaults to 600). 0 '
+                             'queries Koji directly.')
+    parser.add_argument('directory', nargs='?', default='.',
+                        help="directory tree of build txt files")
+    parser.set_defaults(func=main)
+
+
+def query_koji(koji_nvrs, tags, session, builds=None):
+    """
+    Find which of these builds exist, and everything in these tags.
+
+    :param koji_nvrs: list of Koji build nvrs
+    :param tags: set of tag names
+    :param session: Koji session
+    :param builds: inventory.Inventory, or None to query Koji directly
+    :returns: two-element tuple of the set of existing koji nvrs, and a
+              dict of tag name -> set of koji nvrs
+    """
+    if builds:
+        existing = set(koji_nvr for koji_nvr in koji_nvrs
+                       if builds.get_build(koji_nvr))
+        tagged_nvrs = dict((tag, builds.tagged_nvrs(tag)) for tag in tags)
+        return (existing, tagged_nvrs)
+    buildinfos = misoctl.session.find_builds(koji_nvrs, session)
+    existing = set(koji_nvr for koji_nvr, buildinfo in buildinfos.items()
+                   if buildinfo)
+    return (existing, misoctl.session.find_tagged_nvrs(tags, session))
+
+
+def get_status(nvrs, existing, tagged_nvrs):
+    """
+    Compare the builds txt files with Koji.
+
+    :param nvrs: dict of chacra nvr -> set of tag names, from find_all_nvrs
+    :param existing: set of koji nvrs that exist in Koji
+    :param tagged_nvrs: dict of tag name -> set of koji nvrs in that tag
+    :returns: status dict, suitable for JSON
+    """
+    koji_nvrs = dict((nvr, get_koji_nvr(nvr)) for nvr in nvrs)
+    all_koji_nvrs = set(koji_nvrs.values())
+    missing_builds = sorted(koji_nvr for koji_nvr in all_koji_nvrs
+                            if koji_nvr not in existing)
+    missing_tags = {}
+    for nvr, tags in sorted(nvrs.items()):
+        koji_nvr = koji_nvrs[nvr]
+        for tag in tags:
+            if koji_nvr not in tagged_nvrs[tag]:
+                missing_tags.setdefault(tag, []).append(koji_nvr)
+    extra_tagged = {}
+    for tag, tagged in tagged_nvrs.items():
+        extra = sorted(tagged - all_koji_nvrs)
+        if extra:
+            extra_tagged[tag] = extra
+    return {
+        'missing_builds': missing_builds,
+        'missing_tags': missing_tags,
+        'extra_tagged': extra_tagged,
+        'totals': {
+            'nvrs': len(nvrs),
+            'missing_builds': len(missing_builds),
+            'missing_tags': sum(len(v) for v in missing_tags.values()),
+            'extra_tagged': sum(len(v) for v in extra_tagged.values()),
+        },
+    }
+
+
+def log_status(status):
+    """ Log a human-readable summary of this status. """
+    totals = status['totals']
+    log.info('%(missing_builds)d of %(nvrs)d builds are missing from Koji'
+             % totals)
+    for koji_nvr in status['missing_builds']:
+        log.info('missing build: %s' % koji_nvr)
+    for tag, koji_nvrs in sorted(status['missing_tags'].items()):
+        log.info('%d builds are missing from %s' % (len(koji_nvrs), tag))
+    for tag, koji_nvrs in sorted(status['extra_tagged'].items()):
+        log.info('%d builds in %s are not in any builds txt file: %s'
+                 % (len(koji_nvrs), tag, ' '.join(koji_nvrs)))
+
+
+def main(args):
+    nvrs = find_all_nvrs(args.directory)
+
+    session = misoctl.session.get_session(args.profile)
+    inheritance.prune_nvrs(nvrs, inheritance.TagInheritance(session))
+    tags = set()
+    for tag_names in nvrs.values():
+        tags.update(tag_names)
+    builds = None
+    if args.inventory_max_age:
+        builds = inventory.Inventory(session, max_age=args.inventory_max_age,
+                                     profile=args.profile)
+
+    koji_nvrs = sorted(set(get_koji_nvr(nvr) for nvr in nvrs))
+    (existing, tagged_nvrs) = query_koji(koji_nvrs, tags, session, builds)
+    if builds:
+        builds.save()
+
+    status = get_status(nvrs, existing, tagged_nvrs)
+    log_status(status)
+    if args.json == '-':
+        print(json.dumps(status, indent=2, sort_keys=True))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(status, f, indent=2, sort_keys=True)
@@ -0,0 +1,66 @@
+import pytest
+from misoctl import bundle
+from misoctl import filemanager
+
+
+@pytest.fixture
+def build_dir(tmpdir):
+    """ A build directory with a .dsc, a source tarball and a .build log. """
+    tarball = tmpdir.join('mypackage_1.0.orig.tar.gz')
+    tarball.write('testtarballcontents')
+    tmpdir.join('mypackage_1.0-1.dsc').write(
+        'Format: 3.0 (quilt)\n'
+        'Source: mypackage\n'
+        'Version: 1.0-1\n'
+        'Files:\n'
+        ' %s %d mypackage_1.0.orig.tar.gz\n'
+        % (tarball.computehash('md5'), tarball.size()))
+    tmpdir.join('mypackage_1.0-1_amd64.build').write(
+        'I: pbuilder-time-stamp: 1544000000\n'
+        'I: a line of build output\n'
+        'I: pbuilder-time-stamp: 1544000300\n')
+    return tmpdir
+
+
+def test_write_and_read_bundle(build_dir, tmpdir_factory):
+    bdir = filemanager.BuildDirectory(str(build_dir))
+    (manifest, members) = bundle.get_manifest(bdir, skip_log=False)
+    path = str(tmpdir_factory.mktemp('out').join('mypackage.bundle'))
+    bundle.write_bundle(path, manifest, members)
+
+    result = bundle.Bundle(path)
+    assert result.dsc() == {'Source': 'mypackage', 'Version': '1.0-1'}
+    assert result.manifest['start_time'] == 1544000000
+    assert result.manifest['end_time'] == 1544000300
+    contents = dict((entry['name'], f.read())
+                    for entry, f in result.members())
+    assert sorted(contents) == ['mypackage_1.0-1.dsc',
+                                'mypackage_1.0-1_amd64.log',
+                                'mypackage_1.0.orig.tar.gz']
+    assert contents['mypackage_1.0.orig.tar.gz'] == b'testtarballcontents'
+    tarball = build_dir.join('mypackage_1.0.orig.tar.gz')
+    entry = result.manifest['files'][1]
+    assert entry['md5'] == tarball.computehash('md5')
+    assert entry['sha512'] == tarball.computehash('sha512')
+
+
+def test_get_manifest_md5_mismatch(build_dir):
+    build_dir.join('mypackage_1.0.orig.tar.gz').write('corrupted')
+    bdir = filemanager.BuildDirectory(str(build_dir))
+    with pytest.raises(RuntimeError):
+        bundle.get_manifest(bdir, skip_log=False)
+
+
+def test_not_a_bundle(tmpdir):
+    path = tmpdir.join('mypackage_1.0-1.dsc')
+    path.write('Source: mypackage\n')
+    with pytest.raises(bundle.BundleFormatError):
+        bundle.Bundle(str(path))
+
+
+def test_hash_file_not_a_deb(tmpdir):
+    path = tmpdir.join('mypackage_1.0-1_amd64.deb')
+    path.write('not a deb file')
+    entry = bundle.hash_file(str(path))
+    assert entry['size'] == len('not a deb file')
+    assert entry['control'] == {}
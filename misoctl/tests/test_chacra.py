@@ -1,3 +1,4 @@
+from hashlib import sha512
 import pytest
 from misoctl import chacra
 
@@ -50,3 +51,264 @@ def test_verify_checksum_fails(pkg_file):
     checksum = 'f00badlolz'
     filename = str(pkg_file)
     assert not chacra.verify_checksum(filename, checksum)
+
+
+class FakeResponse(object):
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError('HTTP %d' % self.status_code)
+
+    def json(self):
+        return self.payload
+
+
+class FakeSession(object):
+    """ Serve canned Chacra responses, and record each GET. """
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, params=None, **kwargs):
+        self.requests.append(url)
+        if url not in self.responses:
+            return FakeResponse({}, 404)
+        return FakeResponse(self.responses[url])
+
+
+SEARCH_RESULTS = [
+    {'project': 'ceph', 'ref': '1.2-1', 'arch': 'source',
+     'name': 'ceph_1.2-1.dsc', 'checksum': 'aaa', 'size': 100},
+    {'project': 'ceph', 'ref': '1.2-1', 'arch': 'amd64',
+     'name': 'ceph_1.2-1_amd64.deb', 'checksum': 'bbb', 'size': 200},
+    {'project': 'ceph', 'ref': '1.3-1', 'arch': 'source',
+     'name': 'ceph_1.3-1.dsc', 'checksum': 'ccc', 'size': 300},
+    {'project': 'ceph-deploy', 'ref': '1.2-1', 'arch': 'source',
+     'name': 'ceph-deploy_1.2-1.dsc', 'checksum': 'ddd', 'size': 400},
+]
+
+
+def test_catalog_search():
+    session = FakeSession({'https://chacra/search/': SEARCH_RESULTS})
+    catalog = chacra.ChacraCatalog('https://chacra/', session)
+    assert catalog.exists('ceph_1.2-1')
+    assert catalog.exists('ceph_1.3-1')
+    assert not catalog.exists('ceph_1.4-1')
+    assert catalog.checksum('ceph_1.2-1', 'ceph_1.2-1_amd64.deb') == 'bbb'
+    assert catalog.checksum('ceph_1.2-1', 'ceph_1.3-1.dsc') is None
+    assert catalog.size('ceph_1.2-1') == 300
+    # One search for all the ceph versions, and one listing to confirm
+    # that 1.4-1 is missing.
+    assert session.requests == [
+        'https://chacra/search/',
+        'https://chacra/binaries/ceph/1.4-1/ubuntu/all',
+    ]
+
+
+def test_catalog_search_needs_project():
+    results = [dict(binary) for binary in SEARCH_RESULTS]
+    del results[0]['project']
+    session = FakeSession({'https://chacra/search/': results})
+    catalog = chacra.ChacraCatalog('https://chacra/', session)
+    assert catalog.checksum('ceph_1.2-1', 'ceph_1.2-1.dsc') is None
+    assert catalog.checksum('ceph_1.2-1', 'ceph_1.2-1_amd64.deb') == 'bbb'
+
+
+def test_catalog_search_misses_version():
+    build_url = 'https://chacra/binaries/ceph/1.4-1/ubuntu/all'
+    session = FakeSession({
+        'https://chacra/search/': [],
+        build_url: {'source': ['ceph_1.4-1.dsc']},
+        build_url + '/source': {'ceph_1.4-1.dsc': {'checksum': 'eee',
+                                                   'size': 500}},
+    })
+    catalog = chacra.ChacraCatalog('https://chacra/', session)
+    assert catalog.checksum('ceph_1.4-1', 'ceph_1.4-1.dsc') == 'eee'
+    assert catalog.use_search
+
+
+def test_catalog_listing_fallback():
+    build_url = 'https://chacra/binaries/ceph/1.2-1/ubuntu/all'
+    session = FakeSession({
+        build_url: {'source': ['ceph_1.2-1.dsc']},
+        build_url + '/source': {'ceph_1.2-1.dsc': {'checksum': 'aaa',
+                                                   'size': 100}},
+    })
+    catalog = chacra.ChacraCatalog('https://chacra/', session)
+    assert catalog.checksum('ceph_1.2-1', 'ceph_1.2-1.dsc') == 'aaa'
+    assert catalog.exists('ceph_1.2-1')
+    assert not catalog.exists('ceph_1.3-1')
+    assert not catalog.use_search
+    assert session.requests.count(build_url) == 1
+
+
+class FakeStreamSession(object):
+    def __init__(self, contents):
+        self.contents = contents
+
+    def get(self, url, stream=False):
+        response = FakeResponse(None)
+        response.iter_content = lambda size: [self.contents]
+        return response
+
+
+def test_download_file(tmpdir):
+    checksum = 'cce64bfb35285d9c5d82e0a083cafcc6afa3292b84b26f567d92ea8ccd420e57881c9218e718c73a2ce23af53ad05ab54f168cd28ee1b5ca7ca23697fa887e1e'  # NOQA: E501
+    output_path = str(tmpdir.join('mypackage_1.0-1.deb'))
+    session = FakeStreamSession(b'testpackagecontents')
+    chacra.download_file('https://chacra/', output_path, checksum, session)
+    assert chacra.verify_checksum(output_path, checksum)
+
+
+class FakeRangeSession(object):
+    """ Serve byte ranges of contents, unless ranges is False. """
+    def __init__(self, contents, ranges=True):
+        self.contents = contents
+        self.ranges = ranges
+        self.requests = []
+
+    def get(self, url, stream=False, headers=None):
+        self.requests.append(headers)
+        data = self.contents
+        status_code = 200
+        if self.ranges and headers and 'Range' in headers:
+            (start, end) = headers['Range'][len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1]
+            status_code = 206
+        response = FakeResponse(None, status_code)
+        response.url = url
+        response.iter_content = lambda size: [data[i:i + size]
+                                              for i in range(0, len(data),
+                                                             size)]
+        response.close = lambda: None
+        return response
+
+
+def test_segment_bounds():
+    assert chacra.segment_bounds(10, 4) == [(0, 2), (3, 5), (6, 8), (9, 9)]
+    assert chacra.segment_bounds(8, 4) == [(0, 1), (2, 3), (4, 5), (6, 7)]
+
+
+def test_download_file_segments(tmpdir, monkeypatch):
+    monkeypatch.setattr(chacra, 'SEGMENT_THRESHOLD', 10)
+    contents = b'testpackagecontents' * 10000
+    checksum = sha512(contents).hexdigest()
+    output_path = str(tmpdir.join('mypackage_1.0-1.deb'))
+    session = FakeRangeSession(contents)
+    chacra.download_file('https://chacra/', output_path, checksum, session,
+                         size=len(contents))
+    assert tmpdir.join('mypackage_1.0-1.deb').read_binary() == contents
+    assert len(session.requests) == chacra.SEGMENTS
+
+
+def test_download_file_segments_no_ranges(tmpdir, monkeypatch):
+    monkeypatch.setattr(chacra, 'SEGMENT_THRESHOLD', 10)
+    contents = b'testpackagecontents' * 10000
+    checksum = sha512(contents).hexdigest()
+    output_path = str(tmpdir.join('mypackage_1.0-1.deb'))
+    session = FakeRangeSession(contents, ranges=False)
+    chacra.download_file('https://chacra/', output_path, checksum, session,
+                         size=len(contents))
+    assert tmpdir.join('mypackage_1.0-1.deb').read_binary() == contents
+    # One Range request, then one plain GET.
+    assert len(session.requests) == 2
+
+
+def test_download_file_mismatch(tmpdir):
+    output_path = str(tmpdir.join('mypackage_1.0-1.deb'))
+    session = FakeStreamSession(b'corruptedcontents')
+    with pytest.raises(RuntimeError):
+        chacra.download_file('https://chacra/', output_path, 'f00badlolz',
+                             session)
+    assert not tmpdir.join('mypackage_1.0-1.deb').exists()
+
+
+class FakeMirrorSession(object):
+    """ Serve contents from each mirror, or fail like a broken server. """
+    def __init__(self, mirrors):
+        self.mirrors = mirrors
+        self.requests = []
+
+    def get(self, url, stream=False, headers=None, **kwargs):
+        self.requests.append(url)
+        for base, contents in self.mirrors.items():
+            if url.startswith(base):
+                break
+        if contents is None:
+            response = FakeResponse(None, 503)
+        else:
+            response = FakeResponse({'ok': True})
+            response.iter_content = lambda size: [contents]
+        response.url = url
+        return response
+
+
+def test_mirror_pool_fails_over():
+    pool = chacra.MirrorPool(['https://a/', 'https://b/'])
+    session = FakeMirrorSession({'https://a/': None, 'https://b/': b'x'})
+    response = pool.get(session, 'search/')
+    assert response.json() == {'ok': True}
+    assert session.requests == ['https://a/search/', 'https://b/search/']
+    # Mirror "a" sits out for a while now.
+    session.requests = []
+    pool.get(session, 'search/')
+    assert session.requests == ['https://b/search/']
+
+
+def test_mirror_pool_prefers_fast_mirror():
+    pool = chacra.MirrorPool(['https://a/', 'https://b/'])
+    (a, b) = pool.mirrors
+    pool.release(pool.choose(exclude=[b]), True, 2.0)
+    pool.release(pool.choose(exclude=[a]), True, 0.1)
+    assert pool.choose() is b
+    # With one request in flight on "b", another still goes there.
+    assert pool.choose() is b
+
+
+def test_download_from_mirrors_bad_checksum(tmpdir):
+    contents = b'testpackagecontents'
+    metadata = {'checksum': sha512(contents).hexdigest(),
+                'size': len(contents)}
+    pool = chacra.MirrorPool(['https://a/', 'https://b/'])
+    session = FakeMirrorSession({'https://a/': b'corrupted',
+                                 'https://b/': contents})
+    output_path = str(tmpdir.join('mypackage_1.0-1.deb'))
+    chacra.download_from_mirrors('binaries/mypackage/1.0-1/', output_path,
+                                 metadata, session, pool)
+    assert tmpdir.join('mypackage_1.0-1.deb').read_binary() == contents
+    assert pool.mirrors[0].failures == 1
+
+
+@pytest.mark.parametrize('url,stream,expected', (
+    ('https://chacra.example.com/search/', False, 'search'),
+    ('https://chacra.example.com/binaries/ceph/', False, 'GET 2'),
+    ('https://chacra.example.com/binaries/ceph/12.2.8/', False, 'GET 3'),
+    ('https://chacra.example.com/binaries/ceph/a.deb', True, 'download'),
+))
+def test_request_kind(url, stream, expected):
+    assert chacra.request_kind('GET', url, stream) == expected
+
+
+def test_download_from_mirrors_bad_segment(tmpdir, monkeypatch):
+    monkeypatch.setattr(chacra, 'SEGMENT_THRESHOLD', 10)
+    contents = b'testpackagecontents' * 10000
+    metadata = {'checksum': sha512(contents).hexdigest(),
+                'size': len(contents)}
+    pool = chacra.MirrorPool(['https://a/', 'https://b/'])
+    sessions = {'https://a/': FakeRangeSession(contents),
+                'https://b/': FakeRangeSession(b'x' * len(contents))}
+
+    class Session(object):
+        def get(self, url, **kwargs):
+            return sessions[url[:len('https://a/')]].get(url, **kwargs)
+    output_path = str(tmpdir.join('mypackage_1.0-1.deb'))
+    chacra.download_from_mirrors('binaries/mypackage/1.0-1/', output_path,
+                                 metadata, Session(), pool)
+    assert tmpdir.join('mypackage_1.0-1.deb').read_binary() == contents
+    (a, b) = pool.mirrors
+    # We retried from "a" alone, and only blamed "b".
+    assert (a.failures, b.failures) == (0, 1)
+    assert (a.in_flight, b.in_flight) == (0, 0)
@@ -0,0 +1,97 @@
+from io import BytesIO
+import sys
+import tarfile
+import pytest
+from misoctl import debfile
+from misoctl import util
+
+
+CONTROL = b'''Package: mypackage
+Version: 1.0-1
+Architecture: amd64
+Maintainer: Example <example@example.com>
+Depends: libc6 (>= 2.14), python
+Description: a test package
+'''
+
+
+def tar_bytes(files, mode):
+    """ Return the bytes of a tar archive with these files. """
+    buf = BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as tar:
+        for name, contents in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            tar.addfile(info, BytesIO(contents))
+    return buf.getvalue()
+
+
+def ar_member(name, contents):
+    fields = (name, 0, 0, 0, '100644', len(contents))
+    header = '%-16s%-12d%-6d%-6d%-8s%-10d`\n' % fields
+    member = header.encode('ascii') + contents
+    if len(contents) % 2:
+        member += b'\n'
+    return member
+
+
+@pytest.fixture(params=['gz', 'xz'])
+def deb_file(tmpdir, request):
+    """ A small .deb file on local disk. """
+    control_tar = tar_bytes({'./control': CONTROL}, 'w:' + request.param)
+    # An odd-sized data member, to test ar padding.
+    data_tar = tar_bytes({'./usr/bin/hello': b'x' * 12345}, 'w:xz') + b'!'
+    contents = (debfile.AR_MAGIC +
+                ar_member('debian-binary', b'2.0\n') +
+                ar_member('control.tar.' + request.param, control_tar) +
+                ar_member('data.tar.xz', data_tar))
+    local_file = tmpdir.join('mypackage_1.0-1_amd64.deb')
+    local_file.write_binary(contents)
+    return str(local_file)
+
+
+EXPECTED = {
+    'package': 'mypackage',
+    'version': '1.0-1',
+    'architecture': 'amd64',
+    'depends': 'libc6 (>= 2.14), python',
+}
+
+
+def test_read_control(deb_file):
+    assert debfile.read_control(deb_file) == EXPECTED
+
+
+def test_get_md5sum_and_control(deb_file, monkeypatch):
+    # Feed the reader small chunks, so headers span chunk boundaries.
+    monkeypatch.setattr(debfile, 'CHUNK_SIZE', 7)
+    (checksum, control) = debfile.get_md5sum_and_control(deb_file)
+    assert checksum == util.get_md5sum(deb_file)
+    assert control == EXPECTED
+
+
+def test_not_a_deb(tmpdir):
+    local_file = tmpdir.join('mypackage_1.0-1_amd64.deb')
+    local_file.write('not a deb file')
+    with pytest.raises(debfile.DebFormatError):
+        debfile.read_control(str(local_file))
+
+
+def test_corrupt_control_tar(tmpdir):
+    control_tar = tar_bytes({'./control': CONTROL}, 'w:gz')[:40]
+    contents = (debfile.AR_MAGIC +
+                ar_member('debian-binary', b'2.0\n') +
+                ar_member('control.tar.gz', control_tar))
+    local_file = tmpdir.join('mypackage_1.0-1_amd64.deb')
+    local_file.write_binary(contents)
+    assert debfile.read_control(str(local_file)) == {}
+
+
+def test_decompress_xz_command(monkeypatch):
+    data = tar_bytes({'./control': CONTROL}, 'w:xz')
+    # Python 2 has neither lzma nor tarfile xz support.
+    monkeypatch.setitem(sys.modules, 'lzma', None)
+    monkeypatch.setitem(sys.modules, 'backports', None)
+    result = debfile.decompress_xz('control.tar.xz', data)
+    with tarfile.open(fileobj=BytesIO(result), mode='r:') as tar:
+        assert tar.extractfile('./control').read() == CONTROL
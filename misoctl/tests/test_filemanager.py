@@ -1,3 +1,4 @@
+import pytest
 from misoctl import filemanager
 
 
@@ -15,3 +16,116 @@ def test_find_deb_files(tmpdir):
     expected = set([str(debfile)])
     directory = str(tmpdir)
     return filemanager.find_deb_files(directory) == expected
+
+
+def write_pbuilder_log(tmpdir, stamps, padding=0):
+    """ Write a pbuilder log with build output between the time stamps. """
+    log_file = tmpdir.join('mypackage_1.0-1_amd64.build')
+    filler = 'I: a line of build output\n' * (padding // 26)
+    lines = ['I: pbuilder: network access will be disabled\n']
+    for stamp in stamps:
+        lines.append('I: pbuilder-time-stamp: %d\n' % stamp)
+        lines.append(filler)
+    lines[-1] = 'I: unmounting dev filesystem\n'
+    log_file.write(''.join(lines))
+    return str(log_file)
+
+
+def test_get_build_times(tmpdir):
+    log_file = write_pbuilder_log(tmpdir, [1544000000, 1544000300])
+    result = filemanager.get_build_times(log_file)
+    assert result == (1544000000, 1544000300)
+
+
+def test_get_build_times_large_log(tmpdir):
+    log_file = write_pbuilder_log(tmpdir, [1544000000, 1544000300],
+                                  padding=2 * 1024 * 1024)
+    result = filemanager.get_build_times(log_file)
+    assert result == (1544000000, 1544000300)
+
+
+def test_get_build_times_no_trailing_newline(tmpdir):
+    log_file = tmpdir.join('mypackage_1.0-1_amd64.build')
+    log_file.write('I: pbuilder-time-stamp: 1544000000\n' +
+                   'I: a line of build output\n' * 100000 +
+                   'I: pbuilder-time-stamp: 1544000300')
+    result = filemanager.get_build_times(str(log_file))
+    assert result == (1544000000, 1544000300)
+
+
+def test_get_build_times_missing_end(tmpdir):
+    log_file = write_pbuilder_log(tmpdir, [1544000000],
+                                  padding=2 * 1024 * 1024)
+    with pytest.raises(RuntimeError):
+        filemanager.get_build_times(log_file)
+
+
+def test_get_build_times_strict(tmpdir):
+    stamps = [1544000000, 1544000100, 1544000300]
+    log_file = write_pbuilder_log(tmpdir, stamps)
+    assert filemanager.get_build_times(log_file) == (1544000000, 1544000300)
+    with pytest.raises(RuntimeError):
+        filemanager.get_build_times(log_file, strict=True)
+
+
+@pytest.fixture
+def build_dir(tmpdir):
+    """ A directory of build artifacts, with a .dsc that lists a tarball """
+    tarball = tmpdir.join('mypackage_1.0.orig.tar.gz')
+    tarball.write('testtarballcontents')
+    md5sum = tarball.computehash('md5')
+    tmpdir.join('mypackage_1.0-1.dsc').write(
+        'Format: 3.0 (quilt)\n'
+        'Source: mypackage\n'
+        'Version: 1.0-1\n'
+        'Files:\n'
+        ' %s %d mypackage_1.0.orig.tar.gz\n' % (md5sum, tarball.size()))
+    tmpdir.join('mypackage_1.0-1_amd64.deb').write('testpackagecontents')
+    tmpdir.join('.hidden.deb').write('not a package')
+    tmpdir.mkdir('subdir.deb')
+    return tmpdir
+
+
+def test_build_directory(build_dir):
+    bdir = filemanager.BuildDirectory(str(build_dir))
+    assert bdir.dsc_file() == str(build_dir.join('mypackage_1.0-1.dsc'))
+    assert bdir.deb_files() == \
+        set([str(build_dir.join('mypackage_1.0-1_amd64.deb'))])
+    assert bdir.log_file(fatal=False) is None
+    with pytest.raises(filemanager.NoFilesFoundError):
+        bdir.changes_file()
+    assert bdir.dsc()['Source'] == 'mypackage'
+
+
+def test_build_directory_hashes_once(build_dir, monkeypatch):
+    calls = []
+
+    def get_md5sum(path):
+        calls.append(path)
+        return real_get_md5sum(path)
+    real_get_md5sum = filemanager.util.get_md5sum
+    monkeypatch.setattr(filemanager.util, 'get_md5sum', get_md5sum)
+    bdir = filemanager.BuildDirectory(str(build_dir))
+    tarball = str(build_dir.join('mypackage_1.0.orig.tar.gz'))
+    assert bdir.source_files() == set([tarball])
+    assert bdir.md5sum(tarball) == build_dir.join(
+        'mypackage_1.0.orig.tar.gz').computehash('md5')
+    assert bdir.size(tarball) == len('testtarballcontents')
+    assert calls == [tarball]
+
+
+def test_build_directory_md5_mismatch(build_dir):
+    build_dir.join('mypackage_1.0.orig.tar.gz').write('corrupted')
+    bdir = filemanager.BuildDirectory(str(build_dir))
+    with pytest.raises(RuntimeError):
+        bdir.source_files()
+
+
+def test_build_directory_record_mismatch(build_dir):
+    bdir = filemanager.BuildDirectory(str(build_dir))
+    bdir.source_files(verify=False)
+    tarball = str(build_dir.join('mypackage_1.0.orig.tar.gz'))
+    digest = filemanager.StreamDigest(tarball)
+    digest.update(b'corrupted')
+    with pytest.raises(filemanager.DscMismatchError):
+        bdir.record(tarball, digest)
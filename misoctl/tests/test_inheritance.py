@@ -0,0 +1,93 @@
+from misoctl import inheritance
+
+
+class FakeKojiSession(object):
+    """ Answer getFullInheritance and getPackageConfig multicalls. """
+    def __init__(self, inheritance, blocked=()):
+        self.inheritance = inheritance
+        self.blocked = blocked
+        self.multicall = False
+        self.calls = []
+
+    def getFullInheritance(self, tag):
+        self.calls.append(self.inheritance.get(tag, []))
+
+    def getPackageConfig(self, tag, package):
+        self.calls.append({'blocked': (tag, package) in self.blocked})
+
+    def multiCall(self, strict=False):
+        self.multicall = False
+        results = [[result] for result in self.calls]
+        self.calls = []
+        return results
+
+
+INHERITANCE = {
+    'ceph-3.2-xenial-hotfix': [{'name': 'ceph-3.2-xenial'}],
+    'ceph-3.2-xenial-override': [{'name': 'ceph-3.2-xenial-hotfix'},
+                                 {'name': 'ceph-3.2-xenial'}],
+    'ceph-3.2-xenial-candidate': [{'name': 'ceph-3.2-xenial',
+                                   'pkg_filter': '^ceph-ansible'}],
+}
+
+
+def test_prune():
+    tag_inheritance = inheritance.TagInheritance(FakeKojiSession(INHERITANCE))
+    tags = set(['ceph-3.2-xenial-hotfix', 'ceph-3.2-xenial-override'])
+    result = tag_inheritance.prune(tags, 'ceph-deb')
+    assert result == set(['ceph-3.2-xenial-hotfix'])
+
+
+def test_prune_package_filter():
+    tag_inheritance = inheritance.TagInheritance(FakeKojiSession(INHERITANCE))
+    tags = set(['ceph-3.2-xenial', 'ceph-3.2-xenial-candidate'])
+    assert tag_inheritance.prune(tags, 'ceph-deb') == tags
+    result = tag_inheritance.prune(tags, 'ceph-ansible-deb')
+    assert result == set(['ceph-3.2-xenial'])
+
+
+def test_prune_blocked():
+    blocked = [('ceph-3.2-xenial-override', 'ceph-deb')]
+    session = FakeKojiSession(INHERITANCE, blocked)
+    tag_inheritance = inheritance.TagInheritance(session)
+    tags = set(['ceph-3.2-xenial-hotfix', 'ceph-3.2-xenial-override'])
+    assert tag_inheritance.prune(tags, 'ceph-deb') == tags
+
+
+def test_prune_cycle():
+    cycle = {
+        'ceph-3.2-xenial': [{'name': 'ceph-3.2-xenial-hotfix'}],
+        'ceph-3.2-xenial-hotfix': [{'name': 'ceph-3.2-xenial'}],
+        'ceph-3.2-xenial-override': [{'name': 'ceph-3.2-xenial-hotfix'},
+                                     {'name': 'ceph-3.2-xenial'}],
+    }
+    tag_inheritance = inheritance.TagInheritance(FakeKojiSession(cycle))
+    tags = set(cycle)
+    assert tag_inheritance.prune(tags, 'ceph-deb') == set(['ceph-3.2-xenial'])
+
+
+def test_reset():
+    tag_inheritance = inheritance.TagInheritance(FakeKojiSession(INHERITANCE))
+    tags = set(['ceph-3.2-xenial-hotfix', 'ceph-3.2-xenial-override'])
+    tag_inheritance.prune(tags, 'ceph-deb')
+    tag_inheritance.session.inheritance = {}
+    tag_inheritance.reset()
+    assert tag_inheritance.prune(tags, 'ceph-deb') == tags
+
+
+def test_prune_nvrs():
+    session = FakeKojiSession(INHERITANCE)
+    tag_inheritance = inheritance.TagInheritance(session)
+    nvrs = {
+        'ceph_12.2.8-1': set(['ceph-3.2-xenial-hotfix',
+                              'ceph-3.2-xenial-override']),
+        'ceph_12.2.8-2': set(['ceph-3.2-xenial-override']),
+    }
+    inheritance.prune_nvrs(nvrs, tag_inheritance)
+    assert nvrs == {
+        'ceph_12.2.8-1': set(['ceph-3.2-xenial-hotfix']),
+        'ceph_12.2.8-2': set(['ceph-3.2-xenial-override']),
+    }
+    # We fetched each tag's inheritance once.
+    assert sorted(tag_inheritance.parents) == ['ceph-3.2-xenial-hotfix',
+                                               'ceph-3.2-xenial-override']
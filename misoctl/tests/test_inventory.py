@@ -0,0 +1,110 @@
+import json
+from misoctl.inventory import Inventory
+
+
+def build(name, version, release, build_id):
+    return {'build_id': build_id, 'name': name, 'version': version,
+            'release': release,
+            'nvr': '%s-%s-%s' % (name, version, release)}
+
+
+class FakeKojiSession(object):
+    def __init__(self):
+        self.event = {'id': 100, 'ts': 1544000000.0}
+        self.builds = [build('ceph-deb', '12.2.8', '1', 1)]
+        self.tagged = {'ceph-3.2-xenial': ['ceph-deb-12.2.8-1']}
+        self.history = []
+        self.calls = []
+
+    def getLastEvent(self):
+        self.calls.append('getLastEvent')
+        return self.event
+
+    def listBuilds(self, type=None, state=None, createdAfter=None):
+        self.calls.append('listBuilds')
+        assert type == 'debian'
+        return self.builds
+
+    def listTagged(self, tag, type=None, event=None):
+        self.calls.append('listTagged')
+        return [{'nvr': nvr} for nvr in self.tagged[tag]]
+
+    def queryHistory(self, tables=None, afterEvent=None):
+        self.calls.append('queryHistory')
+        return {'tag_listing': self.history}
+
+
+def test_full_refresh(tmpdir):
+    session = FakeKojiSession()
+    path = str(tmpdir.join('inventory.json'))
+    builds = Inventory(session, path)
+    assert builds.get_build('ceph-deb-12.2.8-1')['id'] == 1
+    assert builds.get_build('ceph-deb-12.2.9-1') is None
+    assert 'ceph-deb-12.2.8-1' in builds.tagged_nvrs('ceph-3.2-xenial')
+    # We only asked Koji once for each thing.
+    assert session.calls == ['getLastEvent', 'listBuilds', 'listTagged']
+
+
+def test_save_and_load(tmpdir):
+    session = FakeKojiSession()
+    path = str(tmpdir.join('inventory.json'))
+    builds = Inventory(session, path)
+    builds.tagged_nvrs('ceph-3.2-xenial')
+    builds.save()
+    with open(path) as f:
+        assert json.load(f)['event_id'] == 100
+    session.calls = []
+    builds = Inventory(session, path)
+    assert builds.get_build('ceph-deb-12.2.8-1')
+    assert builds.tagged_nvrs('ceph-3.2-xenial') == set(['ceph-deb-12.2.8-1'])
+    # The saved inventory is fresh enough.
+    assert session.calls == []
+
+
+def test_incremental_refresh(tmpdir):
+    session = FakeKojiSession()
+    path = str(tmpdir.join('inventory.json'))
+    builds = Inventory(session, path, max_age=60)
+    builds.tagged_nvrs('ceph-3.2-xenial')
+    # Pretend that this inventory is old now.
+    builds.refreshed -= 120
+    session.event = {'id': 200, 'ts': 1544001000.0}
+    session.builds = [build('ceph-deb', '12.2.9', '1', 2)]
+    session.history = [
+        {'tag.name': 'ceph-3.2-xenial', 'active': None,
+         'name': 'ceph-deb', 'version': '12.2.8', 'release': '1'},
+        {'tag.name': 'ceph-3.2-xenial', 'active': True,
+         'name': 'ceph-deb', 'version': '12.2.9', 'release': '1'},
+        {'tag.name': 'ceph-3.2-bionic', 'active': True,
+         'name': 'ceph-deb', 'version': '12.2.9', 'release': '1'},
+    ]
+    session.calls = []
+    assert builds.get_build('ceph-deb-12.2.9-1')['id'] == 2
+    assert builds.get_build('ceph-deb-12.2.8-1')
+    assert builds.tagged_nvrs('ceph-3.2-xenial') == set(['ceph-deb-12.2.9-1'])
+    assert builds.event_id == 200
+    assert session.calls == ['getLastEvent', 'listBuilds', 'queryHistory']
+
+
+def test_add_tagged(tmpdir):
+    session = FakeKojiSession()
+    builds = Inventory(session, str(tmpdir.join('inventory.json')))
+    builds.tagged_nvrs('ceph-3.2-xenial')
+    builds.add_build(build('ceph-deb', '12.2.9', '1', 2))
+    builds.add_tagged('ceph-3.2-xenial', 'ceph-deb-12.2.9-1')
+    assert builds.get_build('ceph-deb-12.2.9-1')['id'] == 2
+    assert 'ceph-deb-12.2.9-1' in builds.tagged_nvrs('ceph-3.2-xenial')
+
+
+def test_cache_per_profile(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    session = FakeKojiSession()
+    builds = Inventory(session, profile='koji')
+    builds.tagged_nvrs('ceph-3.2-xenial')
+    builds.save()
+    session.calls = []
+    other = Inventory(session, profile='stg')
+    assert other.path != builds.path
+    # We did not load the first hub's builds or event.
+    assert other.event_id is None
+    assert other.builds == {}
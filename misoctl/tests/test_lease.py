@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+import time
+import pytest
+from misoctl import lease
+
+
+@pytest.fixture
+def leases(tmpdir):
+    return lease.LeaseDirectory(str(tmpdir.join('leases')), 3600)
+
+
+def write_holder(leases, name, **holder):
+    with open(leases.path(name), 'w') as f:
+        json.dump(holder, f)
+
+
+def test_acquire_release(leases):
+    leases.acquire('ceph-deb-1.2-1')
+    assert leases.read('ceph-deb-1.2-1')['pid'] == leases.pid
+    leases.release('ceph-deb-1.2-1')
+    assert leases.read('ceph-deb-1.2-1') is None
+
+
+def test_held_by_other_host(leases):
+    write_holder(leases, 'ceph-deb-1.2-1', host='otherhost', pid=1,
+                 expires=time.time() + 60)
+    with pytest.raises(lease.LeaseHeldError):
+        leases.acquire('ceph-deb-1.2-1')
+
+
+def test_expired(leases):
+    write_holder(leases, 'ceph-deb-1.2-1', host='otherhost', pid=1,
+                 expires=time.time() - 60)
+    leases.acquire('ceph-deb-1.2-1')
+    assert leases.read('ceph-deb-1.2-1')['host'] == leases.host
+
+
+def test_dead_local_process(leases):
+    # Process ids wrap long before this.
+    write_holder(leases, 'ceph-deb-1.2-1', host=leases.host, pid=2 ** 30,
+                 expires=time.time() + 60)
+    leases.acquire('ceph-deb-1.2-1')
+    assert leases.read('ceph-deb-1.2-1')['pid'] == leases.pid
+
+
+def test_release_other_holder(leases):
+    write_holder(leases, 'ceph-deb-1.2-1', host='otherhost', pid=1,
+                 expires=time.time() + 60)
+    leases.release('ceph-deb-1.2-1')
+    assert leases.read('ceph-deb-1.2-1')['host'] == 'otherhost'
+
+
+def test_heartbeat_renews(tmpdir):
+    leases = lease.LeaseDirectory(str(tmpdir.join('leases')), 0.2)
+    leases.acquire('ceph-deb-1.2-1')
+    try:
+        first = leases.read('ceph-deb-1.2-1')['expires']
+        time.sleep(0.3)
+        assert leases.read('ceph-deb-1.2-1')['expires'] > first
+        leases.release('ceph-deb-1.2-1')
+        assert leases.held == set()
+    finally:
+        leases.close()
+
+
+def test_renew_waits_for_release(leases):
+    leases.acquire('ceph-deb-1.2-1')
+    leases.close()
+    renewed = []
+
+    def renew():
+        leases.renew('ceph-deb-1.2-1')
+        renewed.append(leases.read('ceph-deb-1.2-1'))
+    # Hold the lock as release() would, and renew from another thread.
+    with leases.lock():
+        thread = threading.Thread(target=renew)
+        thread.start()
+        thread.join(0.1)
+        assert renewed == []
+        leases.held.discard('ceph-deb-1.2-1')
+        os.unlink(leases.path('ceph-deb-1.2-1'))
+    thread.join()
+    # The renewal did not write the released lease back.
+    assert renewed == [None]
@@ -0,0 +1,49 @@
+import pytest
+from misoctl import metrics
+
+
+@pytest.mark.parametrize('url,expected', (
+    ('https://chacra/search/?project=ceph', 'search'),
+    ('https://chacra/binaries/ceph/1.2-1/ubuntu/all', 'listing'),
+    ('https://chacra/binaries/ceph/1.2-1/ubuntu/all/amd64', 'metadata'),
+    ('https://chacra/binaries/ceph/1.2-1/ubuntu/all/amd64/ceph.deb/',
+     'binary'),
+    ('https://chacra/', 'other'),
+))
+def test_chacra_endpoint(url, expected):
+    assert metrics.chacra_endpoint(url) == expected
+
+
+def test_render():
+    m = metrics.Metrics()
+    m.labels = {'subcommand': 'sync-chacra'}
+    m.inc('misoctl_downloaded_bytes_total', 100)
+    m.inc('misoctl_downloaded_bytes_total', 50)
+    m.observe('misoctl_koji_call_seconds', 0.2, method='getBuild')
+    m.observe('misoctl_koji_call_seconds', 3, method='getBuild')
+    lines = m.render().splitlines()
+    assert '# TYPE misoctl_downloaded_bytes_total counter' in lines
+    assert 'misoctl_downloaded_bytes_total{subcommand="sync-chacra"} 150.0' \
+        in lines
+    assert 'misoctl_koji_call_seconds_bucket{le="0.25",method="getBuild",' \
+        'subcommand="sync-chacra"} 1' in lines
+    assert 'misoctl_koji_call_seconds_bucket{le="+Inf",method="getBuild",' \
+        'subcommand="sync-chacra"} 2' in lines
+    assert 'misoctl_koji_call_seconds_count{method="getBuild",' \
+        'subcommand="sync-chacra"} 2' in lines
+
+
+def test_unknown_metric():
+    m = metrics.Metrics()
+    with pytest.raises(ValueError):
+        m.inc('misoctl_bogus_total')
+
+
+def test_write(tmpdir):
+    path = tmpdir.join('misoctl.prom')
+    m = metrics.Metrics()
+    m.configure(str(path), interval=0, profile='koji')
+    m.inc('misoctl_nvrs_processed_total')
+    m.write()
+    assert 'misoctl_nvrs_processed_total{profile="koji"} 1.0' in \
+        path.read().splitlines()
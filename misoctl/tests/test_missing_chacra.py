@@ -0,0 +1,53 @@
+import pytest
+from debian import deb822
+from misoctl import chacra
+from misoctl import missing_chacra
+
+
+SHA512 = 'f' * 128
+
+DSC = '''Format: 3.0 (quilt)
+Source: mypackage
+Version: 1.0-1
+Files:
+ e04a72f793a87ba9e1b48000044a5e2b 1000 mypackage_1.0.orig.tar.gz
+ e04a72f793a87ba9e1b48000044a5e2b 2000 mypackage_1.0-1.debian.tar.xz
+Checksums-Sha512:
+ %s 1000 mypackage_1.0.orig.tar.gz
+''' % SHA512
+
+
+@pytest.fixture
+def catalog():
+    catalog = chacra.ChacraCatalog('https://chacra/', None)
+    catalog.add('mypackage_1.0-1', {
+        'source': {
+            'mypackage_1.0.orig.tar.gz': {'checksum': SHA512, 'size': 1000},
+            'mypackage_1.0-1.debian.tar.xz': {'checksum': 'a' * 128,
+                                              'size': 2000},
+        },
+    })
+    return catalog
+
+
+def test_verify_files(catalog):
+    dsc = deb822.Dsc(DSC)
+    missing_chacra.verify_files('mypackage_1.0-1', dsc, catalog)
+
+
+def test_verify_files_size_mismatch(catalog):
+    dsc = deb822.Dsc(DSC.replace(' 2000 ', ' 2001 '))
+    with pytest.raises(missing_chacra.ChecksumMismatchException):
+        missing_chacra.verify_files('mypackage_1.0-1', dsc, catalog)
+
+
+def test_verify_files_checksum_mismatch(catalog):
+    dsc = deb822.Dsc(DSC.replace(SHA512, 'e' * 128))
+    with pytest.raises(missing_chacra.ChecksumMismatchException):
+        missing_chacra.verify_files('mypackage_1.0-1', dsc, catalog)
+
+
+def test_verify_files_missing(catalog):
+    dsc = deb822.Dsc(DSC.replace('debian.tar.xz', 'diff.gz'))
+    with pytest.raises(missing_chacra.NoFilesFoundException):
+        missing_chacra.verify_files('mypackage_1.0-1', dsc, catalog)
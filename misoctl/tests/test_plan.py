@@ -0,0 +1,99 @@
+from misoctl import plan
+
+
+BINARIES = {
+    'source': {
+        'ceph_1.2-1.dsc': {'checksum': 'aaa', 'size': 1000},
+        'ceph_1.2.orig.tar.gz': {'checksum': 'bbb', 'size': 2000},
+        'ceph_1.2-1_amd64.changes': {'checksum': 'ccc', 'size': 3000},
+    },
+    'amd64': {
+        'ceph_1.2-1_amd64.deb': {'checksum': 'ddd', 'size': 4000},
+    },
+}
+
+
+def test_get_upload_files():
+    result = plan.get_upload_files(BINARIES)
+    assert result == {
+        'ceph_1.2-1.dsc': 1000,
+        'ceph_1.2.orig.tar.gz': 2000,
+        'ceph_1.2-1_amd64.deb': 4000,
+    }
+
+
+def test_throughput(tmpdir):
+    path = str(tmpdir.join('cache', 'throughput.json'))
+    throughput = plan.Throughput(path)
+    assert not throughput.measured('download')
+    throughput.record('download', 1000, 2)
+    assert throughput.rate('download') == 500
+    throughput.record('download', 1000, 1)
+    assert 500 < throughput.rate('download') < 1000
+    throughput.save()
+    assert plan.Throughput(path).rate('download') == \
+        throughput.rate('download')
+
+
+def test_estimate(tmpdir):
+    throughput = plan.Throughput(str(tmpdir.join('throughput.json')))
+    throughput.record('download', 100, 1)
+    throughput.record('upload', 50, 1)
+    totals = {'download_bytes': 1000, 'upload_bytes': 1000}
+    builds = [{'tags': ['ceph-3.2-xenial']}, {'tags': []}]
+    result = plan.estimate(totals, builds, throughput)
+    assert result['download_seconds'] == 10
+    assert result['upload_seconds'] == 20
+    assert result['tag_seconds'] == plan.TAG_SECONDS
+    assert result['total_seconds'] == 30 + plan.TAG_SECONDS
+
+
+class FakeCatalog(object):
+    """ Chacra has some of the builds. """
+    def __init__(self, builds):
+        self.builds = builds
+
+    def binaries(self, nvr):
+        return self.builds.get(nvr, {})
+
+    def size(self, nvr):
+        return 10000
+
+
+class FakeKojiSession(object):
+    """ Koji has none of the builds, and the tags are empty. """
+    def __init__(self):
+        self.multicall = False
+        self.calls = 0
+
+    def getBuild(self, nvr):
+        self.calls += 1
+
+    def listTagged(self, tag, type=None):
+        self.calls += 1
+
+    def multiCall(self, strict=False):
+        self.multicall = False
+        results = [[None] for _ in range(self.calls)]
+        self.calls = 0
+        return results
+
+
+def test_make_plan_not_in_chacra():
+    nvrs = {'ceph_1.2-1': set(), 'ceph_1.2-2': set()}
+    catalog = FakeCatalog({'ceph_1.2-1': BINARIES})
+    result = plan.make_plan(nvrs, ['ceph_1.2-1', 'ceph_1.2-2'],
+                            ['ceph-deb-1.2-1', 'ceph-deb-1.2-2'], catalog,
+                            FakeKojiSession(), jobs=1)
+    assert [build['nvr'] for build in result['builds']] == ['ceph_1.2-1']
+    assert result['not_in_chacra'] == ['ceph_1.2-2']
+    assert result['totals']['not_in_chacra'] == 1
+
+
+def test_throughput_per_profile(tmpdir, monkeypatch):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    throughput = plan.Throughput(profile='koji')
+    throughput.record('upload', 1000, 1)
+    throughput.save()
+    assert plan.Throughput(profile='koji').measured('upload')
+    assert not plan.Throughput(profile='stg').measured('upload')
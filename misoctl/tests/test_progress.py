@@ -0,0 +1,50 @@
+import io
+import pytest
+from misoctl import progress
+from misoctl.metrics import Metrics
+
+
+@pytest.mark.parametrize('seconds,expected', (
+    (5, '0m05s'),
+    (245, '4m05s'),
+    (7980, '2h13m'),
+))
+def test_format_seconds(seconds, expected):
+    assert progress.format_seconds(seconds) == expected
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    """ Fresh counters, so we leave the global metrics alone. """
+    fresh = Metrics()
+    monkeypatch.setattr(progress, 'metrics', fresh)
+    return fresh
+
+
+def test_sample_bytes_eta(metrics):
+    run = progress.Progress(10, download_bytes=3000, upload_bytes=2000,
+                            stream=io.StringIO())
+    run.sample(now=1000)
+    metrics.inc('misoctl_nvrs_processed_total', 2)
+    metrics.inc('misoctl_downloaded_bytes_total', 1000)
+    metrics.inc('misoctl_uploaded_bytes_total', 500)
+    status = run.sample(now=1010)
+    assert status['done'] == 2
+    assert status['download_rate'] == 100
+    assert status['upload_rate'] == 50
+    # 2000 bytes left at 100 B/s, and 1500 bytes left at 50 B/s.
+    assert status['eta'] == 50
+    line = run.format_line(status)
+    assert line.startswith('2/10 builds')
+    assert 'ETA 0m50s' in line
+    fields = run.format_fields(status)
+    assert 'nvrs_done=2 nvrs_total=10' in fields
+    assert 'eta_seconds=50' in fields
+
+
+def test_sample_nvr_eta(metrics):
+    run = progress.Progress(10, stream=io.StringIO())
+    run.start_time = 1000
+    assert run.sample(now=1000)['eta'] is None
+    metrics.inc('misoctl_nvrs_processed_total', 4)
+    assert run.sample(now=1040)['eta'] == 60
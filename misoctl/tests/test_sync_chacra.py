@@ -1,3 +1,4 @@
+import argparse
 import pytest
 from misoctl import sync_chacra
 
@@ -13,3 +14,163 @@ KOJI_NVRS = [
 def test_get_koji_nvr(deb_nvr, expected):
     result = sync_chacra.get_koji_nvr(deb_nvr)
     assert result == expected
+
+
+@pytest.mark.parametrize('value,expected', (
+    ('1/1', (1, 1)),
+    ('2/4', (2, 4)),
+))
+def test_parse_shard(value, expected):
+    assert sync_chacra.parse_shard(value) == expected
+
+
+@pytest.mark.parametrize('value', ('0/4', '5/4', '1/0', '1', 'a/b'))
+def test_bad_parse_shard(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        sync_chacra.parse_shard(value)
+
+
+def test_shard_nvrs():
+    nvrs = ['ceph_1.2-1', 'ceph_1.3-1', 'ceph-deploy_1.2-1',
+            'ceph-ansible_3.2-1', 'ceph-ansible_3.3-1', 'nfs-ganesha_2.7-1']
+    shards = [sync_chacra.shard_nvrs(nvrs, index, 3)
+              for index in range(1, 4)]
+    # Every build lands in exactly one shard, in the same order.
+    assert sorted(sum(shards, [])) == sorted(nvrs)
+    for shard in shards:
+        assert shard == [nvr for nvr in nvrs if nvr in shard]
+    # All versions of a package stay together.
+    for shard in shards:
+        if 'ceph_1.2-1' in shard:
+            assert 'ceph_1.3-1' in shard
+
+
+def test_builds_tree_scan(tmpdir):
+    buildstxt = tmpdir.join('builds-ceph-3.2-1-xenial.txt')
+    buildstxt.write('ceph_12.2.8-1\n')
+    tree = sync_chacra.BuildsTree(str(tmpdir))
+    assert tree.scan()
+    assert tree.all_nvrs() == {'ceph_12.2.8-1': set(['ceph-3.2-xenial'])}
+    # Nothing changed.
+    assert not tree.scan()
+    hotfix = tmpdir.join('builds-ceph-3.2-hotfix-xenial.txt')
+    hotfix.write('ceph_12.2.8-1\nceph_12.2.8-2\n')
+    assert tree.scan()
+    assert tree.all_nvrs() == {
+        'ceph_12.2.8-1': set(['ceph-3.2-xenial']),
+        'ceph_12.2.8-2': set(['ceph-3.2-xenial-hotfix']),
+    }
+    hotfix.remove()
+    assert tree.scan()
+    assert list(tree.all_nvrs()) == ['ceph_12.2.8-1']
+
+
+def test_builds_tree_scan_skips_bad_name(tmpdir):
+    tmpdir.join('builds-ceph-3.2-1-xenial.txt').write('ceph_12.2.8-1\n')
+    tmpdir.join('builds-mystery.txt').write('ceph_12.2.8-2\n')
+    tree = sync_chacra.BuildsTree(str(tmpdir))
+    assert tree.scan()
+    assert list(tree.all_nvrs()) == ['ceph_12.2.8-1']
+    tmpdir.join('builds-mystery.txt').remove()
+    assert tree.scan()
+
+
+class FakeSync(object):
+    """ Fail to sync these nvrs a number of times. """
+    def __init__(self, failures):
+        self.failures = failures
+        self.synced = []
+
+    def __call__(self, nvr):
+        if self.failures.get(nvr):
+            self.failures[nvr] -= 1
+            raise RuntimeError('chacra is down')
+        self.synced.append(nvr)
+
+
+def test_sync_round_keep_going():
+    nvrs = ['ceph_12.2.8-1', 'ceph_12.2.8-2', 'ceph-ansible_3.2.0-1']
+    sync = FakeSync({'ceph_12.2.8-1': 1})
+    failures = sync_chacra.sync_round(nvrs, sync, keep_going=True)
+    assert failures == {
+        'ceph_12.2.8-1': 'RuntimeError: chacra is down',
+        'ceph_12.2.8-2': 'an earlier ceph build failed',
+    }
+    assert sync.synced == ['ceph-ansible_3.2.0-1']
+
+
+def test_sync_round_stops():
+    sync = FakeSync({'ceph_12.2.8-1': 1})
+    with pytest.raises(RuntimeError):
+        sync_chacra.sync_round(['ceph_12.2.8-1'], sync)
+
+
+def test_sync_nvrs_retries(monkeypatch):
+    monkeypatch.setattr(sync_chacra, 'RETRY_DELAY', 0)
+    nvrs = ['ceph_12.2.8-1', 'ceph_12.2.8-2']
+    sync = FakeSync({'ceph_12.2.8-1': 2})
+    failures = sync_chacra.sync_nvrs(nvrs, sync, keep_going=True, retries=2)
+    assert failures == {}
+    assert sync.synced == ['ceph_12.2.8-1', 'ceph_12.2.8-2']
+
+
+def test_failure_report(tmpdir):
+    path = str(tmpdir.join('failures.json'))
+    nvrs = {'ceph_12.2.8-1': set(['ceph-3.2-xenial'])}
+    failures = {'ceph_12.2.8-1': 'RuntimeError: chacra is down'}
+    sync_chacra.write_failure_report(path, failures, nvrs)
+    assert sync_chacra.read_failure_report(path) == set(['ceph_12.2.8-1'])
+
+
+def test_sync_round_waits_for_leases(monkeypatch):
+    monkeypatch.setattr(sync_chacra, 'LEASE_POLL', 0)
+    held = {'ceph_12.2.8-1': 3}
+    synced = []
+
+    def sync(nvr):
+        if held.get(nvr):
+            held[nvr] -= 1
+            raise sync_chacra.lease.LeaseHeldError('%s is held' % nvr)
+        synced.append(nvr)
+    failures = sync_chacra.sync_round(['ceph_12.2.8-1', 'ceph_12.2.8-2'],
+                                      sync, lease_wait=60)
+    assert failures == {}
+    assert synced == ['ceph_12.2.8-2', 'ceph_12.2.8-1']
+
+
+def test_execute_plan_keep_going(monkeypatch):
+    sync = FakeSync({'ceph_12.2.8-1': 1})
+    monkeypatch.setattr(sync_chacra, 'execute_build',
+                        lambda build, *args: sync(build['nvr']))
+    build_plan = {'builds': [{'nvr': 'ceph_12.2.8-1'},
+                             {'nvr': 'ceph_12.2.8-2'},
+                             {'nvr': 'ceph-ansible_3.2.0-1'}]}
+    failures = sync_chacra.execute_plan(build_plan, None, None, None, None,
+                                        None, None, keep_going=True)
+    assert sorted(failures) == ['ceph_12.2.8-1', 'ceph_12.2.8-2']
+    assert sync.synced == ['ceph-ansible_3.2.0-1']
+
+
+def test_execute_plan_rejects_dryrun():
+    args = argparse.Namespace(watch=None, execute_plan='plan.json',
+                              dryrun=True)
+    with pytest.raises(SystemExit):
+        sync_chacra.main(args)
+
+
+class FakeCatalog(object):
+    def add(self, nvr, binaries):
+        pass
+
+
+def test_execute_build_limiter(monkeypatch):
+    imported = []
+    monkeypatch.setattr(sync_chacra, 'import_build',
+                        lambda nvr, *args: imported.append(args[-1]))
+    monkeypatch.setattr(sync_chacra, 'apply_tags', lambda *args: None)
+    build = {'nvr': 'ceph_12.2.8-1', 'koji_nvr': 'ceph-deb-12.2.8-1',
+             'binaries': [{'filename': 'ceph_12.2.8-1.dsc'}], 'tags': []}
+    limiter = object()
+    sync_chacra.execute_build(build, None, None, FakeCatalog(), None, None,
+                              None, limiter=limiter)
+    assert imported == [limiter]
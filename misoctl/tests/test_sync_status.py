@@ -0,0 +1,27 @@
+from misoctl import sync_status
+
+
+def test_get_status():
+    nvrs = {
+        'ceph_12.2.8-1': set(['ceph-3.2-xenial']),
+        'ceph_12.2.8-2': set(['ceph-3.2-xenial', 'ceph-3.2-bionic']),
+        'ceph_12.2.9-1': set(['ceph-3.2-bionic']),
+    }
+    existing = set(['ceph-deb-12.2.8-1', 'ceph-deb-12.2.8-2'])
+    tagged_nvrs = {
+        'ceph-3.2-xenial': set(['ceph-deb-12.2.8-1', 'ceph-deb-12.2.7-1']),
+        'ceph-3.2-bionic': set(['ceph-deb-12.2.8-2']),
+    }
+    status = sync_status.get_status(nvrs, existing, tagged_nvrs)
+    assert status['missing_builds'] == ['ceph-deb-12.2.9-1']
+    assert status['missing_tags'] == {
+        'ceph-3.2-xenial': ['ceph-deb-12.2.8-2'],
+        'ceph-3.2-bionic': ['ceph-deb-12.2.9-1'],
+    }
+    assert status['extra_tagged'] == {'ceph-3.2-xenial': ['ceph-deb-12.2.7-1']}
+    assert status['totals'] == {
+        'nvrs': 3,
+        'missing_builds': 1,
+        'missing_tags': 2,
+        'extra_tagged': 1,
+    }
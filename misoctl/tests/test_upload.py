@@ -0,0 +1,403 @@
+from argparse import Namespace
+import base64
+from hashlib import md5
+from io import BytesIO
+import json
+import os
+import zlib
+import koji
+import pytest
+from misoctl import upload
+from misoctl.util import AdaptiveLimiter
+
+
+def test_rename_log_file(tmpdir):
+    build_file = tmpdir.join('mypackage_1.0-1_amd64.build')
+    build_file.write('I: pbuilder-time-stamp: 1544000000\n')
+    result = upload.rename_log_file(str(build_file))
+    assert result == str(tmpdir.join('mypackage_1.0-1_amd64.log'))
+    assert os.path.samefile(result, str(build_file))
+
+
+def test_rename_log_file_twice(tmpdir):
+    build_file = tmpdir.join('mypackage_1.0-1_amd64.build')
+    build_file.write('I: pbuilder-time-stamp: 1544000000\n')
+    upload.rename_log_file(str(build_file))
+    result = upload.rename_log_file(str(build_file))
+    assert os.path.samefile(result, str(build_file))
+
+
+def test_rename_log_file_replaces_stale(tmpdir):
+    build_file = tmpdir.join('mypackage_1.0-1_amd64.build')
+    build_file.write('new contents\n')
+    tmpdir.join('mypackage_1.0-1_amd64.log').write('old contents\n')
+    result = upload.rename_log_file(str(build_file))
+    with open(result) as f:
+        assert f.read() == 'new contents\n'
+
+
+def test_chunk_sizer_grows_when_fast():
+    sizer = upload.ChunkSizer()
+    size = sizer.size
+    sizer.update(size, 0.1)
+    assert sizer.size == size * 2
+
+
+def test_chunk_sizer_stops_growing_without_gains():
+    sizer = upload.ChunkSizer()
+    sizer.update(sizer.size, 0.1)
+    size = sizer.size
+    # Twice the chunk size in twice the time: no better throughput.
+    sizer.update(size, 0.2)
+    assert sizer.size == size
+
+
+def test_chunk_sizer_shrinks_when_slow():
+    sizer = upload.ChunkSizer()
+    size = sizer.size
+    sizer.update(size, 30)
+    assert sizer.size == size // 2
+    for _ in range(20):
+        sizer.update(sizer.size, 30)
+    assert sizer.size == upload.ChunkSizer.MIN_SIZE
+
+
+class FakeUploadSession(object):
+    """ Record rawUpload calls like a Koji hub. """
+    def __init__(self):
+        self.opts = {}
+        self.uploaded = {}
+
+    def rawUpload(self, chunk, offset, path, name, overwrite=False):
+        data = self.uploaded.setdefault((path, name), bytearray())
+        assert offset == len(data)
+        data.extend(chunk)
+        hexdigest = '%08x' % (zlib.adler32(chunk) & 0xffffffff)
+        return {'size': len(chunk), 'hexdigest': hexdigest}
+
+
+def test_fast_upload(tmpdir):
+    local_file = tmpdir.join('mypackage_1.0-1.tar.gz')
+    contents = b'x' * (3 * upload.ChunkSizer.MIN_SIZE + 17)
+    local_file.write_binary(contents)
+    session = FakeUploadSession()
+    sizer = upload.ChunkSizer()
+    sizer.size = upload.ChunkSizer.MIN_SIZE
+    upload.fast_upload(str(local_file), 'cli-import/abc', session, sizer)
+    result = session.uploaded[('cli-import/abc', 'mypackage_1.0-1.tar.gz')]
+    assert bytes(result) == contents
+
+
+class FakeParallelSession(FakeUploadSession):
+    """ Hand out subsessions that share one fake hub. """
+    def __init__(self):
+        super(FakeParallelSession, self).__init__()
+        self.subsessions = []
+
+    def subsession(self):
+        subsession = FakeUploadSession()
+        subsession.uploaded = self.uploaded
+        subsession._callMethod = None
+        subsession.multicall = False
+        subsession.logout = lambda: None
+        self.subsessions.append(subsession)
+        return subsession
+
+
+def test_upload_parallel(tmpdir):
+    all_files = []
+    for name in ('a', 'b', 'c'):
+        local_file = tmpdir.join('mypackage-%s_1.0-1_amd64.deb' % name)
+        local_file.write_binary(name.encode('ascii') * 100)
+        all_files.append(str(local_file))
+    session = FakeParallelSession()
+    limiter = AdaptiveLimiter('test', 2)
+    remote_directory = upload.upload(all_files, session, limiter=limiter)
+    assert len(session.uploaded) == 3
+    data = session.uploaded[(remote_directory, 'mypackage-b_1.0-1_amd64.deb')]
+    assert bytes(data) == b'b' * 100
+    assert 1 <= len(session.subsessions) <= 2
+
+
+class FakeKojiSession(object):
+    def getBuild(self, nvr):
+        return None
+
+
+def write_build_directory(directory, name='mypackage'):
+    tarball = directory.join('%s_1.0.orig.tar.gz' % name)
+    tarball.write('testtarballcontents')
+    directory.join('%s_1.0-1.dsc' % name).write(
+        'Format: 3.0 (quilt)\n'
+        'Source: %s\n'
+        'Version: 1.0-1\n'
+        'Files:\n'
+        ' %s %d %s_1.0.orig.tar.gz\n'
+        % (name, tarball.computehash('md5'), tarball.size(), name))
+    directory.join('%s_1.0-1_amd64.changes' % name).write(
+        'Source: %s\n'
+        'Date: Wed, 05 Dec 2018 08:53:20 +0000\n' % name)
+
+
+def test_import_from_directory_dryrun(tmpdir):
+    write_build_directory(tmpdir)
+    result = upload.import_from_directory(str(tmpdir), FakeKojiSession(),
+                                          'kdreyer', True,
+                                          'git://example.com/mypackage',
+                                          True)
+    assert result == {}
+    with open(str(tmpdir.join('metadata.json'))) as f:
+        metadata = json.load(f)
+    assert metadata['build']['name'] == 'mypackage-deb'
+    assert metadata['build']['start_time'] == 1544000000
+    filenames = sorted(o['filename'] for o in metadata['output'])
+    assert filenames == ['mypackage_1.0-1.dsc', 'mypackage_1.0.orig.tar.gz']
+
+
+class FakeBatchKojiSession(object):
+    """ Answers getBuild multicalls. """
+    def __init__(self, existing):
+        self.existing = existing
+        self.multicall = False
+        self.calls = []
+
+    def getBuild(self, nvr):
+        self.calls.append(nvr)
+
+    def multiCall(self, strict=False):
+        self.multicall = False
+        results = [[{'nvr': nvr} if nvr in self.existing else None]
+                   for nvr in self.calls]
+        self.calls = []
+        return results
+
+
+def test_get_batch_entries_manifest(tmpdir):
+    tmpdir.mkdir('a')
+    tmpdir.mkdir('b')
+    manifest = tmpdir.join('manifest.json')
+    manifest.write(json.dumps([
+        {'directory': 'a'},
+        {'directory': 'b', 'scm_url': 'git://example.com/b', 'tag': 'b-tag'},
+    ]))
+    args = Namespace(directories=[], manifest=str(manifest),
+                     scm_url='git://example.com/a', tag=None)
+    entries = upload.get_batch_entries(args)
+    assert entries == [
+        {'directory': str(tmpdir.join('a')),
+         'scm_url': 'git://example.com/a', 'tag': None},
+        {'directory': str(tmpdir.join('b')),
+         'scm_url': 'git://example.com/b', 'tag': 'b-tag'},
+    ]
+
+
+def test_get_batch_entries_needs_scm_url(tmpdir):
+    args = Namespace(directories=[str(tmpdir)], manifest=None,
+                     scm_url=None, tag=None)
+    with pytest.raises(SystemExit):
+        upload.get_batch_entries(args)
+
+
+def test_import_batch_dryrun(tmpdir):
+    entries = []
+    for name in ('one', 'two', 'three'):
+        directory = tmpdir.mkdir(name)
+        write_build_directory(directory, name)
+        entries.append({'directory': str(directory),
+                        'scm_url': 'git://example.com/%s' % name,
+                        'tag': None})
+    # A directory with no .dsc file fails, but the batch keeps going.
+    entries.append({'directory': str(tmpdir.mkdir('empty')),
+                    'scm_url': 'git://example.com/empty', 'tag': None})
+    session = FakeBatchKojiSession(existing=['two-deb-1.0-1'])
+    results = upload.import_batch(entries, session, 'kdreyer', True, True)
+    statuses = [(r['nvr'], r['status']) for r in results]
+    assert statuses == [
+        ('one-deb-1.0-1', 'dryrun'),
+        ('two-deb-1.0-1', 'exists'),
+        ('three-deb-1.0-1', 'dryrun'),
+        (None, 'failed'),
+    ]
+    assert tmpdir.join('three', 'metadata.json').check()
+    assert not tmpdir.join('two', 'metadata.json').check()
+
+
+class FakeResumeSession(FakeUploadSession):
+    """ A hub that already has some uploaded files. """
+    def checkUpload(self, path, name, verify=None):
+        data = self.uploaded.get((path, name))
+        if data is None:
+            return None
+        return {'size': len(data), 'hexdigest': md5(data).hexdigest()}
+
+
+def test_upload_resumes(tmpdir):
+    tarball = tmpdir.join('mypackage_1.0.orig.tar.gz')
+    tarball.write('testtarballcontents')
+    dsc = tmpdir.join('mypackage_1.0-1.dsc')
+    dsc.write('Source: mypackage\n')
+    all_files = [str(tarball), str(dsc)]
+
+    # The first attempt uploaded the tarball, and then failed.
+    state = upload.ImportState(str(tmpdir), 'mypackage-deb-1.0-1')
+    session = FakeResumeSession()
+    remote_directory = upload.upload([str(tarball)], session, state)
+    assert state.is_uploaded(str(tarball), tarball.size(),
+                             tarball.computehash('md5'))
+
+    # The retry uses the same remote directory, and skips the tarball.
+    state = upload.ImportState(str(tmpdir), 'mypackage-deb-1.0-1')
+    assert state.remote_directory == remote_directory
+    session.rawUpload = Spy(session.rawUpload)
+    result = upload.upload(all_files, session, state)
+    assert result == remote_directory
+    assert session.rawUpload.names == ['mypackage_1.0-1.dsc']
+
+
+def test_import_state_other_nvr(tmpdir):
+    state = upload.ImportState(str(tmpdir), 'mypackage-deb-1.0-1')
+    state.remote_directory = 'cli-import/abc'
+    state.save()
+    state = upload.ImportState(str(tmpdir), 'mypackage-deb-1.0-2')
+    assert state.remote_directory is None
+
+
+class Spy(object):
+    """ Record the file names of rawUpload calls. """
+    def __init__(self, func):
+        self.func = func
+        self.names = []
+
+    def __call__(self, chunk, offset, path, name, **kwargs):
+        self.names.append(name)
+        return self.func(chunk, offset, path, name, **kwargs)
+
+
+class FakeImportSession(FakeResumeSession):
+    """ A hub that accepts CGImport calls. """
+    def __init__(self):
+        super(FakeImportSession, self).__init__()
+        self.imports = []
+
+    def getBuild(self, nvr):
+        return None
+
+    def CGImport(self, metadata, remote_directory):
+        self.imports.append((metadata, remote_directory))
+        return {'name': 'mypackage-deb', 'version': '1.0', 'release': '1'}
+
+
+def test_import_hashes_upload_stream(tmpdir, monkeypatch):
+    write_build_directory(tmpdir)
+
+    def get_md5sum(path):
+        raise AssertionError('read %s again' % path)
+    monkeypatch.setattr(upload.filemanager.util, 'get_md5sum', get_md5sum)
+    session = FakeImportSession()
+    upload.import_from_directory(str(tmpdir), session, 'kdreyer', True,
+                                 'git://example.com/mypackage', False)
+    ((metadata, remote_directory),) = session.imports
+    output = dict((o['filename'], o) for o in metadata['output'])
+    tarball = tmpdir.join('mypackage_1.0.orig.tar.gz')
+    assert output['mypackage_1.0.orig.tar.gz']['checksum'] == \
+        tarball.computehash('md5')
+    assert (remote_directory, 'metadata.json') in session.uploaded
+
+
+def test_import_md5_mismatch(tmpdir):
+    write_build_directory(tmpdir)
+    tmpdir.join('mypackage_1.0.orig.tar.gz').write('corruptedcontents!!')
+    session = FakeImportSession()
+    with pytest.raises(upload.filemanager.DscMismatchError):
+        upload.import_from_directory(str(tmpdir), session, 'kdreyer', True,
+                                     'git://example.com/mypackage', False)
+    # We stopped right after the bad file.
+    names = [name for (_, name) in session.uploaded]
+    assert names[-1] == 'mypackage_1.0.orig.tar.gz'
+    assert session.imports == []
+
+
+def test_import_bundle(tmpdir, monkeypatch):
+    build_dir = tmpdir.mkdir('build')
+    write_build_directory(build_dir)
+    bdir = upload.filemanager.BuildDirectory(str(build_dir))
+    (manifest, members) = upload.bundle.get_manifest(bdir, skip_log=True)
+    path = str(tmpdir.join('mypackage_1.0-1.bundle'))
+    upload.bundle.write_bundle(path, manifest, members)
+
+    def get_md5sum(path):
+        raise AssertionError('hashed %s' % path)
+    monkeypatch.setattr(upload.filemanager.util, 'get_md5sum', get_md5sum)
+    session = FakeImportSession()
+    upload.import_from_directory(path, session, 'kdreyer', True,
+                                 'git://example.com/mypackage', False)
+    ((metadata, remote_directory),) = session.imports
+    assert metadata['build']['name'] == 'mypackage-deb'
+    output = dict((o['filename'], o) for o in metadata['output'])
+    tarball = build_dir.join('mypackage_1.0.orig.tar.gz')
+    assert output['mypackage_1.0.orig.tar.gz']['checksum'] == \
+        tarball.computehash('md5')
+    data = session.uploaded[(remote_directory, 'mypackage_1.0.orig.tar.gz')]
+    assert bytes(data) == b'testtarballcontents'
+    assert (remote_directory, 'metadata.json') in session.uploaded
+
+
+class FakeOldHubSession(FakeUploadSession):
+    """ A hub without rawUpload, or one that fails uploads. """
+    def __init__(self, error):
+        super(FakeOldHubSession, self).__init__()
+        self.error = error
+        self.wrapped = []
+
+    def rawUpload(self, chunk, offset, path, name, overwrite=False):
+        raise koji.GenericError(self.error)
+
+    def uploadWrapper(self, localfile, path, callback=None, blocksize=None):
+        self.wrapped.append((os.path.basename(localfile), blocksize))
+
+    def uploadFile(self, path, name, size, digest, offset, data):
+        chunk = base64.b64decode(data)
+        uploaded = self.uploaded.setdefault((path, name), bytearray())
+        if offset == -1:
+            assert size == len(uploaded)
+            assert digest == md5(uploaded).hexdigest()
+            return True
+        assert offset == len(uploaded)
+        assert size == len(chunk)
+        assert digest == md5(chunk).hexdigest()
+        uploaded.extend(chunk)
+        return True
+
+
+def test_upload_file_xmlrpc_fallback(tmpdir):
+    local_file = tmpdir.join('mypackage_1.0-1.tar.gz')
+    local_file.write_binary(b'x' * 100)
+    session = FakeOldHubSession('Invalid method: rawUpload')
+    sizer = upload.ChunkSizer()
+    upload.upload_file(str(local_file), 'cli-import/abc', session, sizer)
+    assert session.opts['use_fast_upload'] is False
+    # We leave the XML-RPC block size to Koji.
+    assert session.wrapped == [('mypackage_1.0-1.tar.gz', None)]
+
+
+def test_upload_file_hub_error(tmpdir):
+    local_file = tmpdir.join('mypackage_1.0-1.tar.gz')
+    local_file.write_binary(b'x' * 100)
+    session = FakeOldHubSession('No space left on device')
+    with pytest.raises(koji.GenericError):
+        upload.upload_file(str(local_file), 'cli-import/abc', session,
+                           upload.ChunkSizer())
+    assert 'use_fast_upload' not in session.opts
+
+
+def test_upload_stream_xmlrpc_fallback():
+    contents = b'x' * 2500
+    session = FakeOldHubSession('Invalid method: rawUpload')
+    session.opts['upload_blocksize'] = 1000
+    upload.upload_stream(BytesIO(contents), 'mypackage_1.0.orig.tar.gz',
+                         len(contents), 'cli-import/abc', session,
+                         upload.ChunkSizer())
+    result = session.uploaded[('cli-import/abc', 'mypackage_1.0.orig.tar.gz')]
+    assert bytes(result) == contents
+    # We sent the stream itself, not a temporary copy on disk.
+    assert session.wrapped == []
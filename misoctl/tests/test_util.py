@@ -11,3 +11,61 @@ def test_get_md5sum(tmpdir):
     expected = 'e04a72f793a87ba9e1b48000044a5e2b'
     filename = str(cache_file)
     assert util.get_md5sum(filename) == expected
+
+
+def test_rate_limiter(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(util.time, 'sleep', sleeps.append)
+    monkeypatch.setattr(util.time, 'time', lambda: 1000.0)
+    limiter = util.RateLimiter(100)
+    # The first second's worth is free.
+    limiter.consume(100)
+    assert sleeps == []
+    # After that, we pay for every byte.
+    limiter.consume(50)
+    assert sleeps == [0.5]
+
+
+def test_adaptive_limiter_grows():
+    limiter = util.AdaptiveLimiter('test', maximum=4)
+    assert limiter.limit == 1
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(ok=True, seconds=0.1)
+    assert limiter.limit == 4
+
+
+def test_adaptive_limiter_backs_off():
+    limiter = util.AdaptiveLimiter('test', maximum=8)
+    limiter.limit = 8.0
+    limiter.acquire()
+    limiter.release(ok=False)
+    assert limiter.limit == 4
+    # Requests that were in flight at the same time don't halve it again.
+    limiter.acquire()
+    limiter.release(ok=False)
+    assert limiter.limit == 4
+
+
+def test_adaptive_limiter_slow_response():
+    limiter = util.AdaptiveLimiter('test', maximum=8)
+    limiter.limit = 8.0
+    limiter.acquire()
+    limiter.release(ok=True, seconds=0.1)
+    limiter.acquire()
+    limiter.release(ok=True, seconds=1.0)
+    assert limiter.limit == 4
+
+
+def test_adaptive_limiter_latency_per_kind():
+    limiter = util.AdaptiveLimiter('test', maximum=8)
+    limiter.limit = 8.0
+    limiter.acquire()
+    limiter.release(ok=True, seconds=0.1, kind='search')
+    # A slow download is not congestion compared with a quick search.
+    limiter.acquire()
+    limiter.release(ok=True, seconds=1.0, kind='download')
+    assert limiter.limit == 8
+    limiter.acquire()
+    limiter.release(ok=True, seconds=1.0, kind='search')
+    assert limiter.limit == 4
@@ -1,6 +1,14 @@
+from multiprocessing.pool import ThreadPool
+import base64
+from hashlib import md5
+from io import BytesIO
 import json
 import os
 import shutil
+import threading
+import time
+import zlib
+import koji
 from koji_cli.lib import _progress_callback
 from koji_cli.lib import watch_tasks
 try:
@@ -8,10 +16,13 @@ try:
     from koji_cli.lib import unique_path
 except ImportError:
     from koji_cli.lib import _unique_path as unique_path
+from misoctl import bundle
 from misoctl import filemanager
-from misoctl import util
 import misoctl.session
 from misoctl.log import log as log
+from misoctl.metrics import metrics
+from misoctl.metrics import instrument_koji
+from misoctl.util import AdaptiveLimiter
 
 
 def add_parser(subparsers):
@@ -20,7 +31,7 @@ def add_parser(subparsers):
     """
     parser = subparsers.add_parser('upload', help='upload build to Koji')
 
-    parser.add_argument('--scm-url', required=True,
+    parser.add_argument('--scm-url',
                         help='SCM URL for this build, eg. git://...')
     parser.add_argument('--owner', required=True,
                         help='koji user name that owns this build')
@@ -30,7 +41,17 @@ def add_parser(subparsers):
                         help="Show what would happen, but don't do it")
     parser.add_argument('--skip-log', action='store_true',
                         help="Do not upload a .build log file")
-    parser.add_argument('directory', help="parent directory of a .dsc file")
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='maximum number of files to upload at once '
+                             '(defaults to 4). We start with one, and add '
+                             'more while the hub copes.')
+    parser.add_argument('--manifest',
+                        help='JSON file listing more directories to import, '
+                             'with optional per-directory "scm_url" and '
+                             '"tag" values')
+    parser.add_argument('directories', nargs='*', metavar='directory',
+                        help='parent directory of a .dsc file, or a file '
+                             'from "misoctl bundle"')
     parser.set_defaults(func=main)
 
 
@@ -65,24 +86,60 @@ def get_build_data(dsc, start_time, end_time, scm_url, owner):
     return info
 
 
-def get_output_data(filenames):
-    """ Return a list of file information, for the CG metadata. """
+def get_output_data(filenames, build_dir=None):
+    """
+    Return a list of file information, for the CG metadata.
+
+    :param filenames: paths to the files to import
+    :param build_dir: filemanager.BuildDirectory that already knows some of
+                      these files' sizes and checksums.
+    """
+    if build_dir is None:
+        build_dir = filemanager.BuildDirectory(None)
     output = []
     for filename in filenames:
-        file_info = get_file_info(filename)
+        file_info = get_file_info(filename, build_dir)
         output.append(file_info)
     return output
 
 
-def get_file_info(filename):
+def get_file_info(filename, build_dir=None):
     """ Return information about a single file, for the CG metadata. """
+    if build_dir is None:
+        build_dir = filemanager.BuildDirectory(None)
+    fbytes = build_dir.size(filename)
+    checksum = build_dir.md5sum(filename)
+    typeinfo = {}
+    if filename.endswith('.deb'):
+        # We read the control fields in the same pass as the checksum.
+        typeinfo = build_dir.control(filename)
+    return make_file_info(filename, fbytes, checksum, typeinfo)
+
+
+def get_bundle_output_data(entries):
+    """
+    Return a list of file information from bundle manifest entries, for
+    the CG metadata.
+    """
+    return [make_file_info(entry['name'], entry['size'], entry['md5'],
+                           entry.get('control', {}))
+            for entry in entries]
+
+
+def make_file_info(filename, fbytes, checksum, typeinfo):
+    """
+    Return the CG metadata for a single file.
+
+    :param filename: name or path of the file
+    :param fbytes: size of the file in bytes
+    :param checksum: hex md5 digest of the file
+    :param typeinfo: dict of control fields for a .deb
+    """
     info = {'buildroot_id': 0}
     info['filename'] = os.path.basename(filename)
-    fbytes = os.path.getsize(filename)
     info['filesize'] = int(fbytes)
     # Kojihub only supports checksum_type: md5 for now.
     info['checksum_type'] = 'md5'
-    checksum = util.get_md5sum(filename)
     info['checksum'] = checksum
     info['arch'] = 'x86_64'
     if filename.endswith('.tar.gz') or filename.endswith('.tar.xz'):
@@ -97,7 +154,7 @@ def get_file_info(filename):
         raise RuntimeError('unknown extension for %s' % filename)
     info['extra'] = {
         'typeinfo': {
-            'debian': {},
+            'debian': typeinfo,
         },
     }
     return info
@@ -105,15 +162,32 @@ def get_file_info(filename):
 
 def rename_log_file(log_file):
     """
-    Rename a .build file to a .log file.
+    Present a .build file as a .log file, without copying its contents.
 
     Koji checks each file's extension during an import operation. We have to
     do this so Koji will accept the log file when we import it.
+
+    pbuilder logs can be hundreds of MB, so we hardlink the .log name to the
+    original .build file. If the filesystem does not support hardlinks, we
+    fall back to a symlink, and only copy the data as a last resort.
     """
     assert log_file.endswith('.build')
     new_log_file = log_file[:-6] + '.log'
-    # os.rename(log_file, new_log_file)
-    # I'm copying instead of renaming, for testing:
+    if os.path.lexists(new_log_file):
+        if os.path.exists(new_log_file) and \
+           os.path.samefile(log_file, new_log_file):
+            return new_log_file
+        os.unlink(new_log_file)
+    try:
+        os.link(log_file, new_log_file)
+        return new_log_file
+    except (OSError, AttributeError) as e:
+        log.debug('could not hardlink %s: %s' % (log_file, e))
+    try:
+        os.symlink(os.path.basename(log_file), new_log_file)
+        return new_log_file
+    except (OSError, AttributeError) as e:
+        log.debug('could not symlink %s: %s' % (log_file, e))
     shutil.copy(log_file, new_log_file)
     return new_log_file
 
@@ -163,35 +237,474 @@ def verify_tag(tag, session):
         raise RuntimeError('tag %s is not present in Koji' % tag)
 
 
-def upload(all_files, session):
+class FastUploadUnavailable(Exception):
+    """ This Koji hub does not support rawUpload. """
+    pass
+
+
+class ChunkSizer(object):
+    """
+    Choose the size of each rawUpload chunk from the ones before it.
+
+    Small chunks waste most of a high-latency link on round trips, and huge
+    chunks make each retry expensive. We aim for each chunk to take about
+    TARGET_SECONDS: grow the chunk size while chunks are quick and our
+    throughput keeps improving, and shrink it when chunks are slow.
+    """
+
+    INITIAL_SIZE = 1024 * 1024
+    MIN_SIZE = 256 * 1024
+    MAX_SIZE = 64 * 1024 * 1024
+    TARGET_SECONDS = 2.0
+
+    def __init__(self):
+        self.size = self.INITIAL_SIZE
+        self.best_rate = 0
+
+    def update(self, nbytes, seconds):
+        """ Record how long one chunk of nbytes took to upload. """
+        if nbytes < self.size:
+            # The final short chunk of a file tells us nothing.
+            return
+        seconds = max(seconds, 0.001)
+        rate = nbytes / seconds
+        if seconds > self.TARGET_SECONDS * 2:
+            self.size = max(self.size // 2, self.MIN_SIZE)
+        elif seconds < self.TARGET_SECONDS / 2 and \
+                rate > self.best_rate * 1.1:
+            self.size = min(self.size * 2, self.MAX_SIZE)
+        self.best_rate = max(self.best_rate, rate)
+
+
+def fast_upload(filename, remote_directory, session, sizer, callback=None,
+                digest=None):
+    """
+    Upload one file with Koji's rawUpload call, in adaptive chunks.
+
+    This is Koji's fastUpload protocol, but we choose the chunk size as we
+    go with a ChunkSizer.
+
+    :param filename: local file to upload
+    :param remote_directory: Koji upload directory
+    :param session: Koji session
+    :param sizer: ChunkSizer for this upload.
+    :param callback: Koji-style progress callback
+    :param digest: filemanager.StreamDigest to feed each chunk that the hub
+                   accepts, so we hash the file in the same read.
+    :raises: FastUploadUnavailable if the hub does not have rawUpload.
+    """
+    name = os.path.basename(filename)
+    total_size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        fast_upload_stream(f, name, total_size, remote_directory, session,
+                           sizer, callback, digest)
+
+
+def fast_upload_stream(f, name, total_size, remote_directory, session, sizer,
+                       callback=None, digest=None):
+    """
+    Upload one file object with Koji's rawUpload call.
+
+    See fast_upload() for the other parameters.
+
+    :param f: file object to read from its current position
+    :param name: file name on the hub
+    :param total_size: number of bytes to read from f
+    """
+    offset = 0
+    start = time.time()
+    if callback:
+        callback(0, total_size, 0, 0, 0)
+    while True:
+        chunk = f.read(sizer.size)
+        lap = time.time()
+        try:
+            result = session.rawUpload(chunk, offset, remote_directory,
+                                       name, overwrite=True)
+        except koji.GenericError as e:
+            # The hub answers "Invalid method: rawUpload" if it predates
+            # fast uploads. Other errors are real failures.
+            if offset == 0 and 'Invalid method' in str(e):
+                raise FastUploadUnavailable(str(e))
+            raise
+        elapsed = time.time() - lap
+        hexdigest = '%08x' % (zlib.adler32(chunk) & 0xffffffff)
+        if result['size'] != len(chunk):
+            raise RuntimeError('hub received %d bytes of %s, not %d' %
+                               (result['size'], name, len(chunk)))
+        if result['hexdigest'] != hexdigest:
+            raise RuntimeError('upload checksum failed for %s' % name)
+        if digest:
+            digest.update(chunk)
+        offset += len(chunk)
+        metrics.inc('misoctl_uploaded_bytes_total', len(chunk))
+        sizer.update(len(chunk), elapsed)
+        if callback:
+            callback(offset, total_size, len(chunk), max(elapsed, 0.001),
+                     max(time.time() - start, 0.001))
+        if offset >= total_size or not chunk:
+            break
+    if offset != total_size:
+        raise RuntimeError('%s changed size during upload' % name)
+
+
+def upload_file(filename, remote_directory, session, sizer, callback=None,
+                build_dir=None):
+    """
+    Upload one file to a remote directory in Koji, and log the throughput.
+
+    We use the fast (raw) upload path when the hub supports it, or fall
+    back to Koji's XML-RPC base64 upload path for older hubs.
+
+    :param build_dir: filemanager.BuildDirectory. On the fast upload path,
+                      we record this file's md5 and control fields there
+                      from the bytes we send, so nothing reads it again.
+    """
+    start = time.time()
+    if session.opts.get('use_fast_upload', True):
+        digest = None
+        if build_dir is not None:
+            digest = filemanager.StreamDigest(filename)
+        try:
+            fast_upload(filename, remote_directory, session, sizer, callback,
+                        digest)
+            if build_dir is not None:
+                build_dir.record(filename, digest)
+        except FastUploadUnavailable as e:
+            # Older hubs do not have rawUpload.
+            log.warning('fast upload failed (%s), using XML-RPC upload' % e)
+            session.opts['use_fast_upload'] = False
+    if not session.opts.get('use_fast_upload', True):
+        if build_dir is not None:
+            # Koji reads this file itself, so check it before we send it.
+            build_dir.verify(filename)
+        # XML-RPC sends each chunk as one base64 request, so we keep to
+        # Koji's upload_blocksize rather than our (large) raw chunks.
+        session.uploadWrapper(filename, remote_directory, callback=callback)
+        metrics.inc('misoctl_uploaded_bytes_total',
+                    os.path.getsize(filename))
+    log_upload(os.path.basename(filename), os.path.getsize(filename), start,
+               callback)
+
+
+def upload_stream(f, name, size, remote_directory, session, sizer,
+                  callback=None):
+    """
+    Upload one file object to a remote directory in Koji, like
+    upload_file().
+
+    Koji's uploadWrapper() only reads files by name, so for older hubs we
+    send the file object with our own XML-RPC chunk loop instead.
+
+    :param f: seekable file object, at the start of the file
+    :param name: file name on the hub
+    :param size: size of the file in bytes
+    """
+    start = time.time()
+    if session.opts.get('use_fast_upload', True):
+        try:
+            fast_upload_stream(f, name, size, remote_directory, session,
+                               sizer, callback)
+        except FastUploadUnavailable as e:
+            log.warning('fast upload failed (%s), using XML-RPC upload' % e)
+            session.opts['use_fast_upload'] = False
+            f.seek(0)
+    if not session.opts.get('use_fast_upload', True):
+        xmlrpc_upload_stream(f, name, size, remote_directory, session,
+                             callback)
+    log_upload(name, size, start, callback)
+
+
+def xmlrpc_upload_stream(f, name, size, remote_directory, session,
+                         callback=None):
+    """
+    Upload one file object with Koji's XML-RPC uploadFile call.
+
+    This is the chunk loop from Koji's uploadWrapper(), for a file object
+    rather than a file name. We send plain md5 digests, since every hub
+    that lacks rawUpload understands them.
+
+    See fast_upload_stream() for the parameters.
+    """
+    blocksize = session.opts.get('upload_blocksize', 1048576)
+    whole = md5()
+    offset = 0
+    start = time.time()
+    if callback:
+        callback(0, size, 0, 0, 0)
+    while True:
+        lap = time.time()
+        chunk = f.read(blocksize)
+        whole.update(chunk)
+        data = base64.b64encode(chunk).decode('ascii')
+        if chunk:
+            result = session.uploadFile(remote_directory, name, len(chunk),
+                                        md5(chunk).hexdigest(), offset, data)
+        else:
+            # Offset -1 ends the upload, and checks the whole file.
+            result = session.uploadFile(remote_directory, name, offset,
+                                        whole.hexdigest(), -1, data)
+        if not result:
+            raise RuntimeError('failed to upload %s at offset %d'
+                               % (name, offset))
+        if not chunk:
+            break
+        offset += len(chunk)
+        metrics.inc('misoctl_uploaded_bytes_total', len(chunk))
+        if callback:
+            callback(offset, size, len(chunk),
+                     max(time.time() - lap, 0.001),
+                     max(time.time() - start, 0.001))
+    if offset != size:
+        raise RuntimeError('%s changed size during upload' % name)
+
+
+def log_upload(name, size, start, callback=None):
+    """ Log the throughput of one upload that began at start. """
+    elapsed = max(time.time() - start, 0.001)
+    if callback:
+        print('')
+    log.info('uploaded %s (%.1f MB) at %.1f MB/s' %
+             (name, size / 1048576.0, size / 1048576.0 / elapsed))
+
+
+class ImportState(object):
+    """
+    Remember an import's remote directory and the files we uploaded there.
+
+    If CGImport fails after we have uploaded many GB, a retry can use the
+    same remote directory and only upload the files that are not already
+    on the hub. We keep this state in a small JSON file in the build
+    directory, and remove it after a successful import.
+    """
+
+    FILENAME = '.misoctl-import.json'
+
+    def __init__(self, directory, nvr):
+        """
+        :param directory: local build directory
+        :param nvr: Koji build NVR we are importing
+        """
+        self.path = os.path.join(directory, self.FILENAME)
+        self.nvr = nvr
+        self.remote_directory = None
+        self.files = {}
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('nvr') != nvr:
+            return
+        self.remote_directory = data['remote_directory']
+        self.files = data['files']
+        log.info('resuming import of %s in %s' % (nvr, self.remote_directory))
+
+    def is_uploaded(self, filename, size, md5sum):
+        """ Return True if we uploaded this exact file before. """
+        name = os.path.basename(filename)
+        return self.files.get(name) == {'size': size, 'md5sum': md5sum}
+
+    def mark_uploaded(self, filename, size, md5sum):
+        name = os.path.basename(filename)
+        self.files[name] = {'size': size, 'md5sum': md5sum}
+        self.save()
+
+    def save(self):
+        data = {
+            'nvr': self.nvr,
+            'remote_directory': self.remote_directory,
+            'files': self.files,
+        }
+        with open(self.path, 'w') as f:
+            json.dump(data, f)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def is_on_hub(filename, size, md5sum, remote_directory, session):
+    """
+    Check whether the hub already has this exact file in remote_directory.
+    """
+    name = os.path.basename(filename)
+    try:
+        result = session.checkUpload(remote_directory, name, verify='md5')
+    except koji.GenericError as e:
+        log.warning('could not check %s on the hub: %s' % (name, e))
+        return False
+    if not result:
+        return False
+    return result['size'] == size and result.get('hexdigest') == md5sum
+
+
+class ParallelUploader(object):
+    """
+    Upload files over several Koji subsessions at once.
+
+    A Koji session is not thread-safe, so each thread uploads with its own
+    subsession. An util.AdaptiveLimiter decides how many uploads may run at
+    once, and we retry each failed file a few times while it backs off.
+    """
+
+    ATTEMPTS = 3
+
+    def __init__(self, session, limiter):
+        self.session = session
+        self.limiter = limiter
+        self.local = threading.local()
+        self.subsessions = []
+        self.lock = threading.Lock()
+
+    def get_subsession(self):
+        if not hasattr(self.local, 'session'):
+            # subsession() is a call on the main session, which is not
+            # thread-safe either.
+            with self.lock:
+                subsession = self.session.subsession()
+                self.subsessions.append(subsession)
+            instrument_koji(subsession)
+            self.local.session = subsession
+            self.local.sizer = ChunkSizer()
+        return (self.local.session, self.local.sizer)
+
+    def upload_file(self, filename, remote_directory, build_dir=None):
+        """ Upload one file, retrying when the hub struggles. """
+        for attempt in range(1, self.ATTEMPTS + 1):
+            self.limiter.acquire()
+            ok = False
+            try:
+                (subsession, sizer) = self.get_subsession()
+                upload_file(filename, remote_directory, subsession, sizer,
+                            build_dir=build_dir)
+                ok = True
+                return
+            except filemanager.DscMismatchError:
+                # The hub did its part, and another attempt won't help.
+                ok = True
+                raise
+            except Exception as e:
+                if attempt == self.ATTEMPTS:
+                    raise
+                log.warning('upload of %s failed (%s), retrying'
+                            % (filename, e))
+            finally:
+                self.limiter.release(ok)
+
+    def close(self):
+        for subsession in self.subsessions:
+            try:
+                subsession.logout()
+            except koji.GenericError as e:
+                log.warning('could not log out a subsession: %s' % e)
+
+
+def upload(all_files, session, state=None, build_dir=None, limiter=None):
     """
     Upload all files to a remote directory in Koji.
+
+    :param all_files: set of files to upload
+    :param session: Koji session
+    :param state: ImportState. If it records a previous attempt, we upload
+                  into the same remote directory, and skip files that are
+                  already on the hub.
+    :param build_dir: filemanager.BuildDirectory that knows some of these
+                      files' sizes and checksums. We record the checksums
+                      of the files we upload there.
+    :param limiter: util.AdaptiveLimiter. If set, we upload files in
+                    parallel over Koji subsessions, as the limiter allows.
+    :returns: the remote directory
     """
-    remote_directory = unique_path('cli-import')
+    if state and state.remote_directory:
+        remote_directory = state.remote_directory
+    else:
+        remote_directory = unique_path('cli-import')
+        if state:
+            state.remote_directory = remote_directory
+            state.save()
     log.info('uploading files to %s' % remote_directory)
+    if build_dir is None:
+        build_dir = filemanager.BuildDirectory(None)
 
+    todo = []
     for filename in all_files:
+        # Only hash the files that a previous attempt uploaded.
+        if state and os.path.basename(filename) in state.files:
+            size = build_dir.size(filename)
+            md5sum = build_dir.md5sum(filename)
+            if state.is_uploaded(filename, size, md5sum) and \
+               is_on_hub(filename, size, md5sum, remote_directory, session):
+                log.info('%s is already uploaded' % filename)
+                continue
+        todo.append(filename)
+
+    if limiter and len(todo) > 1:
+        uploader = ParallelUploader(session, limiter)
+        lock = threading.Lock()
+        failed = threading.Event()
+
+        def upload_one(filename):
+            if failed.is_set():
+                # Don't start more uploads after one has failed.
+                return
+            log.info("Uploading %s" % filename)
+            try:
+                uploader.upload_file(filename, remote_directory, build_dir)
+            except Exception:
+                failed.set()
+                raise
+            if state:
+                with lock:
+                    state.mark_uploaded(filename, build_dir.size(filename),
+                                        build_dir.md5sum(filename))
+        pool = ThreadPool(limiter.maximum)
+        try:
+            pool.map(upload_one, todo)
+        finally:
+            pool.close()
+            pool.join()
+            uploader.close()
+        return remote_directory
+
+    sizer = ChunkSizer()
+    for filename in todo:
         callback = _progress_callback
         log.info("Uploading %s" % filename)
-        session.uploadWrapper(filename, remote_directory, callback=callback)
-        if callback:
-            print('')
+        upload_file(filename, remote_directory, session, sizer, callback,
+                    build_dir)
+        if state:
+            state.mark_uploaded(filename, build_dir.size(filename),
+                                build_dir.md5sum(filename))
     return remote_directory
 
 
-def cg_import(all_files, metadata, session):
+def cg_import(all_files, write_metadata, session, state=None, build_dir=None,
+              limiter=None):
     """
     Import all files into this Koji content generator.
 
     :param all_files: set of files to upload and import
-    :param metadata: path to metadata json file
+    :param write_metadata: function that writes the metadata json file, and
+                           returns a two-element tuple of the metadata dict
+                           and the file's path. We call this after the
+                           upload, so it can use the checksums that the
+                           upload computed.
     :param session: Koji session
+    :param state: ImportState, to resume a failed import
+    :param build_dir: filemanager.BuildDirectory for these files
+    :param limiter: util.AdaptiveLimiter for parallel uploads
     :returns: buildinfo (dict) from Koji's CGImport call
     """
-    remote_directory = upload(all_files, session)
+    remote_directory = upload(all_files, session, state, build_dir, limiter)
+    (metadata, metadata_file) = write_metadata()
+    upload_file(metadata_file, remote_directory, session, ChunkSizer())
     buildinfo = session.CGImport(metadata, remote_directory)
     if not buildinfo:
         raise RuntimeError('CGImport failed')
+    metrics.inc('misoctl_builds_imported_total')
+    if state:
+        state.remove()
     return buildinfo
 
 
@@ -200,81 +713,381 @@ def tag_build(buildinfo, tag, session):
     nvr = '%(name)s-%(version)s-%(release)s' % buildinfo
     log.info('tagging %s into %s' % (nvr, tag))
     task_id = session.tagBuild(tag, nvr)
+    start = time.time()
     task_result = watch_tasks(session, [task_id], poll_interval=15)
+    metrics.observe('misoctl_tag_wait_seconds', time.time() - start)
     if task_result != 0:
         raise RuntimeError('failed to tag builds')
 
 
-def import_from_directory(directory, session, owner, skip_log, scm_url,
-                          dryrun):
+class PreparedImport(object):
     """
-    Import the build artifacts in this directory into a Koji CG build.
+    Everything we need to import one build directory into Koji.
 
-    :param directory: dir containing the build artifacts, with one dsc file.
-    :param session: Koji session.
+    We prepare an import locally (finding the files and reading the build
+    times) before we upload anything. We don't hash the files here: the
+    upload hashes each file as it sends it, and write_metadata() assembles
+    the output metadata from those checksums afterwards. This way we read
+    each file from disk once. The upload checks each source file against
+    the .dsc as soon as it has sent it, so a bad file stops the import
+    before we upload anything more.
+    """
+
+    def __init__(self, build_dir, nvr, all_files, build):
+        self.build_dir = build_dir
+        self.nvr = nvr
+        self.all_files = all_files
+        self.build = build
+        self.metadata = None
+
+    @property
+    def size(self):
+        """ Total size in bytes of the files we will upload. """
+        return sum(self.build_dir.size(f) for f in self.all_files)
+
+    def write_metadata(self):
+        """
+        Verify the source files, and write the CG metadata.
+
+        :returns: two-element tuple of the metadata dict and the path to
+                  the metadata json file.
+        """
+        # Check the source files against the md5s in the .dsc.
+        self.build_dir.source_files()
+        buildroots = get_buildroots()
+        output = get_output_data(self.all_files, self.build_dir)
+        self.metadata = get_metadata(self.build, buildroots, output)
+        metadata_file = os.path.join(self.build_dir.directory,
+                                     'metadata.json')
+        with open(metadata_file, 'w') as f:
+            json.dump(self.metadata, f)
+        return (self.metadata, metadata_file)
+
+
+class PreparedBundle(object):
+    """
+    Everything we need to import one bundle file into Koji.
+
+    The bundle's manifest already has every file's size and checksum, so
+    we assemble all the metadata up front, and never hash or unpack the
+    files.
+    """
+
+    def __init__(self, bundle_file, nvr, entries, metadata):
+        self.bundle_file = bundle_file
+        self.nvr = nvr
+        self.entries = entries
+        self.metadata = metadata
+
+    @property
+    def size(self):
+        """ Total size in bytes of the files we will upload. """
+        return sum(entry['size'] for entry in self.entries)
+
+    @property
+    def all_files(self):
+        return [entry['name'] for entry in self.entries]
+
+
+def get_nvr(dsc):
+    """ Return the Koji build NVR for this parsed .dsc file. """
+    return '%(Source)s-deb-%(Version)s' % dsc
+
+
+def prepare_bundle(bundle_file, owner, skip_log, scm_url):
+    """
+    Read a bundle's manifest, and assemble the CG metadata.
+
+    See prepare_import() for the parameters.
+
+    :param bundle_file: bundle.Bundle
+    :returns: PreparedBundle
+    """
+    manifest = bundle_file.manifest
+    entries = manifest['files']
+    if skip_log:
+        entries = [entry for entry in entries
+                   if not entry['name'].endswith('.log')]
+    dsc = bundle_file.dsc()
+    build = get_build_data(dsc, manifest['start_time'], manifest['end_time'],
+                           scm_url, owner)
+    output = get_bundle_output_data(entries)
+    metadata = get_metadata(build, get_buildroots(), output)
+    return PreparedBundle(bundle_file, get_nvr(dsc), entries, metadata)
+
+
+def import_bundle(prepared, session):
+    """
+    Stream each file in a PreparedBundle to Koji, and import the build.
+
+    A bundle is one tar stream, so we upload its files one at a time. Koji
+    verifies each file's checksum against the metadata during CGImport.
+
+    :returns: buildinfo (dict) from Koji's CGImport call
+    """
+    remote_directory = unique_path('cli-import')
+    log.info('uploading files to %s' % remote_directory)
+    names = set(prepared.all_files)
+    sizer = ChunkSizer()
+    for entry, f in prepared.bundle_file.members():
+        if entry['name'] not in names:
+            continue
+        log.info('Uploading %s' % entry['name'])
+        upload_stream(f, entry['name'], entry['size'], remote_directory,
+                      session, sizer, _progress_callback)
+    data = json.dumps(prepared.metadata).encode('utf-8')
+    upload_stream(BytesIO(data), 'metadata.json', len(data),
+                  remote_directory, session, sizer)
+    buildinfo = session.CGImport(prepared.metadata, remote_directory)
+    if not buildinfo:
+        raise RuntimeError('CGImport failed')
+    metrics.inc('misoctl_builds_imported_total')
+    return buildinfo
+
+
+def prepare_import(build_dir, owner, skip_log, scm_url):
+    """
+    Find the build artifacts, and gather the build metadata.
+
+    This only touches local files, so it is safe to run in another thread
+    while we upload a different build.
+
+    :param build_dir: filemanager.BuildDirectory with one dsc file.
     :param owner: Koji user to own this imported build.
     :param skip_log: Don't try to import log files for this build.
     :param scm_url: SCM (dist-git) url for this build.
-    :param dryrun: show what would be done, but don't do it.
+    :returns: PreparedImport
     """
     # Discover our files on disk
-    dsc_file = filemanager.find_dsc_file(directory)
-    dsc = filemanager.parse_dsc(dsc_file)
-    source_files = filemanager.find_source_files(dsc, directory)
-    deb_files = filemanager.find_deb_files(directory)
+    dsc_file = build_dir.dsc_file()
+    dsc = build_dir.dsc()
+    source_files = build_dir.source_files(verify=False)
+    deb_files = build_dir.deb_files()
     log_files = set()
-    log_file = filemanager.find_log_file(directory, fatal=not skip_log)
+    log_file = build_dir.log_file(fatal=not skip_log)
     if log_file:
         log_file = rename_log_file(log_file)
         log_files.add(log_file)
 
-    # Bail early if this build already exists
-    nvr = '%(Source)s-deb-%(Version)s' % dsc
-    if session.getBuild(nvr):
-        raise RuntimeError('%s build exists in koji' % nvr)
-
     # Determine build metadata
     if log_file:
         (start_time, end_time) = filemanager.get_build_times(log_file)
     else:
         # This is not optimial, because the start and end times are the same,
         # so it looks as if the build took zero seconds.
-        changes_file = filemanager.find_changes_file(directory)
-        changes_time = filemanager.get_changes_time(changes_file)
+        changes_time = filemanager.get_date_time(build_dir.changes())
         start_time = changes_time
         end_time = changes_time
     build = get_build_data(dsc, start_time, end_time, scm_url, owner)
 
-    # Determine buildroot metadata
-    buildroots = get_buildroots()
-
-    # Determine output metadata
     dsc_files = set([dsc_file])
     all_files = set.union(dsc_files, source_files, deb_files, log_files)
-    output = get_output_data(all_files)
 
-    # Generate the main metdata JSON
-    metadata = get_metadata(build, buildroots, output)
-    with open('metadata.json', 'w') as f:
-        json.dump(metadata, f)
-    all_files.add('metadata.json')
+    return PreparedImport(build_dir, get_nvr(dsc), all_files, build)
 
-    # TODO: check if this build already exists in Koji before uploading here
 
+def run_import(prepared, session, dryrun, limiter=None):
+    """
+    Upload and import a PreparedImport (or PreparedBundle) into Koji.
+
+    :param limiter: util.AdaptiveLimiter for parallel uploads. We upload a
+                    bundle's files one at a time.
+
+    :returns: buildinfo (dict) from Koji's CGImport call, or an empty dict
+              for a dryrun.
+    """
+    if isinstance(prepared, PreparedBundle):
+        if dryrun:
+            log.info('dryrun: would upload from %s'
+                     % prepared.bundle_file.path)
+            for name in prepared.all_files:
+                log.info(name)
+            return {}
+        return import_bundle(prepared, session)
     if dryrun:
+        # Nothing will hash the files on the way to the hub, so this reads
+        # them.
+        (_, metadata_file) = prepared.write_metadata()
         log.info('dryrun: would upload')
-        for filename in all_files:
+        for filename in sorted(prepared.all_files) + [metadata_file]:
             log.info(filename)
         return {}
-    buildinfo = cg_import(all_files, metadata, session)
+    state = ImportState(prepared.build_dir.directory, prepared.nvr)
+    buildinfo = cg_import(prepared.all_files, prepared.write_metadata,
+                          session, state, prepared.build_dir, limiter)
     return buildinfo
 
 
+def import_from_directory(directory, session, owner, skip_log, scm_url,
+                          dryrun, limiter=None):
+    """
+    Import the build artifacts in this directory into a Koji CG build.
+
+    :param directory: dir containing the build artifacts, with one dsc file,
+                      or a bundle file from "misoctl bundle".
+    :param session: Koji session.
+    :param owner: Koji user to own this imported build.
+    :param skip_log: Don't try to import log files for this build.
+    :param scm_url: SCM (dist-git) url for this build.
+    :param dryrun: show what would be done, but don't do it.
+    :param limiter: util.AdaptiveLimiter for parallel uploads
+    """
+    prepared = None
+    if os.path.isfile(directory):
+        # This only reads the bundle's manifest.
+        prepared = prepare_bundle(bundle.Bundle(directory), owner, skip_log,
+                                  scm_url)
+        nvr = prepared.nvr
+    else:
+        build_dir = filemanager.BuildDirectory(directory)
+        nvr = get_nvr(build_dir.dsc())
+
+    # Bail early if this build already exists
+    if session.getBuild(nvr):
+        raise RuntimeError('%s build exists in koji' % nvr)
+
+    if prepared is None:
+        prepared = prepare_import(build_dir, owner, skip_log, scm_url)
+    return run_import(prepared, session, dryrun, limiter)
+
+
+def read_manifest(path):
+    """
+    Read a batch manifest file.
+
+    The manifest is a JSON list of objects with a "directory" key (a build
+    directory or a bundle file), and
+    optional "scm_url" and "tag" keys that override the command-line
+    values. Relative directories are relative to the manifest file.
+
+    :returns: list of dicts
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    for entry in entries:
+        entry['directory'] = os.path.join(base, entry['directory'])
+    return entries
+
+
+def get_batch_entries(args):
+    """
+    Find all the directories to import, from the command line and manifest.
+
+    :returns: list of dicts with "directory", "scm_url" and "tag" keys
+    """
+    entries = [{'directory': directory} for directory in args.directories]
+    if args.manifest:
+        entries.extend(read_manifest(args.manifest))
+    if not entries:
+        raise SystemExit('specify a directory or a --manifest')
+    for entry in entries:
+        entry.setdefault('scm_url', args.scm_url)
+        entry.setdefault('tag', args.tag)
+        if not entry['scm_url']:
+            raise SystemExit('no scm url for %s' % entry['directory'])
+        if not os.path.exists(entry['directory']):
+            raise SystemExit('%s does not exist' % entry['directory'])
+    return entries
+
+
+def import_batch(entries, session, owner, skip_log, dryrun, limiter=None):
+    """
+    Import many build directories over one Koji session.
+
+    We prepare (find and hash) the next directory in a background thread
+    while we upload the current one.
+
+    :param entries: list of dicts from get_batch_entries()
+    :param limiter: util.AdaptiveLimiter for parallel uploads
+    :returns: list of result dicts, one per entry, for print_summary()
+    """
+    results = []
+    todo = []
+    for entry in entries:
+        result = {'directory': entry['directory'], 'nvr': None,
+                  'status': None, 'size': 0, 'seconds': 0}
+        results.append(result)
+        try:
+            if os.path.isfile(entry['directory']):
+                entry['bundle'] = prepare_bundle(
+                    bundle.Bundle(entry['directory']), owner, skip_log,
+                    entry['scm_url'])
+                result['nvr'] = entry['bundle'].nvr
+            else:
+                entry['build_dir'] = filemanager.BuildDirectory(
+                    entry['directory'])
+                result['nvr'] = get_nvr(entry['build_dir'].dsc())
+        except Exception as e:
+            log.error('%s: %s' % (entry['directory'], e))
+            result['status'] = 'failed'
+            continue
+        todo.append((entry, result))
+
+    # Bail early on builds that already exist, with one multicall.
+    koji_nvrs = [result['nvr'] for _, result in todo]
+    buildinfos = misoctl.session.find_builds(koji_nvrs, session)
+    for entry, result in todo:
+        if buildinfos[result['nvr']]:
+            log.warning('%s build exists in koji' % result['nvr'])
+            result['status'] = 'exists'
+    todo = [(entry, result) for entry, result in todo
+            if not result['status']]
+
+    def prepare(entry):
+        if 'bundle' in entry:
+            return entry['bundle']
+        return prepare_import(entry['build_dir'], owner, skip_log,
+                              entry['scm_url'])
+
+    pool = ThreadPool(1)
+    try:
+        pending = None
+        if todo:
+            pending = pool.apply_async(prepare, (todo[0][0],))
+        for i, (entry, result) in enumerate(todo):
+            start = time.time()
+            try:
+                prepared = pending.get()
+            except Exception as e:
+                prepared = None
+                error = e
+            # Prepare the next build while we upload this one.
+            if i + 1 < len(todo):
+                pending = pool.apply_async(prepare, (todo[i + 1][0],))
+            try:
+                if prepared is None:
+                    raise error
+                result['size'] = prepared.size
+                buildinfo = run_import(prepared, session, dryrun, limiter)
+                if entry['tag'] and not dryrun:
+                    tag_build(buildinfo, entry['tag'], session)
+                result['status'] = 'dryrun' if dryrun else 'imported'
+            except Exception as e:
+                log.error('%s: %s' % (entry['directory'], e))
+                result['status'] = 'failed'
+            result['seconds'] = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def print_summary(results):
+    """ Print a table of batch import results. """
+    header = ('nvr', 'status', 'MB', 'seconds', 'directory')
+    print('%-40s %-9s %10s %8s  %s' % header)
+    for result in results:
+        print('%-40s %-9s %10.1f %8d  %s' % (
+            result['nvr'] or '-', result['status'],
+            result['size'] / 1048576.0, result['seconds'],
+            result['directory']))
+
+
 def main(args):
 
     # Pre-flight checks
-    directory = args.directory
-    assert os.path.isdir(directory)
+    entries = get_batch_entries(args)
 
     session = misoctl.session.get_session(args.profile)
     # TODO: verify this session is authorized to import to the debian CG.
@@ -283,19 +1096,19 @@ def main(args):
     owner = args.owner
     verify_user(owner, session)
 
-    tag = args.tag
-    if tag:
+    for tag in set(entry['tag'] for entry in entries if entry['tag']):
         verify_tag(tag, session)
 
-    buildinfo = import_from_directory(directory,
-                                      session,
-                                      args.owner,
-                                      args.skip_log,
-                                      args.scm_url,
-                                      args.dryrun)
-    log.info('imported %(name)s-%(version)s-%(release)s' % buildinfo)
-
-    if tag:
-        tag_build(buildinfo, tag, session)
-    else:
-        log.info('not tagging %(name)s-%(version)s-%(release)s' % buildinfo)
+    limiter = None
+    if args.jobs > 1:
+        limiter = AdaptiveLimiter('koji-upload', args.jobs)
+    results = import_batch(entries, session, owner, args.skip_log,
+                           args.dryrun, limiter)
+    for result in results:
+        if result['status'] == 'imported':
+            log.info('imported %s' % result['nvr'])
+    print_summary(results)
+    failed = [r for r in results if r['status'] in ('failed', 'exists')]
+    if failed:
+        raise SystemExit('%d of %d builds were not imported'
+                         % (len(failed), len(results)))
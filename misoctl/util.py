@@ -1,6 +1,10 @@
 import os
 import errno
+import threading
+import time
 from hashlib import md5
+from misoctl.log import log as log
+from misoctl.metrics import metrics
 
 
 def ensure_directory(path):
@@ -17,8 +21,121 @@ def ensure_directory(path):
 def get_md5sum(filename):
     """ Return the hex md5 digest for a file. """
     chsum = md5()
+    start = time.time()
+    size = 0
     with open(filename, 'rb') as f:
         for chunk in iter(lambda: f.read(4096), b""):
             chsum.update(chunk)
+            size += len(chunk)
     digest = chsum.hexdigest()
+    record_hash(size, time.time() - start)
     return digest
+
+
+class RateLimiter(object):
+    """
+    Cap the combined bandwidth of many threads, with a token bucket.
+
+    :param rate: bytes per second
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """ Account for nbytes, and sleep if we are over our rate. """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Callers that go into debt sleep until it is paid off.
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveLimiter(object):
+    """
+    Limit the requests we have in flight to one server, with AIMD.
+
+    Like TCP congestion control, we allow about one more concurrent request
+    for each round of healthy responses (additive increase), and halve the
+    limit when a request fails or is much slower than the fastest we have
+    seen for that kind of request (multiplicative decrease).
+
+    :param name: server name for logs and the "server" metric label
+    :param maximum: never allow more than this many requests in flight
+    :param minimum: always allow at least this many requests in flight
+    """
+
+    # A response this many times slower than our baseline means congestion.
+    LATENCY_FACTOR = 3.0
+    # Don't halve the limit again for every request that was already in
+    # flight when the server got into trouble.
+    DECREASE_INTERVAL = 1.0
+
+    def __init__(self, name, maximum, minimum=1):
+        self.name = name
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(minimum)
+        self.in_flight = 0
+        # kind of request -> fastest recent response, in seconds
+        self.baselines = {}
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+        metrics.set('misoctl_concurrency_limit', self.limit, server=name)
+
+    def acquire(self):
+        """ Wait until we may send another request. """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, ok=True, seconds=None, kind=None):
+        """
+        Record that one request finished.
+
+        :param ok: False if the request failed because the server is
+                   overloaded, eg. a timeout or a 5xx response.
+        :param seconds: how long the request took, if latency is a useful
+                        signal for this server.
+        :param kind: the kind of request, eg. "search". We only compare
+                     latencies between requests of the same kind, since a
+                     cheap endpoint says nothing about an expensive one.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if ok and seconds is not None:
+                baseline = self.baselines.get(kind)
+                if baseline is None or seconds < baseline:
+                    self.baselines[kind] = seconds
+                elif seconds > baseline * self.LATENCY_FACTOR:
+                    ok = False
+                else:
+                    # Let the baseline follow slow, steady changes.
+                    self.baselines[kind] += (seconds - baseline) * 0.01
+            old_limit = int(self.limit)
+            if ok:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+            elif time.time() - self.last_decrease > self.DECREASE_INTERVAL:
+                self.limit = max(self.limit / 2, self.minimum)
+                self.last_decrease = time.time()
+            if int(self.limit) != old_limit:
+                log.info('%s concurrency limit is now %d'
+                         % (self.name, int(self.limit)))
+            metrics.set('misoctl_concurrency_limit', self.limit,
+                        server=self.name)
+            self.condition.notify_all()
+
+
+def record_hash(nbytes, seconds):
+    """ Record the hash throughput metrics for one file. """
+    metrics.inc('misoctl_hashed_bytes_total', nbytes)
+    metrics.inc('misoctl_hash_seconds_total', seconds)
@@ -161,6 +161,7 @@ setup(
         'koji>=1.16.0',
         'python-dateutil',
         'python-debian',
+        'scandir; python_version < "3.5"',
     ],
     tests_require=[
         'pytest-flake8',